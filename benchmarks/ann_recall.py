@@ -0,0 +1,106 @@
+"""
+Recall and latency of the IVF index against the exact search.
+
+Usage:
+python -m benchmarks.ann_recall --scale 50 --queries 200 --top-n 5
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.ivf_index import IVFIndex
+
+
+def scale_matrix(
+    matrix: np.ndarray, scale: int, noise: float, seed: int = 0
+) -> np.ndarray:
+    """
+    Grow a normalized matrix `scale` times with noisy copies of its rows.
+    """
+    rng = np.random.default_rng(seed)
+    copies = [matrix]
+
+    for _ in range(scale - 1):
+        copies.append(matrix + rng.normal(0, noise, matrix.shape).astype(np.float32))
+
+    return EmbeddingIndex.normalize(np.vstack(copies))
+
+
+def time_queries(index: EmbeddingIndex, queries: np.ndarray, top_n: int, **kwargs):
+    """
+    Run the queries and get their results and the latency of each one in ms.
+    """
+    results = []
+    latencies = []
+
+    for query in queries:
+        start = time.perf_counter()
+        positions, _ = index.search(query, top_n, **kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(positions)
+
+    return results, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--vectorstore", default="data/vectorstore.parquet")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    df = pd.read_parquet(args.vectorstore)
+    matrix = scale_matrix(EmbeddingIndex(df).matrix, args.scale, args.noise)
+    rows = pd.DataFrame(index=range(len(matrix)))
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.choice(len(matrix), args.queries)]
+    queries = queries + rng.normal(0, args.noise, queries.shape).astype(np.float32)
+
+    exact = EmbeddingIndex(rows, matrix=matrix)
+    start = time.perf_counter()
+    ivf = IVFIndex(rows, matrix=matrix, n_lists=args.n_lists)
+    build_seconds = time.perf_counter() - start
+    expected, exact_latencies = time_queries(exact, queries, args.top_n)
+    report = {
+        "rows": len(matrix),
+        "top_n": args.top_n,
+        "n_lists": len(ivf.centroids),
+        "build_seconds": build_seconds,
+        "exact": {
+            "p50_ms": float(np.percentile(exact_latencies, 50)),
+            "p95_ms": float(np.percentile(exact_latencies, 95)),
+        },
+        "ivf": [],
+    }
+
+    for nprobe in args.nprobe:
+        results, latencies = time_queries(ivf, queries, args.top_n, nprobe=nprobe)
+        recall = np.mean(
+            [
+                len(np.intersect1d(found, truth)) / len(truth)
+                for found, truth in zip(results, expected)
+            ]
+        )
+        report["ivf"].append(
+            {
+                "nprobe": nprobe,
+                f"recall@{args.top_n}": float(recall),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+            }
+        )
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+A local stand-in for the Azure OpenAI endpoints used by openai_api_connection.
+
+It serves the deployments list, the embeddings and the chat completions (also
+streamed) with the deterministic answers of benchmarks.fakes, a configurable
+latency, and a fraction of the requests rejected with 429 and Retry-After, so the
+chat and the builds can be driven under load without using quota.
+
+Usage:
+python -m benchmarks.fake_openai_server --port 8765 --error-rate 0.05
+OPENAI_API_BASE=http://127.0.0.1:8765 OPENAI_API_KEY=fake python main.py
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+from benchmarks.fakes import fake_completion, fake_get_embedding
+
+
+class FakeOpenAIServer:
+    """
+    The handlers of the fake endpoints and their configuration.
+
+    Args:
+        embedding_latency (float, optional): Seconds of an embeddings request.
+            Default is 0.05.
+        first_token_latency (float, optional): Seconds until the first token of a
+            completion. Default is 0.3.
+        token_latency (float, optional): Seconds between the streamed tokens.
+            Default is 0.02.
+        jitter (float, optional): The latencies vary uniformly by this fraction.
+            Default is 0.2.
+        error_rate (float, optional): The fraction of requests answered with 429.
+            Default is 0.
+        retry_after (float, optional): The Retry-After seconds of the 429 answers.
+            Default is 1.
+        seed (int, optional): The seed of the latencies and the errors. Default is 0.
+    """
+
+    def __init__(
+        self,
+        embedding_latency: float = 0.05,
+        first_token_latency: float = 0.3,
+        token_latency: float = 0.02,
+        jitter: float = 0.2,
+        error_rate: float = 0,
+        retry_after: float = 1,
+        seed: int = 0,
+    ):
+        self.embedding_latency = embedding_latency
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = {"embeddings": 0, "chat": 0, "rejected": 0}
+
+    async def __sleep(self, seconds: float):
+        if seconds > 0:
+            await asyncio.sleep(
+                seconds * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+            )
+
+    def __reject(self):
+        """
+        Get a 429 answer for a fraction `error_rate` of the requests, None otherwise.
+        """
+        if self.random.random() >= self.error_rate:
+            return None
+
+        self.requests["rejected"] += 1
+        message = (
+            "Requests to the deployment have exceeded the call rate limit. "
+            f"Please retry after {self.retry_after} second."
+        )
+        return web.json_response(
+            {"error": {"code": "429", "message": message}},
+            status=429,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    async def deployments(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": [{"id": "testCX_2"}, {"id": "cx_gpt4"}]})
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self.requests["embeddings"] += 1
+        rejected = self.__reject()
+
+        if rejected is not None:
+            return rejected
+
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await self.__sleep(self.embedding_latency)
+        data = [
+            {"object": "embedding", "index": i, "embedding": fake_get_embedding(text)}
+            for i, text in enumerate(texts)
+        ]
+        tokens = sum(len(text.split()) for text in texts)
+        return web.json_response(
+            {
+                "object": "list",
+                "data": data,
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests["chat"] += 1
+        rejected = self.__reject()
+
+        if rejected is not None:
+            return rejected
+
+        body = await request.json()
+        answer = fake_completion(body["messages"])
+        created = int(time.time())
+        await self.__sleep(self.first_token_latency)
+
+        if not body.get("stream"):
+            await self.__sleep(self.token_latency * len(answer.split()))
+            return web.json_response(
+                {
+                    "object": "chat.completion",
+                    "created": created,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": answer},
+                        }
+                    ],
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        # azure sends a first chunk without choices
+        await response.write(b'data: {"object": "", "choices": []}\n\n')
+
+        for i, word in enumerate(answer.split(" ")):
+            chunk = {
+                "object": "chat.completion.chunk",
+                "created": created,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": None,
+                        "delta": {"content": word if i == 0 else " " + word},
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            await self.__sleep(self.token_latency)
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/openai/deployments", self.deployments)
+        app.router.add_post("/openai/deployments/{engine}/embeddings", self.embeddings)
+        app.router.add_post(
+            "/openai/deployments/{engine}/chat/completions", self.chat_completions
+        )
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765) -> web.AppRunner:
+        """
+        Start serving in the running loop, stop it with `await runner.cleanup()`.
+        """
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=float, default=1)
+
+
+def server_from_arguments(args: argparse.Namespace) -> FakeOpenAIServer:
+    return FakeOpenAIServer(
+        embedding_latency=args.embedding_latency,
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_arguments(args)
+    web.run_app(server.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
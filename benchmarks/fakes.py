@@ -0,0 +1,51 @@
+"""
+Deterministic local stand-ins for the Azure OpenAI calls of the offline benchmarks.
+
+The embeddings are feature-hashed bags of words, so texts that share words are
+similar and the searches return meaningful rows, and the same text always gets the
+same vector in every run and machine.
+"""
+
+import zlib
+
+import numpy as np
+
+EMBEDDING_DIMENSION = 1536
+
+
+def fake_get_embedding(text: str, engine: str = "testCX_2") -> list:
+    """
+    Same signature as openai.embeddings_utils.get_embedding.
+    """
+    words = text.lower().split()
+
+    if not words:
+        return [0.0] * EMBEDDING_DIMENSION
+
+    hashes = np.array(
+        [zlib.crc32(word.encode("utf-8")) for word in words], dtype=np.int64
+    )
+    signs = np.where(hashes & 1, 1.0, -1.0)
+    vector = np.bincount(hashes % EMBEDDING_DIMENSION, signs, EMBEDDING_DIMENSION)
+    return (vector / (np.linalg.norm(vector) or 1)).tolist()
+
+
+def fake_request_embeddings(texts: list, engine: str) -> list:
+    """
+    Same signature as openai_api_connection.batch_embeddings.request_embeddings.
+    """
+    return [fake_get_embedding(text, engine) for text in texts]
+
+
+def fake_completion(
+    messages: list,
+    model: str = "gpt-3.5-turbo",
+    engine: str = "cx_gpt4",
+    temperature: float = 0,
+) -> str:
+    """
+    Same signature as get_completion_from_messages, it answers with the start of the
+    context of the system message.
+    """
+    context = messages[0]["content"]
+    return f"Answer to '{messages[-1]['content']}': {context[:200]}"
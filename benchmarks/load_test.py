@@ -0,0 +1,180 @@
+"""
+Drive N concurrent multi-turn chat sessions and report latency and throughput.
+
+The sessions call the `chatbot` handler of main.py, the one served by
+run_chatbot, with their own session state and history. The Azure OpenAI requests
+go to the fake server of benchmarks.fake_openai_server, started in-process unless
+`--api-base` points to a running one. The query embeddings are cached only in
+memory, the real cache file is not touched.
+
+The fake server embeds the questions with benchmarks.fakes, so the loaded store is
+embedded again with the same fakes in memory, and the context threshold is lowered
+to `--threshold`, so the turns retrieve context and go through its assembly.
+
+Usage:
+python -m benchmarks.load_test --sessions 50 --turns 5 --think-time 2
+python -m benchmarks.load_test --sessions 50 --error-rate 0.05 --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+import numpy as np
+
+import main as chat_app
+from benchmarks.fake_openai_server import add_server_arguments, server_from_arguments
+from benchmarks.fakes import fake_get_embedding
+from benchmarks.suite import make_queries
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.metrics import metrics
+from openai_api_connection.async_client import AsyncAzureOpenAIClient
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+
+    values = np.array(values) * 1000
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+async def run_session(
+    session_id: int,
+    questions: list,
+    args: argparse.Namespace,
+    turns: list,
+    errors: Counter,
+):
+    """
+    Run the turns of one conversation, recording the latency of every answer.
+    """
+    rng = random.Random(session_id)
+    session = {}
+    history = []
+    await asyncio.sleep(rng.uniform(0, args.ramp_up))
+
+    for turn in range(args.turns):
+        question = rng.choice(questions)
+        response = ""
+        first_token = None
+        start = time.perf_counter()
+
+        try:
+            async for response in chat_app.chatbot(question, history, session):
+                if first_token is None:
+                    first_token = time.perf_counter()
+        except Exception as error:
+            errors[type(error).__name__] += 1
+            continue
+
+        end = time.perf_counter()
+        turns.append(
+            {
+                "session": session_id,
+                "turn": turn,
+                "first_token": (first_token or end) - start,
+                "total": end - start,
+            }
+        )
+        history.append([question, response])
+        await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+def use_fake_embeddings(threshold: float):
+    """
+    Search the loaded store with the fake embeddings of its chunks, the ones of the
+    fake server, and keep the context above `threshold`.
+    """
+    matrix = EmbeddingIndex.normalize(
+        [fake_get_embedding(text) for text in chat_app.df.content]
+    )
+    chat_app.similarity_searcher.index = EmbeddingIndex(chat_app.df, matrix=matrix)
+    chat_app.CONTEXT_THRESHOLD = threshold
+    chat_app.similarity_searcher.min_similarity = threshold
+
+
+async def run(args: argparse.Namespace) -> dict:
+    runner = None
+    server = None
+    api_base = args.api_base
+
+    if api_base is None:
+        server = server_from_arguments(args)
+        runner = await server.start(port=args.port)
+        api_base = f"http://127.0.0.1:{args.port}"
+
+    client = AsyncAzureOpenAIClient(api_base=api_base, api_key="fake")
+    chat_app.init_chatbot(client, embedding_cache_path=None, use_response_cache=False)
+    use_fake_embeddings(args.threshold)
+    questions = make_queries(chat_app.df, args.questions)
+    turns = []
+    errors = Counter()
+    start = time.perf_counter()
+
+    try:
+        await asyncio.gather(
+            *[
+                run_session(i, questions, args, turns, errors)
+                for i in range(args.sessions)
+            ]
+        )
+    finally:
+        wall_seconds = time.perf_counter() - start
+        await client.close()
+
+        if runner is not None:
+            await runner.cleanup()
+
+    stages = {
+        stage: {"count": h["count"], "mean_ms": 1000 * h["sum"] / h["count"]}
+        for stage, h in metrics.to_dict().items()
+        if h["count"]
+    }
+    return {
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "completed_turns": len(turns),
+        "errors": dict(errors),
+        "wall_seconds": wall_seconds,
+        "turns_per_second": len(turns) / wall_seconds,
+        "first_token": percentiles([t["first_token"] for t in turns]),
+        "total": percentiles([t["total"] for t in turns]),
+        "stages": stages,
+        "server_requests": server.requests if server is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--think-time", type=float, default=1)
+    parser.add_argument("--ramp-up", type=float, default=2)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--api-base", default=None)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default=None)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+
+
+if __name__ == "__main__":
+    main()
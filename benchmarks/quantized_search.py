@@ -0,0 +1,94 @@
+"""
+Top-k agreement, memory and latency of the quantized indexes against full precision.
+
+Usage:
+python -m benchmarks.quantized_search --scale 20 --queries 200 --top-n 5
+
+It exits with an error when the share of queries whose top-k matches the full
+precision search is below `--min-topk-match`, by default all of them.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.ann_recall import scale_matrix
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.quantized_index import QuantizedIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--vectorstore", default="data/vectorstore.parquet")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--min-topk-match", type=float, default=1.0)
+    args = parser.parse_args()
+
+    df = pd.read_parquet(args.vectorstore)
+    matrix = scale_matrix(EmbeddingIndex(df).matrix, args.scale, args.noise)
+    # the reference is the float64 path of the original searcher
+    store = pd.DataFrame({"ada_v2": list(matrix.astype(np.float64))})
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.choice(len(matrix), args.queries)].astype(np.float64)
+    queries = queries + rng.normal(0, args.noise, queries.shape)
+    reference = np.vstack(store.ada_v2.values)
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    report = {
+        "rows": len(matrix),
+        "top_n": args.top_n,
+        "float64_bytes": reference.nbytes,
+    }
+
+    for dtype in ("float16", "int8"):
+        index = QuantizedIndex(store, dtype=dtype)
+        same_rows = 0
+        same_threshold = 0
+        max_score_error = 0.0
+        latencies = []
+
+        for query in queries:
+            expected_scores = reference @ (query / np.linalg.norm(query))
+            expected = EmbeddingIndex.top_k(expected_scores, args.top_n)
+            start = time.perf_counter()
+            positions, scores = index.search(query, args.top_n)
+            latencies.append((time.perf_counter() - start) * 1000)
+            same_rows += np.array_equal(positions, expected)
+            same_threshold += np.array_equal(
+                scores >= args.threshold, expected_scores[expected] >= args.threshold
+            )
+            max_score_error = max(
+                max_score_error,
+                float(np.abs(scores - expected_scores[positions]).max()),
+            )
+
+        report[dtype] = {
+            "bytes": index.codes.nbytes + index.scales.nbytes,
+            "memory_reduction": reference.nbytes
+            / (index.codes.nbytes + index.scales.nbytes),
+            "topk_match_rate": same_rows / len(queries),
+            "threshold_match_rate": same_threshold / len(queries),
+            "max_score_error": max_score_error,
+            "p50_ms": float(np.percentile(latencies, 50)),
+        }
+
+    print(json.dumps(report, indent=2))
+    failed = [
+        dtype
+        for dtype in ("float16", "int8")
+        if report[dtype]["topk_match_rate"] < args.min_topk_match
+    ]
+
+    if failed:
+        sys.exit(f"The top-k of {', '.join(failed)} does not match full precision")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Recall@k, MRR and score distribution of the retrieval on a labeled question set.
+
+The questions are a JSON lines file, every line with the question and the pages
+that answer it:
+{"question": "How do I load a PDF?", "references": [{"name_path": "a.pdf", "page": 3}]}
+
+All the questions are embedded in batches (through the embedding cache) and searched
+together with SimilaritiesContextSearcher.get_dataframe_top_similarities_batch. The
+threshold sweep shows, for every threshold, how many of the retrieved rows are kept
+by get_context_and_references and how many of them are relevant.
+
+Usage:
+python -m benchmarks.retrieval_eval questions.jsonl --k 1 5 10 --thresholds 0.75 0.8
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.fakes import fake_request_embeddings
+from load_transform_data.embedding_cache import EmbeddingCache
+from load_transform_data.mmap_store import load_mmap_index
+from load_transform_data.similarities_searcher import SimilaritiesContextSearcher
+from openai_api_connection.batch_embeddings import BatchEmbedder
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def load_questions(path: str) -> tuple[list, list]:
+    """
+    Read the questions and the set of (name_path, page) that answer each one.
+    """
+    questions = []
+    labels = []
+
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+
+            if not item["references"]:
+                raise ValueError(f"The question {item['question']!r} has no references")
+
+            questions.append(item["question"])
+            labels.append(
+                {(ref["name_path"], int(ref["page"])) for ref in item["references"]}
+            )
+
+    return questions, labels
+
+
+def describe(scores: list) -> dict:
+    """
+    Get the count and percentiles of some scores.
+    """
+    if len(scores) == 0:
+        return {"count": 0}
+
+    values = np.percentile(scores, PERCENTILES)
+    return {
+        "count": len(scores),
+        **{f"p{p}": float(v) for p, v in zip(PERCENTILES, values)},
+    }
+
+
+def evaluate(results: list, labels: list, ks: list, thresholds: list) -> dict:
+    """
+    Compute the metrics of the search results against the labels.
+
+    Args:
+        results (list): The SearchResult of every question.
+        labels (list): The set of (name_path, page) of every question.
+        ks (list): The cutoffs of recall@k.
+        thresholds (list): The similarity thresholds of the sweep.
+
+    Returns:
+        dict: recall@k, MRR, the score distributions and the threshold sweep.
+    """
+    recall = {k: [] for k in ks}
+    reciprocal_ranks = []
+    relevant_scores = []
+    other_scores = []
+    top_scores = []
+    sweep = {t: {"kept": 0, "relevant": 0, "found": [], "empty": 0} for t in thresholds}
+
+    for result, expected in zip(results, labels):
+        metadata = result.metadata
+        pages = list(zip(metadata.name_path, metadata.page.astype(int)))
+        relevant = np.array([page in expected for page in pages], dtype=bool)
+        scores = np.asarray(result.scores, dtype=np.float64)
+
+        for k in ks:
+            recall[k].append(len(expected.intersection(pages[:k])) / len(expected))
+
+        hits = np.flatnonzero(relevant)
+        reciprocal_ranks.append(1 / (hits[0] + 1) if hits.size else 0.0)
+        relevant_scores.extend(scores[relevant])
+        other_scores.extend(scores[~relevant])
+
+        if scores.size:
+            top_scores.append(scores[0])
+
+        for threshold, stats in sweep.items():
+            kept = scores >= threshold
+            stats["kept"] += int(kept.sum())
+            stats["relevant"] += int((kept & relevant).sum())
+            stats["empty"] += int(not kept.any())
+            kept_pages = {page for page, keep in zip(pages, kept) if keep}
+            stats["found"].append(len(expected & kept_pages) / len(expected))
+
+    n_questions = len(results)
+    return {
+        "questions": n_questions,
+        "recall_at_k": {k: float(np.mean(values)) for k, values in recall.items()},
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "scores": {
+            "top1": describe(top_scores),
+            "relevant": describe(relevant_scores),
+            "not_relevant": describe(other_scores),
+        },
+        "thresholds": {
+            threshold: {
+                "precision": (
+                    stats["relevant"] / stats["kept"] if stats["kept"] else 0.0
+                ),
+                "recall": float(np.mean(stats["found"])),
+                "rows_per_question": stats["kept"] / n_questions,
+                "empty_context_rate": stats["empty"] / n_questions,
+            }
+            for threshold, stats in sweep.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("questions")
+    parser.add_argument("--store", default="data/vectorstore")
+    parser.add_argument("--embedding-cache", default="data/embedding_cache.sqlite")
+    parser.add_argument("--mode", default="dense", choices=["dense", "hybrid"])
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.7, 0.75, 0.8, 0.85, 0.9]
+    )
+    parser.add_argument(
+        "--fake-embeddings",
+        action="store_true",
+        help="embed with benchmarks.fakes, for a store built with them",
+    )
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    questions, labels = load_questions(args.questions)
+    index = load_mmap_index(args.store)
+    embedding_cache = EmbeddingCache(args.embedding_cache)
+
+    if args.fake_embeddings:
+        embedder = BatchEmbedder(
+            tokens_per_minute=10**12,
+            requests_per_minute=10**9,
+            request_function=fake_request_embeddings,
+        )
+    else:
+        embedder = BatchEmbedder(embedding_cache=embedding_cache)
+
+    searcher = SimilaritiesContextSearcher(
+        index, embedding_cache=embedding_cache, mode=args.mode
+    )
+    start = time.perf_counter()
+    embeddings = embedder.embed(questions)
+    middle = time.perf_counter()
+    results = searcher.get_dataframe_top_similarities_batch(
+        index.df, questions, top_n=max(args.k), embeddings=embeddings
+    )
+    end = time.perf_counter()
+    report = evaluate(results, labels, sorted(args.k), sorted(args.thresholds))
+    report["embedding_seconds"] = middle - start
+    report["search_seconds"] = end - middle
+    text = json.dumps(report, indent=2)
+    print(text)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+
+
+if __name__ == "__main__":
+    main()
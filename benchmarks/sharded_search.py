@@ -0,0 +1,68 @@
+"""
+Latency of the sharded exact search from 1 to N shards.
+
+The BLAS threads are limited to one before NumPy is imported, so every shard uses a
+single core and the speedup measures the sharding, not the threads of the BLAS.
+
+Usage:
+python -m benchmarks.sharded_search --scale 100 --queries 200 --shards 1 2 4 8
+"""
+
+import argparse
+import json
+import os
+
+# before NumPy loads its BLAS, which reads them once
+for variable in ("OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "OMP_NUM_THREADS"):
+    os.environ[variable] = "1"
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.ann_recall import scale_matrix, time_queries
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.sharded_index import ShardedIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--vectorstore", default="data/vectorstore.parquet")
+    parser.add_argument("--scale", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument(
+        "--shards", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1]
+    )
+    args = parser.parse_args()
+
+    df = pd.read_parquet(args.vectorstore)
+    matrix = scale_matrix(EmbeddingIndex(df).matrix, args.scale, args.noise)
+    store = pd.DataFrame(index=range(len(matrix)))
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.choice(len(matrix), args.queries)]
+    queries = queries + rng.normal(0, args.noise, queries.shape).astype(np.float32)
+    expected, _ = time_queries(
+        EmbeddingIndex(store, matrix=matrix), queries, args.top_n
+    )
+    report = {"rows": len(matrix), "top_n": args.top_n, "shards": {}}
+    baseline = None
+
+    for n_shards in sorted(set(args.shards)):
+        index = ShardedIndex(store, matrix=matrix, n_shards=n_shards, min_shard_rows=1)
+        results, latencies = time_queries(index, queries, args.top_n)
+        index.close()
+        p50 = float(np.percentile(latencies, 50))
+        baseline = baseline or p50
+        report["shards"][n_shards] = {
+            "p50_ms": p50,
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "speedup": baseline / p50,
+            "same_results": all(map(np.array_equal, results, expected)),
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Offline benchmarks of the build and query hot paths across corpus sizes.
+
+The Azure OpenAI calls are replaced by the deterministic stand-ins of
+benchmarks.fakes, and the corpora are copies of data/vectorstore.parquet scaled
+`--scales` times. The tiktoken encoding has to be in the local tiktoken cache.
+The report is JSON, and `--compare` checks it against a report of another commit.
+
+Usage:
+python -m benchmarks.suite --scales 1 4 16 --output bench.json
+python -m benchmarks.suite --scales 1 4 16 --compare bench.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.clean_content import make_pages
+from benchmarks.fakes import (
+    fake_completion,
+    fake_get_embedding,
+    fake_request_embeddings,
+)
+from load_transform_data.loader_blob_storage import AzureBlobStorageDocumentLoader
+from load_transform_data.similarities_searcher import SimilaritiesContextSearcher
+from load_transform_data.splitters import TextSplitter
+from load_transform_data.vectorstore import VectorStore
+from openai_api_connection.batch_embeddings import BatchEmbedder
+
+
+def make_corpus(base: pd.DataFrame, scale: int) -> pd.DataFrame:
+    """
+    Build raw pages like the loader output, `scale` copies of every base page with
+    different noise and file names.
+    """
+    pages = base.groupby(["name_path", "page"], sort=False).content.apply(" ".join)
+    pages = pages.reset_index()
+    copies = []
+
+    for copy in range(scale):
+        df = pages.assign(name_path=pages.name_path + f"#{copy}")
+        df["content"] = make_pages(df.content.tolist(), len(df), seed=copy)
+        copies.append(df)
+
+    corpus = pd.concat(copies, ignore_index=True)
+    corpus["index_document"] = corpus.groupby("name_path").ngroup()
+    return corpus[["name_path", "index_document", "page", "content"]]
+
+
+def make_queries(store: pd.DataFrame, n_queries: int, seed: int = 0) -> list:
+    """
+    Make questions from the first words of random chunks.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(store), n_queries)
+    return [" ".join(store.content.iloc[i].split()[:12]) for i in rows]
+
+
+def timed(function, repeat: int) -> tuple[list, object]:
+    """
+    Run a function `repeat` times and get the seconds of each run and the last output.
+    """
+    seconds = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        seconds.append(time.perf_counter() - start)
+
+    return seconds, output
+
+
+def summarize(seconds: list, items: int) -> dict:
+    return {
+        "items": items,
+        "min_seconds": float(np.min(seconds)),
+        "median_seconds": float(np.median(seconds)),
+        "items_per_second": items / float(np.median(seconds)) if items else 0.0,
+    }
+
+
+def summarize_latencies(latencies: list) -> dict:
+    latencies = np.array(latencies) * 1000
+    return {
+        "items": len(latencies),
+        "median_seconds": float(np.median(latencies)) / 1000,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def run_scale(base: pd.DataFrame, scale: int, args) -> dict:
+    """
+    Time every stage on a corpus `scale` times the base vectorstore.
+    """
+    corpus = make_corpus(base, scale)
+    clean_content = AzureBlobStorageDocumentLoader.clean_content
+    splitter = TextSplitter(tokens_per_document=600, overlap=40)
+    stages = {}
+
+    seconds, cleaned = timed(
+        lambda: [clean_content(x) for x in corpus.content], args.repeat
+    )
+    stages["clean_content"] = summarize(seconds, len(corpus))
+    pages = corpus.assign(content=cleaned)
+
+    seconds, documents = timed(
+        lambda: splitter.generate_documents(pages.copy()), args.repeat
+    )
+    stages["generate_documents"] = summarize(seconds, len(pages))
+
+    def create_vector_store():
+        embedder = BatchEmbedder(
+            tokens_per_minute=10**12,
+            requests_per_minute=10**9,
+            request_function=fake_request_embeddings,
+        )
+        vectorstore = VectorStore(documents.copy(), embedder=embedder)
+        return vectorstore.create_vector_store()
+
+    with mock.patch("load_transform_data.vectorstore.embedding_connection"):
+        seconds, store = timed(create_vector_store, args.repeat)
+
+    stages["create_vector_store"] = summarize(seconds, len(store))
+    searcher = SimilaritiesContextSearcher()
+    queries = make_queries(store, args.queries)
+    search_latencies = []
+    context_latencies = []
+    chat_latencies = []
+
+    with mock.patch(
+        "load_transform_data.similarities_searcher.get_embedding", fake_get_embedding
+    ):
+        # the first search builds the index, it is not timed
+        searcher.get_dataframe_top_similarities(store, queries[0], top_n=args.top_n)
+
+        for query in queries:
+            start = time.perf_counter()
+            result = searcher.get_dataframe_top_similarities(
+                store, query, top_n=args.top_n
+            )
+            middle = time.perf_counter()
+            context, _ = searcher.get_context_and_references(result, args.threshold)
+            end = time.perf_counter()
+            fake_completion(
+                [
+                    {"role": "system", "content": context},
+                    {"role": "user", "content": query},
+                ]
+            )
+            search_latencies.append(middle - start)
+            context_latencies.append(end - middle)
+            chat_latencies.append(time.perf_counter() - start)
+
+    stages["get_dataframe_top_similarities"] = summarize_latencies(search_latencies)
+    stages["get_context_and_references"] = summarize_latencies(context_latencies)
+    stages["chat_turn"] = summarize_latencies(chat_latencies)
+    return {
+        "scale": scale,
+        "pages": len(corpus),
+        "chunks": len(store),
+        "stages": stages,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Get the stages whose median time grew more than `tolerance` against the baseline.
+    """
+    previous = {
+        (run["scale"], stage): values["median_seconds"]
+        for run in baseline["runs"]
+        for stage, values in run["stages"].items()
+    }
+    regressions = []
+
+    for run in report["runs"]:
+        for stage, values in run["stages"].items():
+            before = previous.get((run["scale"], stage))
+
+            if not before:
+                continue
+
+            ratio = values["median_seconds"] / before
+
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    {"scale": run["scale"], "stage": stage, "ratio": ratio}
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--vectorstore", default="data/vectorstore.parquet")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.3)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    base = pd.read_parquet(args.vectorstore, columns=["name_path", "page", "content"])
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "runs": [run_scale(base, scale, args) for scale in args.scales],
+    }
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        report["baseline_commit"] = baseline.get("commit")
+        report["regressions"] = compare(report, baseline, args.tolerance)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
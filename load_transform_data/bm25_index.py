@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import re
+import sys
+from typing import Iterable
+
+import numpy as np
+import scipy.sparse as sp
+
+from load_transform_data.embedding_index import EmbeddingIndex
+
+BM25_SUFFIX = ".bm25.npz"
+# words and dotted identifiers, e.g. "langchain.chains.RetrievalQA"
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*")
+IDENTIFIER_PART = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+class BM25Index:
+    """
+    A sparse inverted index that scores the chunks with BM25.
+
+    The identifiers are kept whole, so an exact API name like `RetrievalQA` or
+    `from_chain_type` is a rare term that scores high, and they are also split in
+    their camelCase, snake_case and dotted parts, so "retrieval qa" finds them too.
+    The BM25 weight of every (chunk, term) pair is computed when the index is built
+    and stored in a sparse matrix by term, a query only reads the columns of its
+    terms.
+    Usage:
+    index = BM25Index(df.content)
+    positions, scores = index.search("How do I use RetrievalQA?", top_n=100)
+
+    Args:
+        texts (Iterable[str], optional): The content of the chunks, in the order of
+            the vectorstore. Default is None, used by `load`.
+        k1 (float, optional): The term frequency saturation. Default is 1.5.
+        b (float, optional): The length normalization. Default is 0.75.
+        fingerprint (str, optional): The get_store_fingerprint of the vectorstore the
+            index is built from, saved with it to detect a stale index. Default is None.
+    """
+
+    def __init__(
+        self,
+        texts: Iterable[str] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        fingerprint: str = None,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = fingerprint
+        self.vocabulary = {}
+        self.weights = sp.csc_matrix((0, 0), dtype=np.float32)
+
+        if texts is not None:
+            self.__build(texts)
+
+    def __len__(self) -> int:
+        return self.weights.shape[0]
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        """
+        Split a text in lowercase terms, the identifiers whole and by parts.
+        """
+        terms = []
+
+        for word in TOKEN_PATTERN.findall(text):
+            terms.append(word.lower())
+            segments = [segment.lower() for segment in word.split(".") if segment]
+
+            if len(segments) > 1:
+                terms.extend(segments)
+
+            parts = [
+                part.lower()
+                for piece in re.split(r"[._]", word)
+                for part in IDENTIFIER_PART.findall(piece)
+            ]
+
+            if len(parts) > 1 and parts != segments:
+                terms.extend(part for part in parts if part not in segments)
+
+        return terms
+
+    def __build(self, texts: Iterable[str]):
+        rows = []
+        columns = []
+        n_rows = 0
+
+        for row, text in enumerate(texts):
+            for term in self.tokenize(text):
+                columns.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                rows.append(row)
+
+            n_rows = row + 1
+
+        shape = (n_rows, len(self.vocabulary))
+        frequencies = sp.coo_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=shape
+        ).tocsc()
+        frequencies.sum_duplicates()
+        lengths = np.asarray(frequencies.sum(axis=1)).ravel()
+        average_length = lengths.mean() if n_rows else 0
+        document_frequency = np.diff(frequencies.indptr)
+        idf = np.log(
+            1 + (n_rows - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+
+        tf = frequencies.data
+        term_of_value = np.repeat(np.arange(shape[1]), document_frequency)
+        length_norm = (
+            1 - self.b + self.b * lengths[frequencies.indices] / (average_length or 1)
+        )
+        frequencies.data = (
+            idf[term_of_value] * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+        ).astype(np.float32)
+        self.weights = frequencies
+        logging.info(f"BM25 index built with {n_rows} chunks and {shape[1]} terms")
+
+    def scores(self, query: str, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Get the BM25 score of every chunk, or of the sorted `rows`, for a query.
+        """
+        terms = {self.vocabulary.get(term) for term in self.tokenize(query)}
+        terms = sorted(term for term in terms if term is not None)
+        size = len(self) if rows is None else rows.size
+
+        if not terms:
+            return np.zeros(size, dtype=np.float32)
+
+        postings = self.weights[:, terms]
+
+        if rows is None:
+            return np.asarray(postings.sum(axis=1)).ravel()
+
+        # only the postings of the query terms are read, not the rest of the corpus
+        found = np.searchsorted(rows, postings.indices)
+        valid = found < rows.size
+        valid[valid] = rows[found[valid]] == postings.indices[valid]
+        scores = np.bincount(found[valid], weights=postings.data[valid], minlength=size)
+        return scores.astype(np.float32)
+
+    def search(
+        self, query: str, top_n: int = 100, rows: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the chunks with the highest BM25 score for a query.
+
+        Args:
+            query (str): The question of the user.
+            top_n (int, optional): The number of chunks to retrieve. Default is 100.
+            rows (np.ndarray, optional): The sorted row positions to search, from
+                PartitionMap.rows. Default is None, all the chunks.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions in the vectorstore and
+                their scores, highest first, only the chunks with some query term.
+        """
+        scores = self.scores(query, rows)
+        positions = EmbeddingIndex.top_k(scores, top_n)
+        positions = positions[scores[positions] > 0]
+        scores = scores[positions]
+
+        if rows is not None:
+            positions = rows[positions]
+
+        return positions, scores
+
+    def save(self, path: str):
+        """
+        Save the index next to the vectorstore, in `path` + ".bm25.npz".
+
+        Args:
+            path (str): The path of the store without extension.
+        """
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez(
+            path + BM25_SUFFIX,
+            data=self.weights.data,
+            indices=self.weights.indices,
+            indptr=self.weights.indptr,
+            shape=np.array(self.weights.shape),
+            terms=np.array(json.dumps(terms)),
+            parameters=np.array([self.k1, self.b]),
+            fingerprint=np.array(self.fingerprint or ""),
+        )
+        logging.info(f"BM25 index saved in {path + BM25_SUFFIX}")
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """
+        Load the index saved with `save`.
+
+        Args:
+            path (str): The path of the store without extension.
+
+        Returns:
+            BM25Index: The loaded index.
+        """
+        with np.load(path + BM25_SUFFIX) as saved:
+            k1, b = saved["parameters"]
+            index = cls(k1=float(k1), b=float(b))
+            index.weights = sp.csc_matrix(
+                (saved["data"], saved["indices"], saved["indptr"]),
+                shape=tuple(saved["shape"]),
+            )
+            terms = json.loads(str(saved["terms"]))
+
+            # the indexes saved without it are considered stale
+            if "fingerprint" in saved:
+                index.fingerprint = str(saved["fingerprint"]) or None
+
+        index.vocabulary = {term: i for i, term in enumerate(terms)}
+        return index
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        Check if there is a saved index for the store in `path`.
+        """
+        return os.path.exists(path + BM25_SUFFIX)
+
+
+if __name__ == "__main__":
+    # python -m load_transform_data.bm25_index data/vectorstore
+    from load_transform_data.mmap_store import load_mmap_store
+    from load_transform_data.utils import get_store_fingerprint
+
+    logging.basicConfig(level=logging.INFO)
+    store_path = sys.argv[1]
+    df, _ = load_mmap_store(store_path)
+    BM25Index(df.content, fingerprint=get_store_fingerprint(df)).save(store_path)
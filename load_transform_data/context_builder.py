@@ -0,0 +1,199 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+class ContextBuilder:
+    """
+    Build the context of the prompt from the retrieved chunks within a token budget.
+
+    The chunks of the same document and page that overlap or touch, by their
+    character offsets, are merged in a single passage without repeating the
+    overlapped text. The passages are then packed in score order while their token
+    counts fit in `max_context_tokens`, and joined with `separator`.
+
+    The token counts are read from the 'n_tokens' column of the vectorstore. Stores
+    without it fall back to an estimate of `chars_per_token` characters per token,
+    and stores without the 'char_start' and 'char_end' offsets are not merged.
+    Usage:
+    builder = ContextBuilder(max_context_tokens=3000)
+    context, references = builder.build(hits)
+
+    Args:
+        max_context_tokens (int, optional): The token budget of the context.
+            Default is 3000.
+        separator (str, optional): The text between passages. Default is "\\n\\n".
+        chars_per_token (float, optional): The estimate used without 'n_tokens'.
+            Default is 4.
+    """
+
+    def __init__(
+        self,
+        max_context_tokens: int = 3000,
+        separator: str = "\n\n",
+        chars_per_token: float = 4,
+    ):
+        self.max_context_tokens = max_context_tokens
+        self.separator = separator
+        self.chars_per_token = chars_per_token
+
+    def __count_tokens(self, hits: pd.DataFrame) -> pd.Series:
+        """
+        Get the number of tokens of each chunk.
+        """
+        if "n_tokens" in hits.columns:
+            return hits.n_tokens.astype("int64")
+
+        return np.ceil(hits.content.str.len() / self.chars_per_token).astype("int64")
+
+    @staticmethod
+    def __merge_chunks(chunks: list) -> list:
+        """
+        Merge the overlapping or touching chunks, sorted by document, page and offset.
+
+        Args:
+            chunks (list): The (name_path, page, char_start, char_end, content,
+                n_tokens, similarity) of every chunk.
+
+        Returns:
+            list: One dict per passage.
+        """
+        passages = []
+        passage = None
+        end = None
+
+        for name_path, page, char_start, char_end, content, n_tokens, score in chunks:
+            same_page = passage is not None and (name_path, page) == (
+                passage["name_path"],
+                passage["page"],
+            )
+
+            if not same_page or char_start > end + 1:
+                passage = {
+                    "name_path": name_path,
+                    "page": page,
+                    "content": content,
+                    "n_tokens": n_tokens,
+                    "similarities": score,
+                }
+                passages.append(passage)
+                end = char_end
+                continue
+
+            if char_start > end:
+                passage["content"] += " " + content
+                passage["n_tokens"] += n_tokens
+            elif char_end > end:
+                # only the part after the previous end is new
+                new_part = content[end - char_start :]
+                passage["content"] += new_part
+                passage["n_tokens"] += int(
+                    np.ceil(n_tokens * len(new_part) / max(len(content), 1))
+                )
+
+            passage["similarities"] = max(passage["similarities"], score)
+            end = max(end, char_end)
+
+        return passages
+
+    def merge(self, hits: pd.DataFrame) -> pd.DataFrame:
+        """
+        Merge the overlapping or touching chunks of the same document and page.
+
+        The hits are few (the top-k of a search), so they are merged in plain Python
+        instead of with a pandas groupby.
+
+        Args:
+            hits (pd.DataFrame): The retrieved chunks with a 'similarities' column.
+
+        Returns:
+            pd.DataFrame: One row per passage with 'name_path', 'page', 'content',
+                'n_tokens' and 'similarities' (the best score of its chunks), sorted
+                by score.
+        """
+        hits = hits.assign(n_tokens=self.__count_tokens(hits))
+
+        if not {"char_start", "char_end"} <= set(hits.columns):
+            passages = hits[
+                ["name_path", "page", "content", "n_tokens", "similarities"]
+            ]
+            return passages.sort_values("similarities", ascending=False, kind="stable")
+
+        chunks = sorted(
+            zip(
+                hits.name_path.tolist(),
+                hits.page.tolist(),
+                hits.char_start.tolist(),
+                hits.char_end.tolist(),
+                hits.content.tolist(),
+                hits.n_tokens.tolist(),
+                hits.similarities.tolist(),
+            ),
+            key=lambda chunk: chunk[:3],
+        )
+        passages = self.__merge_chunks(chunks)
+        passages.sort(key=lambda passage: -passage["similarities"])
+        return pd.DataFrame(
+            passages,
+            columns=["name_path", "page", "content", "n_tokens", "similarities"],
+        )
+
+    def pack(self, passages: pd.DataFrame) -> pd.DataFrame:
+        """
+        Select the passages in score order while they fit in the token budget.
+
+        A passage that does not fit is skipped, and the next ones are still tried.
+
+        Args:
+            passages (pd.DataFrame): The output of `merge`.
+
+        Returns:
+            pd.DataFrame: The selected passages, in score order.
+        """
+        selected = []
+        used = 0
+
+        for i, n_tokens in zip(passages.index, passages.n_tokens):
+            if used + n_tokens <= self.max_context_tokens:
+                selected.append(i)
+                used += n_tokens
+
+        logging.info(
+            f"{len(selected)}/{len(passages)} passages, {used} tokens in the context"
+        )
+        return passages.loc[selected]
+
+    @staticmethod
+    def format_references(passages: pd.DataFrame) -> str:
+        """
+        Format the files and pages of the passages, the best file first.
+        """
+        pages = {}
+
+        for name_path, page in zip(passages.name_path, passages.page):
+            pages.setdefault(name_path, set()).add(int(page))
+
+        return "".join(
+            f"`File name: {name_path} | Pages: {sorted(file_pages)}`\n"
+            for name_path, file_pages in pages.items()
+        )
+
+    def build(self, hits: pd.DataFrame) -> tuple[str, str]:
+        """
+        Build the context and the references from the retrieved chunks.
+
+        Args:
+            hits (pd.DataFrame): The retrieved chunks above the threshold, with a
+                'similarities' column.
+
+        Returns:
+            tuple[str, str]: The context and the references.
+        """
+        passages = self.pack(self.merge(hits))
+
+        if passages.empty:
+            return "null", "null"
+
+        context = self.separator.join(passages.content)
+        return context, self.format_references(passages)
@@ -0,0 +1,290 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import numpy as np
+from openai_api_connection.api_conection import get_embedding
+
+
+class EmbeddingCache:
+    """
+    A two-level cache for embeddings, keyed by the normalized text and the engine.
+
+    The first level is a bounded in-process LRU, the second level is a SQLite file
+    that persists between runs. Both levels evict the least recently used entries
+    when they are full. The instance is thread safe and can be shared between the
+    vectorstore builds and the chat searches.
+
+    The SQLite level keeps a running count of its rows instead of counting them on
+    every put, evicts `evict_batch` rows at a time when it is full, and writes the
+    access times of the disk hits in batches of `access_batch`. The embeddings are
+    kept as read-only float32 arrays in memory and as float32 blobs on disk, the
+    float64 blobs of older files are still read.
+    Usage:
+    cache = EmbeddingCache(get_file_full_path("embedding_cache.sqlite"))
+    embedding = cache.get_embedding(text, engine="testCX_2")
+
+    Args:
+        path (str, optional): The SQLite file of the persistent level. If None, only
+            the in-memory level is used. Default is None.
+        max_memory_items (int, optional): Maximum entries in memory. Default is 1024.
+        max_disk_items (int, optional): Maximum entries in the SQLite file.
+            Default is 200000.
+        evict_batch (int, optional): The extra entries removed when the SQLite file
+            is full. Default is 1000.
+        access_batch (int, optional): The disk hits whose access time is kept in
+            memory before it is written. Default is 256.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        max_memory_items: int = 1024,
+        max_disk_items: int = 200_000,
+        evict_batch: int = 1000,
+        access_batch: int = 256,
+    ):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.evict_batch = evict_batch
+        self.access_batch = access_batch
+        self.memory = OrderedDict()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__connection = None
+        self.__disk_items = 0
+        self.__pending_access = {}
+
+        if path is not None:
+            self.__connection = self.__connect_sqlite(path)
+            # counted once, then kept up to date by the puts and the evictions
+            self.__disk_items = self.__connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+
+    @staticmethod
+    def __connect_sqlite(path: str) -> sqlite3.Connection:
+        """
+        Open the SQLite file and create the embeddings table if it does not exist.
+        """
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, engine TEXT, embedding BLOB, last_access REAL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)"
+        )
+        columns = [
+            row[1] for row in connection.execute("PRAGMA table_info(embeddings)")
+        ]
+
+        if "dtype" not in columns:
+            # the files written before the float32 blobs have float64 ones
+            connection.execute(
+                "ALTER TABLE embeddings ADD COLUMN dtype TEXT DEFAULT 'float64'"
+            )
+
+        connection.commit()
+        logging.info(f"Embedding cache opened in {path}")
+        return connection
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        Normalize a text the same way before embedding and before building the key.
+
+        Line breaks and repeated whitespace are collapsed in a single space.
+        """
+        return re.sub(r"\s+", " ", text).strip()
+
+    @classmethod
+    def make_key(cls, text: str, engine: str) -> str:
+        """
+        Build the cache key of a text for an engine.
+        """
+        normalized = cls.normalize_text(text)
+        return hashlib.sha256(f"{engine}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters of the cache.
+
+        Returns:
+            dict: The hits by level, the misses, the hit rate and the sizes.
+        """
+        with self.__lock:
+            requests = self.hits_memory + self.hits_disk + self.misses
+            hits = self.hits_memory + self.hits_disk
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": hits / requests if requests else 0.0,
+                "memory_items": len(self.memory),
+                "disk_items": self.__disk_items,
+            }
+
+    def __flush_access(self):
+        """
+        Write the pending access times of the disk hits.
+        """
+        if self.__connection is None or not self.__pending_access:
+            return
+
+        self.__connection.executemany(
+            "UPDATE embeddings SET last_access = ? WHERE key = ?",
+            [(last_access, key) for key, last_access in self.__pending_access.items()],
+        )
+        self.__connection.commit()
+        self.__pending_access.clear()
+
+    def __put_memory(self, key: str, embedding: np.ndarray):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def __get_disk(self, key: str):
+        if self.__connection is None:
+            return None
+
+        row = self.__connection.execute(
+            "SELECT embedding, dtype FROM embeddings WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        self.__pending_access[key] = time.time()
+
+        if len(self.__pending_access) >= self.access_batch:
+            self.__flush_access()
+
+        embedding = np.frombuffer(row[0], dtype=row[1]).astype(np.float32, copy=False)
+        embedding.setflags(write=False)
+        return embedding
+
+    def __put_disk(self, key: str, engine: str, embedding: np.ndarray):
+        if self.__connection is None:
+            return
+
+        blob = embedding.tobytes()
+        exists = self.__connection.execute(
+            "SELECT 1 FROM embeddings WHERE key = ?", (key,)
+        ).fetchone()
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO embeddings "
+            "(key, engine, embedding, last_access, dtype) VALUES (?, ?, ?, ?, ?)",
+            (key, engine, blob, time.time(), "float32"),
+        )
+        self.__pending_access.pop(key, None)
+        self.__disk_items += exists is None
+
+        if self.__disk_items > self.max_disk_items:
+            # the access order has to be on disk before choosing what to evict
+            self.__flush_access()
+            excess = self.__disk_items - self.max_disk_items + self.evict_batch
+            deleted = self.__connection.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                (excess,),
+            ).rowcount
+            self.__disk_items -= deleted
+            logging.info(f"{deleted} embeddings evicted from the cache")
+
+        self.__connection.commit()
+
+    def get(self, text: str, engine: str):
+        """
+        Look up the embedding of a text, first in memory and then on disk.
+
+        Args:
+            text (str): The text that was embedded.
+            engine (str): The name of the embedding deployment.
+
+        Returns:
+            np.ndarray | None: The read-only float32 embedding, or None if it is not
+                cached.
+        """
+        key = self.make_key(text, engine)
+
+        with self.__lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return self.memory[key]
+
+            embedding = self.__get_disk(key)
+
+            if embedding is None:
+                self.misses += 1
+                return None
+
+            self.hits_disk += 1
+            self.__put_memory(key, embedding)
+            return embedding
+
+    def put(self, text: str, engine: str, embedding: list):
+        """
+        Store the embedding of a text in both levels.
+
+        Args:
+            text (str): The text that was embedded.
+            engine (str): The name of the embedding deployment.
+            embedding (list): The embedding of the text.
+        """
+        key = self.make_key(text, engine)
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+
+        with self.__lock:
+            self.__put_memory(key, embedding)
+            self.__put_disk(key, engine, embedding)
+
+    def get_embedding(
+        self,
+        text: str,
+        engine: str = "testCX_2",
+        embedding_function: Callable = get_embedding,
+    ) -> list:
+        """
+        Get the embedding of a text from the cache, requesting it on a miss.
+
+        Args:
+            text (str): The text to embed.
+            engine (str, optional): The name of the embedding deployment.
+                Default is "testCX_2".
+            embedding_function (Callable, optional): The function called on a miss
+                as embedding_function(text, engine=engine). Default is get_embedding.
+
+        Returns:
+            list | np.ndarray: The embedding of the text, a float32 array when it
+                comes from the cache.
+        """
+        embedding = self.get(text, engine)
+
+        if embedding is None:
+            embedding = embedding_function(self.normalize_text(text), engine=engine)
+            self.put(text, engine, embedding)
+
+        return embedding
+
+    def close(self):
+        """
+        Close the SQLite file.
+        """
+        with self.__lock:
+            if self.__connection is not None:
+                self.__flush_access()
+                self.__connection.close()
+                self.__connection = None
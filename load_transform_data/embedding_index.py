@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+import logging
+
+
+class EmbeddingIndex:
+    """
+    A dense index over the embeddings column of a vectorstore.
+
+    The embeddings are stacked once in a contiguous float32 matrix whose rows are
+    L2-normalized, so the cosine similarity between a query and every row is a
+    single matrix-vector product.
+    Usage:
+    index = EmbeddingIndex(df)
+    positions, scores = index.search(embedding, top_n=5)
+
+    Args:
+        df (pd.DataFrame): The vectorstore containing the embeddings.
+        column (str, optional): The name of the embeddings column. Default is "ada_v2".
+        matrix (np.ndarray, optional): The embeddings of `df` already normalized, for
+            example a memory-mapped store. It is used as is, without copying, and `df`
+            does not need the embeddings column. Default is None.
+    """
+
+    def __init__(
+        self, df: pd.DataFrame, column: str = "ada_v2", matrix: np.ndarray = None
+    ):
+        self.df = df
+        self.column = column
+        self.matrix = self.__build_matrix() if matrix is None else matrix
+        logging.info(f"Embedding index built with shape {self.matrix.shape}")
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def __build_matrix(self) -> np.ndarray:
+        """
+        Stack the embeddings column in a normalized float32 matrix.
+
+        Returns:
+            np.ndarray: C-contiguous matrix with one normalized embedding per row.
+        """
+        if self.df.empty:
+            return np.empty((0, 0), dtype=np.float32)
+
+        matrix = np.vstack(self.df[self.column].values).astype(np.float32)
+        return np.ascontiguousarray(self.normalize(matrix))
+
+    @staticmethod
+    def normalize(matrix: np.ndarray) -> np.ndarray:
+        """
+        L2-normalize the rows of a matrix (or a single vector).
+
+        Rows with norm 0 are left as zeros, so their similarity is 0.
+
+        Args:
+            matrix (np.ndarray): A 1-d vector or a 2-d matrix of row vectors.
+
+        Returns:
+            np.ndarray: The normalized float32 array, same shape as the input.
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    @staticmethod
+    def top_k(scores: np.ndarray, top_n: int) -> np.ndarray:
+        """
+        Select the positions of the `top_n` highest scores, sorted descending.
+
+        Uses `argpartition` so only the selected scores are sorted.
+
+        Args:
+            scores (np.ndarray): 1-d array of scores.
+            top_n (int): The number of positions to select.
+
+        Returns:
+            np.ndarray: The selected positions, highest score first.
+        """
+        top_n = min(top_n, scores.shape[0])
+
+        if top_n <= 0:
+            return np.empty(0, dtype=np.int64)
+
+        if top_n < scores.shape[0]:
+            positions = np.argpartition(-scores, top_n - 1)[:top_n]
+        else:
+            positions = np.arange(scores.shape[0])
+
+        # sort the shortlist by score, ties broken by position
+        order = np.lexsort((positions, -scores[positions]))
+        return positions[order]
+
+    def search(self, embedding: list, top_n: int = 3) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows with the highest cosine similarity to a query embedding.
+
+        Args:
+            embedding (list): The query embedding.
+            top_n (int, optional): The number of rows to retrieve. Default is 3.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions in the vectorstore and
+                their cosine similarities, highest first.
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        query = self.normalize(embedding)
+        scores = self.matrix @ query
+        positions = self.top_k(scores, top_n)
+        return positions, scores[positions]
+
+    def search_batch(
+        self, embeddings: np.ndarray, top_n: int = 3, block_size: int = 16384
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows with the highest cosine similarity to many query embeddings.
+
+        The queries are scored together with one matrix product per block of
+        `block_size` rows, and the top-k of every query is merged block by block, so
+        the temporary memory is bounded by the number of queries times `block_size`.
+
+        Args:
+            embeddings (np.ndarray): The query embeddings, one per row.
+            top_n (int, optional): The number of rows to retrieve per query.
+                Default is 3.
+            block_size (int, optional): The rows scored at a time. Default is 16384.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions and cosine similarities
+                of every query, one row per query, highest first.
+        """
+        queries = self.normalize(np.atleast_2d(embeddings))
+        top_n = max(0, min(top_n, len(self)))
+        positions = np.empty((queries.shape[0], 0), dtype=np.int64)
+        scores = np.empty((queries.shape[0], 0), dtype=np.float32)
+
+        if top_n == 0:
+            return positions, scores
+
+        for start in range(0, len(self), block_size):
+            block_scores = (
+                queries @ np.asarray(self.matrix[start : start + block_size]).T
+            )
+            block_positions = np.arange(start, start + block_scores.shape[1])
+            block_positions = np.broadcast_to(block_positions, block_scores.shape)
+            scores = np.hstack([scores, block_scores])
+            positions = np.hstack([positions, block_positions])
+
+            if scores.shape[1] > top_n:
+                best = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+                scores = np.take_along_axis(scores, best, axis=1)
+                positions = np.take_along_axis(positions, best, axis=1)
+
+        # sort every query by score, ties broken by position as in top_k
+        order = np.lexsort((positions, -scores), axis=1)
+        return (
+            np.take_along_axis(positions, order, axis=1),
+            np.take_along_axis(scores, order, axis=1),
+        )
+
+    def score(self, embedding: list, positions: np.ndarray) -> np.ndarray:
+        """
+        Get the cosine similarity of some rows to a query embedding.
+
+        Only the given rows are read, which is cheaper than a full search when they
+        are few.
+
+        Args:
+            embedding (list): The query embedding.
+            positions (np.ndarray): The rows to score, ideally sorted.
+
+        Returns:
+            np.ndarray: The cosine similarity of each row.
+        """
+        query = self.normalize(embedding)
+        return np.asarray(self.matrix[positions]) @ query
@@ -0,0 +1,316 @@
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.mmap_store import get_mmap_store_paths, load_mmap_store
+
+IVF_SUFFIX = ".ivf.npz"
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    An approximate nearest-neighbour index with inverted lists (IVF).
+
+    The normalized embeddings are clustered with spherical k-means, and every row is
+    stored in the list of its nearest centroid. A query only scores the rows of the
+    `nprobe` lists whose centroids are the most similar to it, so a bigger `nprobe`
+    gives a better recall and a slower search.
+    Usage:
+    index = IVFIndex(df, n_lists=64, nprobe=8)
+    positions, scores = index.search(embedding, top_n=5)
+    index.save("data/vectorstore")
+
+    Args:
+        df (pd.DataFrame): The vectorstore containing the embeddings.
+        column (str, optional): The name of the embeddings column. Default is "ada_v2".
+        matrix (np.ndarray, optional): The embeddings of `df` already normalized.
+            Default is None.
+        n_lists (int, optional): The number of clusters. Default is the square root
+            of the number of rows.
+        nprobe (int, optional): The number of lists scanned per query. Default is 8.
+        n_iter (int, optional): The iterations of k-means. Default is 20.
+        seed (int, optional): The seed of the k-means initialization. Default is 0.
+        centroids (np.ndarray, optional): Trained centroids, to skip the training.
+            Default is None.
+        assignments (np.ndarray, optional): The list of every row for `centroids`.
+            Default is None.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        column: str = "ada_v2",
+        matrix: np.ndarray = None,
+        n_lists: int = None,
+        nprobe: int = 8,
+        n_iter: int = 20,
+        seed: int = 0,
+        centroids: np.ndarray = None,
+        assignments: np.ndarray = None,
+    ):
+        super().__init__(df, column=column, matrix=matrix)
+        self.nprobe = nprobe
+
+        if centroids is None:
+            if n_lists is None:
+                n_lists = int(np.sqrt(len(self)))
+
+            n_lists = max(1, min(n_lists, len(self)))
+            centroids, assignments = self.__train(n_lists, n_iter, seed)
+
+        self.centroids = centroids
+        self.__build_lists(assignments)
+        logging.info(f"IVF index built with {len(self.centroids)} lists")
+
+    def __assign(self, centroids: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """
+        Get the nearest centroid of every row, scanning the matrix by blocks.
+        """
+        assignments = np.empty(len(self), dtype=np.int64)
+
+        for start in range(0, len(self), block_size):
+            block = self.matrix[start : start + block_size]
+            assignments[start : start + block_size] = np.argmax(
+                block @ centroids.T, axis=1
+            )
+
+        return assignments
+
+    def __sum_lists(
+        self, assignments: np.ndarray, n_lists: int, block_size: int = 65536
+    ) -> np.ndarray:
+        """
+        Sum the rows of every list, as a sparse one-hot product by blocks.
+        """
+        sums = np.zeros((n_lists, self.matrix.shape[1]), dtype=np.float32)
+
+        for start in range(0, len(self), block_size):
+            block = self.matrix[start : start + block_size]
+            one_hot = sp.csr_matrix(
+                (
+                    np.ones(len(block), dtype=np.float32),
+                    (assignments[start : start + block_size], np.arange(len(block))),
+                ),
+                shape=(n_lists, len(block)),
+            )
+            sums += one_hot @ np.asarray(block, dtype=np.float32)
+
+        return sums
+
+    def __train(self, n_lists: int, n_iter: int, seed: int) -> tuple:
+        """
+        Cluster the rows with spherical k-means.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The normalized centroids and the list of
+                every row.
+        """
+        rng = np.random.default_rng(seed)
+        centroids = np.array(self.matrix[rng.choice(len(self), n_lists, replace=False)])
+        assignments = self.__assign(centroids)
+
+        for _ in range(n_iter):
+            sums = self.__sum_lists(assignments, n_lists)
+            counts = np.bincount(assignments, minlength=n_lists)
+            empty = counts == 0
+
+            # the empty clusters restart from random rows
+            sums[empty] = self.matrix[rng.choice(len(self), int(empty.sum()))]
+            centroids = self.normalize(sums)
+            new_assignments = self.__assign(centroids)
+
+            if np.array_equal(new_assignments, assignments):
+                break
+
+            assignments = new_assignments
+
+        return centroids, assignments
+
+    def __build_lists(self, assignments: np.ndarray):
+        """
+        Store the rows grouped by list, with the offsets of every list.
+        """
+        self.assignments = assignments
+        self.list_rows = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def search(
+        self, embedding: list, top_n: int = 3, nprobe: int = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows with the highest cosine similarity in the nearest lists.
+
+        Args:
+            embedding (list): The query embedding.
+            top_n (int, optional): The number of rows to retrieve. Default is 3.
+            nprobe (int, optional): The lists scanned, overrides the index value.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions in the vectorstore and
+                their cosine similarities, highest first.
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        query = self.normalize(embedding)
+        lists = self.top_k(self.centroids @ query, nprobe)
+        candidates = np.concatenate(
+            [
+                self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]]
+                for i in lists
+            ]
+        )
+        # scan the candidates in storage order, it is faster on a mapped matrix
+        candidates.sort()
+        scores = self.matrix[candidates] @ query
+        best = self.top_k(scores, top_n)
+        return candidates[best], scores[best]
+
+    def search_batch(
+        self, embeddings: np.ndarray, top_n: int = 3, nprobe: int = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search every query in its nearest lists, one query at a time.
+
+        A query whose `nprobe` lists hold fewer than `top_n` rows is searched in all
+        the lists, so every query gets the same number of rows.
+
+        Args:
+            embeddings (np.ndarray): The query embeddings, one per row.
+            top_n (int, optional): The number of rows to retrieve per query.
+                Default is 3.
+            nprobe (int, optional): The lists scanned, overrides the index value.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions and cosine similarities
+                of every query, one row per query, highest first.
+        """
+        top_n = max(0, min(top_n, len(self)))
+        positions = []
+        scores = []
+
+        for embedding in np.atleast_2d(embeddings):
+            result = self.search(embedding, top_n, nprobe=nprobe)
+
+            if len(result[0]) < top_n:
+                result = self.search(embedding, top_n, nprobe=len(self.centroids))
+
+            positions.append(result[0])
+            scores.append(result[1])
+
+        shape = (len(positions), top_n)
+        return (
+            np.array(positions, dtype=np.int64).reshape(shape),
+            np.array(scores, dtype=np.float32).reshape(shape),
+        )
+
+    def save(self, path: str):
+        """
+        Save the lists next to the vectorstore, in `path` + ".ivf.npz".
+
+        Args:
+            path (str): The path of the store without extension.
+        """
+        np.savez(
+            path + IVF_SUFFIX,
+            centroids=self.centroids,
+            assignments=self.assignments,
+            nprobe=self.nprobe,
+        )
+        logging.info(f"IVF index saved in {path + IVF_SUFFIX}")
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        df: pd.DataFrame,
+        column: str = "ada_v2",
+        matrix: np.ndarray = None,
+        nprobe: int = None,
+    ) -> "IVFIndex":
+        """
+        Load the lists saved with `save` for the same vectorstore.
+
+        Args:
+            path (str): The path of the store without extension.
+            df (pd.DataFrame): The vectorstore the lists were built from.
+            column (str, optional): The name of the embeddings column.
+            matrix (np.ndarray, optional): The normalized embeddings of `df`.
+            nprobe (int, optional): The lists scanned per query. Default is the
+                saved value.
+
+        Returns:
+            IVFIndex: The index.
+        """
+        with np.load(path + IVF_SUFFIX) as data:
+            if len(data["assignments"]) != len(df):
+                raise ValueError(
+                    f"The IVF index in {path} was built for other vectorstore"
+                )
+
+            return cls(
+                df,
+                column=column,
+                matrix=matrix,
+                nprobe=int(data["nprobe"]) if nprobe is None else nprobe,
+                centroids=data["centroids"],
+                assignments=data["assignments"],
+            )
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """
+        Check if there are saved lists for the store in `path`.
+        """
+        return os.path.exists(path + IVF_SUFFIX)
+
+    @staticmethod
+    def is_outdated(path: str) -> bool:
+        """
+        Check if the saved lists are older than the embeddings of the store.
+        """
+        embeddings_path, _ = get_mmap_store_paths(path)
+
+        if not os.path.exists(embeddings_path):
+            return False
+
+        return os.path.getmtime(path + IVF_SUFFIX) < os.path.getmtime(embeddings_path)
+
+    @classmethod
+    def rebuild(cls, path: str):
+        """
+        Train the saved lists again on the current store, with the same number of
+        lists and nprobe. The file is removed if the store is empty.
+
+        Args:
+            path (str): The path of the store without extension.
+        """
+        with np.load(path + IVF_SUFFIX) as data:
+            n_lists = len(data["centroids"])
+            nprobe = int(data["nprobe"])
+
+        df, matrix = load_mmap_store(path)
+
+        if len(df) == 0:
+            os.remove(path + IVF_SUFFIX)
+            logging.info(f"IVF index removed from {path}, the store is empty")
+            return
+
+        cls(df, matrix=matrix, n_lists=n_lists, nprobe=nprobe).save(path)
+
+
+if __name__ == "__main__":
+    # python -m load_transform_data.ivf_index data/vectorstore [n_lists] [nprobe]
+    logging.basicConfig(level=logging.INFO)
+    store_path = sys.argv[1]
+    df, matrix = load_mmap_store(store_path)
+    n_lists = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    nprobe = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    IVFIndex(df, matrix=matrix, n_lists=n_lists, nprobe=nprobe).save(store_path)
@@ -4,11 +4,16 @@ from azure.storage.blob import (
     ContainerClient,
     StorageStreamDownloader,
 )
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator
 import os
 import io
+import time
 import pypdf
-import re
 import logging
+from load_transform_data.text_normalizer import default_normalizer
+from load_transform_data.metrics import metrics
 
 
 class AzureBlobStorageDocumentLoader:
@@ -24,6 +29,11 @@ class AzureBlobStorageDocumentLoader:
         container_name (str, optional): the name of the azure blob container
         prefix (str, optional): the beginning of the path where you want to search and load the files
             Defaults to 'EMBEDDINGS_TEST/ai_papers_segmented'
+        download_workers (int, optional): the threads downloading blobs at the same time
+            Defaults to 8
+        extraction_workers (int, optional): the processes extracting and cleaning the
+            text of the PDFs, None uses one per CPU
+            Defaults to None
     """
 
     def __init__(
@@ -32,11 +42,15 @@ class AzureBlobStorageDocumentLoader:
         account_name: str = "westdraid001",
         container_name: str = "tests-gpt-neoris",
         prefix: str = "EMBEDDINGS_TEST/langchain",
+        download_workers: int = 8,
+        extraction_workers: int = None,
     ):
         self.account_name = account_name
         self.account_key = account_key
         self.container_name = container_name
         self.prefix = prefix
+        self.download_workers = download_workers
+        self.extraction_workers = extraction_workers
 
     def __connect_blob_storage(self) -> ContainerClient:
         """
@@ -110,11 +124,11 @@ class AzureBlobStorageDocumentLoader:
         self, blob_container: ContainerClient, ext=None
     ) -> list:
         """
-        Create a list of file paths for blobs in Azure Blob Storage.
+        Create a list of blobs in Azure Blob Storage.
 
-        This function generates a list of file paths for blobs located in the specified
-        `blob_container` and starting with the given `init_path`. You can optionally
-        provide a list of file extensions to filter the results.
+        This function generates a list of the properties of the blobs located in the
+        specified `blob_container` and starting with the given `init_path`. You can
+        optionally provide a list of file extensions to filter the results.
 
         Parameters
         ----------
@@ -128,66 +142,175 @@ class AzureBlobStorageDocumentLoader:
         Returns
         -------
         list
-            A list of file paths for blobs matching the given criteria.
+            A list of azure.storage.blob.BlobProperties for the blobs matching the
+            given criteria.
         """
 
         if ext is None:
             ext = [".pdf"]
 
         blob_path_files = blob_container.list_blobs(name_starts_with=self.prefix)
-        path_files = [
-            blob.name
-            for blob in blob_path_files
-            if os.path.splitext(blob.name)[-1] in ext
+        blobs = [
+            blob for blob in blob_path_files if os.path.splitext(blob.name)[-1] in ext
         ]
-        return path_files
+        return blobs
 
-    def __generate_pandas_dataframe_from_blob(
-        self, list_path_blobs: list, blob_container_: ContainerClient
-    ) -> pd.DataFrame:
+    @staticmethod
+    def get_blob_version(blob) -> str:
+        """
+        Get a string that changes every time the content of a blob changes.
+
+        The MD5 of the content is used when the storage provides it, otherwise the
+        ETag of the blob.
+
+        Parameters
+        ----------
+        blob : azure.storage.blob.BlobProperties
+            The properties of the blob.
+
+        Returns
+        -------
+        str
+            The version of the blob.
         """
-        Generate a pandas DataFrame from PDFs stored as blobs in Azure Blob Storage.
+        content_md5 = blob.content_settings.content_md5
 
-        This function reads PDFs stored as blobs in the specified `blob_container_` and
-        extracts information such as the file path, page number, and content. It then
-        creates a pandas DataFrame containing this information.
+        if content_md5:
+            return "md5:" + bytes(content_md5).hex()
+
+        return "etag:" + blob.etag.strip('"')
+
+    def list_blobs(self) -> pd.DataFrame:
+        """
+        List the PDF blobs under the prefix with their versions.
+
+        Parameters
+        ----------
+        self
+
+        Returns
+        -------
+        pd.DataFrame
+            A pandas DataFrame with the columns 'name_path', 'index_document' and
+            'blob_version', one row per blob sorted by name.
+        """
+        blob_container = self.__connect_blob_storage()
+        blobs = sorted(
+            self.__create_list_path_blobs(blob_container), key=lambda blob: blob.name
+        )
+        return pd.DataFrame(
+            {
+                "name_path": [blob.name for blob in blobs],
+                "index_document": list(range(len(blobs))),
+                "blob_version": [self.get_blob_version(blob) for blob in blobs],
+            }
+        )
+
+    def __download_blob(self, blob_container_: ContainerClient, path: str) -> bytes:
+        """
+        Download the whole content of a blob.
 
         Parameters
         ----------
         self
-        list_path_blobs : list
-            A list of file paths for the PDF blobs to be processed.
         blob_container_ : azure.storage.blob.ContainerClient
             A container client instance pointing to the Azure Blob Storage container.
+        path : str
+            The name of the blob.
 
         Returns
         -------
+        bytes
+            The content of the blob.
+        """
+        with metrics.span("download"):
+            return self.__retrieve_file_from_blob_storage(
+                blob_container_, path
+            ).readall()
+
+    def __iter_dataframes_from_blob(
+        self, blobs: pd.DataFrame, blob_container_: ContainerClient, max_pending: int
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Generate one pandas DataFrame per PDF stored as a blob in Azure Blob Storage.
+
+        The blobs are downloaded by a pool of threads, and every downloaded PDF is sent
+        to a pool of processes that extracts and cleans the text of its pages, so the
+        downloads and the extractions run at the same time. The parsed PDFs only live
+        in the worker processes. At most `max_pending` blobs are in flight, so the
+        loader does not get ahead of a slow consumer.
+
+        Parameters
+        ----------
+        self
+        blobs : pd.DataFrame
+            The PDF blobs to be processed, as returned by `list_blobs`.
+        blob_container_ : azure.storage.blob.ContainerClient
+            A container client instance pointing to the Azure Blob Storage container.
+        max_pending : int
+            The maximum number of blobs downloaded or extracted ahead of the consumer.
+
+        Yields
+        ------
         pd.DataFrame
-            A pandas DataFrame containing information about PDFs, including their file
-            paths, page numbers, and extracted content.
-        """
-        list_pdfs = []
-        list_name_path = []
-        list_page = []
-        list_content = []
-        list_index_document = []
-
-        for i, path in enumerate(list_path_blobs):
-            pdf_binary = self.__retrieve_file_from_blob_storage(blob_container_, path)
-            stream = io.BytesIO()
-            pdf_binary.readinto(stream)
-            pdf = pypdf.PdfReader(stream, strict=True)
-            list_pdfs.append((i, pdf))
-
-            # enumerate each page of each file
-            for j, page in enumerate(pdf.pages):
-                list_name_path.append(path)
-                list_page.append(j)
-                list_content.append(page.extract_text())
-                list_index_document.append(i)
-
-        columns_name = ["name_path", "index_document", "page", "content"]
-        columns_data = [list_name_path, list_index_document, list_page, list_content]
+            The pages of one PDF, with its file path, page numbers, version and
+            cleaned content, in the order of `blobs`.
+        """
+        rows = blobs[["name_path", "index_document", "blob_version"]].itertuples(
+            index=False
+        )
+        pending = deque()
+
+        with ThreadPoolExecutor(
+            self.download_workers
+        ) as downloads, ProcessPoolExecutor(self.extraction_workers) as extractions:
+
+            def download_and_extract(path: str):
+                pdf_bytes = self.__download_blob(blob_container_, path)
+                logging.info(f"{path} downloaded")
+                return extractions.submit(timed_extract_pdf_pages, pdf_bytes)
+
+            for row in rows:
+                pending.append(
+                    (row, downloads.submit(download_and_extract, row.name_path))
+                )
+
+                if len(pending) >= max_pending:
+                    yield self.__pages_dataframe(*self.__pop_pages(pending))
+
+            while pending:
+                yield self.__pages_dataframe(*self.__pop_pages(pending))
+
+    @staticmethod
+    def __pop_pages(pending: deque) -> tuple:
+        """
+        Wait for the oldest blob in flight and get its row and the text of its pages.
+        """
+        row, future = pending.popleft()
+        pages, seconds = future.result().result()
+        # timed in the worker process, its own metrics are not collected
+        metrics.observe("extraction", seconds)
+        return row, pages
+
+    @staticmethod
+    def __pages_dataframe(row: tuple, pages: list) -> pd.DataFrame:
+        """
+        Create the pandas DataFrame with one row per page of a PDF.
+        """
+        columns_name = [
+            "name_path",
+            "index_document",
+            "page",
+            "content",
+            "blob_version",
+        ]
+        columns_data = [
+            [row.name_path] * len(pages),
+            [row.index_document] * len(pages),
+            list(range(len(pages))),
+            pages,
+            [row.blob_version] * len(pages),
+        ]
         dict_pdf_info = dict(zip(columns_name, columns_data))
         return pd.DataFrame(dict_pdf_info)
 
@@ -208,18 +331,14 @@ class AzureBlobStorageDocumentLoader:
         -------
         str
             The cleaned text with line breaks, strange symbols, and double spaces removed.
+
+        See Also
+        --------
+        TextNormalizer : the compiled implementation, with a bulk API.
         """
-        x = re.sub(r"[\r\n\t]+|[^a-zA-Z0-9\s.,!?_(){}\[\]+=\-/*]+| {2,}", "", x)
-        x = re.sub(r"\s+", " ", x).strip()
-        x = re.sub(r". ,", "", x)
-        # remove all instances of multiple spaces
-        x = x.replace("..", ".")
-        x = x.replace(". .", ".")
-        x = x.replace("\n", "")
-        x = x.strip()
-        return x
+        return default_normalizer.clean(x)
 
-    def load_document(self) -> pd.DataFrame:
+    def load_document(self, blobs: pd.DataFrame = None) -> pd.DataFrame:
         """
         Create a pandas DataFrame with cleaned content from documents stored as blobs.
 
@@ -230,14 +349,98 @@ class AzureBlobStorageDocumentLoader:
         Parameters
         ----------
         self
+        blobs : pd.DataFrame, optional
+            The blobs to load, as returned by `list_blobs`. If not provided, all the
+            PDF blobs under the prefix are loaded.
 
         Returns
         -------
         pd.DataFrame
             A pandas DataFrame containing information about documents, including their
-            file paths, page numbers, and cleaned content."""
+            file paths, page numbers, versions and cleaned content."""
+        columns_name = [
+            "name_path",
+            "index_document",
+            "page",
+            "content",
+            "blob_version",
+        ]
+        dataframes = list(self.iter_documents(blobs))
+
+        if not dataframes:
+            return pd.DataFrame({col: [] for col in columns_name})
+
+        return pd.concat(dataframes, ignore_index=True)
+
+    def iter_documents(
+        self, blobs: pd.DataFrame = None, max_pending: int = None
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Stream the cleaned content of the documents stored as blobs, one PDF at a time.
+
+        Only the PDFs in flight are held in memory, the next blobs are downloaded when
+        the consumer asks for more documents.
+
+        Parameters
+        ----------
+        self
+        blobs : pd.DataFrame, optional
+            The blobs to load, as returned by `list_blobs`. If not provided, all the
+            PDF blobs under the prefix are loaded.
+        max_pending : int, optional
+            The maximum number of blobs downloaded or extracted ahead of the consumer.
+            If not provided, twice the number of download workers.
+
+        Yields
+        ------
+        pd.DataFrame
+            The pages of one PDF, with the same columns as `load_document`.
+        """
+        if blobs is None:
+            blobs = self.list_blobs()
+
+        if max_pending is None:
+            max_pending = 2 * self.download_workers
+
         blob_container = self.__connect_blob_storage()
-        path_blobs = self.__create_list_path_blobs(blob_container)
-        df = self.__generate_pandas_dataframe_from_blob(path_blobs, blob_container)
-        df["content"] = df.content.apply(lambda x: self.clean_content(x))
-        return df
+        yield from self.__iter_dataframes_from_blob(blobs, blob_container, max_pending)
+
+
+def extract_pdf_pages(pdf_bytes: bytes) -> list:
+    """
+    Extract and clean the text of every page of a PDF.
+
+    This function is run in the extraction worker processes, the parsed PDF is
+    discarded as soon as its text is extracted.
+
+    Parameters
+    ----------
+    pdf_bytes : bytes
+        The content of the PDF file.
+
+    Returns
+    -------
+    list
+        The cleaned text of each page, in page order.
+    """
+    pdf = pypdf.PdfReader(io.BytesIO(pdf_bytes), strict=True)
+    return default_normalizer.clean_many(page.extract_text() for page in pdf.pages)
+
+
+def timed_extract_pdf_pages(pdf_bytes: bytes) -> tuple[list, float]:
+    """
+    Run extract_pdf_pages and measure it, for the metrics of the main process.
+
+    Parameters
+    ----------
+    pdf_bytes : bytes
+        The content of the PDF file.
+
+    Returns
+    -------
+    tuple[list, float]
+        The cleaned text of each page and the seconds of the extraction.
+    """
+    start = time.perf_counter()
+    pages = extract_pdf_pages(pdf_bytes)
+    return pages, time.perf_counter() - start
@@ -0,0 +1,263 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# seconds, from a fast vector search to a long completion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """
+    The cumulative counts of the observed durations of a stage.
+
+    Args:
+        buckets (tuple): The upper bounds of the buckets, in seconds.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = np.zeros(len(self.buckets), dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[np.searchsorted(self.buckets, seconds) :] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(map(str, self.buckets), self.counts.tolist())),
+        }
+
+
+class MetricsRegistry:
+    """
+    Aggregate the durations of the pipeline stages in histograms.
+
+    A stage is timed with the `span` context manager, or observed directly when it
+    is measured elsewhere (e.g. in a worker process). The histograms can be read as
+    Prometheus text, served on an HTTP port or dumped periodically as JSON. A stage
+    can also be profiled with cProfile or tracemalloc in a sample of its spans, the
+    profiles are written to `profile_dir`.
+    Usage:
+    with metrics.span("vector_search"):
+        positions, scores = index.search(embedding, top_n)
+    metrics.start_http_server(9100)
+
+    Args:
+        buckets (tuple, optional): The upper bounds of the buckets, in seconds.
+            Default is DEFAULT_BUCKETS.
+        profile_dir (str, optional): The folder of the profiles. Default is "profiles".
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS, profile_dir: str = "profiles"):
+        self.buckets = buckets
+        self.profile_dir = profile_dir
+        self.histograms = {}
+        self.profiling = {}
+        self.__lock = threading.Lock()
+        # cProfile and tracemalloc are process-wide, one profiled span at a time
+        self.__profile_lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Add a duration to the histogram of a stage.
+        """
+        with self.__lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram(self.buckets)
+
+            self.histograms[stage].observe(seconds)
+
+    def enable_profiling(
+        self, stage: str, mode: str = "cprofile", sample_rate: float = 1.0
+    ):
+        """
+        Profile a sample of the spans of a stage.
+
+        Args:
+            stage (str): The name of the stage.
+            mode (str, optional): "cprofile" for the CPU time by function, or
+                "tracemalloc" for the memory allocated by line. Default is "cprofile".
+            sample_rate (float, optional): The fraction of the spans profiled.
+                Default is 1.0.
+        """
+        if mode not in ("cprofile", "tracemalloc"):
+            raise ValueError("mode has to be 'cprofile' or 'tracemalloc'")
+
+        self.profiling[stage] = (mode, sample_rate)
+
+    def disable_profiling(self, stage: str):
+        self.profiling.pop(stage, None)
+
+    def __profile_path(self, stage: str, extension: str) -> str:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return os.path.join(self.profile_dir, f"{stage}-{time.time_ns()}.{extension}")
+
+    @contextmanager
+    def __profile(self, stage: str):
+        """
+        Profile the span if the stage is sampled and no other span is profiled.
+        """
+        mode, sample_rate = self.profiling.get(stage, (None, 0))
+
+        if mode is None or random.random() >= sample_rate:
+            yield
+            return
+
+        if not self.__profile_lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            if mode == "cprofile":
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+                    profiler.dump_stats(self.__profile_path(stage, "prof"))
+            else:
+                started = not tracemalloc.is_tracing()
+
+                if started:
+                    tracemalloc.start()
+
+                before = tracemalloc.take_snapshot()
+
+                try:
+                    yield
+                finally:
+                    stats = tracemalloc.take_snapshot().compare_to(before, "lineno")
+
+                    if started:
+                        tracemalloc.stop()
+
+                    with open(self.__profile_path(stage, "txt"), "w") as file:
+                        file.write("\n".join(str(stat) for stat in stats[:50]))
+        finally:
+            self.__profile_lock.release()
+
+    @contextmanager
+    def span(self, stage: str):
+        """
+        Time the code in the block as a stage, also when it raises.
+
+        Args:
+            stage (str): The name of the stage.
+        """
+        start = time.perf_counter()
+
+        try:
+            with self.__profile(stage):
+                yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(stage, seconds)
+            logging.debug(f"{stage} took {seconds:.4f} seconds")
+
+    def to_dict(self) -> dict:
+        """
+        Get the histograms of every stage.
+        """
+        with self.__lock:
+            return {stage: h.to_dict() for stage, h in sorted(self.histograms.items())}
+
+    def to_prometheus(self, name: str = "pipeline_stage_seconds") -> str:
+        """
+        Get the histograms in the Prometheus text format, one label per stage.
+        """
+        lines = [
+            f"# HELP {name} Duration of the stages of the chat and build pipelines.",
+            f"# TYPE {name} histogram",
+        ]
+
+        for stage, histogram in self.to_dict().items():
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+
+            lines.append(
+                f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}'
+            )
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path: str):
+        """
+        Write the histograms to a JSON file, replacing it atomically.
+        """
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "w") as file:
+            json.dump({"time": time.time(), "stages": self.to_dict()}, file, indent=2)
+
+        os.replace(tmp_path, path)
+
+    def start_json_dump(self, path: str, interval: float = 60) -> threading.Thread:
+        """
+        Dump the histograms to a JSON file every `interval` seconds in a daemon thread.
+        """
+
+        def dump_forever():
+            while True:
+                time.sleep(interval)
+
+                try:
+                    self.dump_json(path)
+                except OSError:
+                    logging.exception(f"The metrics could not be written in {path}")
+
+        thread = threading.Thread(target=dump_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def start_http_server(
+        self, port: int = 9100, host: str = "127.0.0.1"
+    ) -> ThreadingHTTPServer:
+        """
+        Serve the Prometheus text on http://host:port/metrics in a daemon thread.
+
+        The default host only accepts local connections, pass "0.0.0.0" to let a
+        remote Prometheus scrape it.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Metrics served in http://{host}:{port}/metrics")
+        return server
+
+
+metrics = MetricsRegistry()
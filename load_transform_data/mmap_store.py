@@ -0,0 +1,196 @@
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from load_transform_data.embedding_index import EmbeddingIndex
+
+EMBEDDINGS_SUFFIX = ".embeddings.npy"
+METADATA_SUFFIX = ".metadata.parquet"
+
+
+def get_mmap_store_paths(path: str) -> tuple[str, str]:
+    """
+    Get the files of a memory-mapped vector store.
+
+    Parameters
+    ----------
+    path : str
+        The path of the store without extension, e.g. "data/vectorstore".
+
+    Returns
+    -------
+    tuple[str, str]
+        The path of the embeddings matrix and the path of the metadata file.
+    """
+    return path + EMBEDDINGS_SUFFIX, path + METADATA_SUFFIX
+
+
+def save_mmap_store(df: pd.DataFrame, path: str, column: str = "ada_v2") -> None:
+    """
+    Save a vector store as a memory-mappable embeddings matrix plus a metadata file.
+
+    The embeddings are stored normalized, as a single C-contiguous float32 `.npy`
+    matrix with one row per chunk, and the other columns in a parquet file with the
+    same row order.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The vector store with the embeddings in `column`.
+    path : str
+        The path of the store without extension, e.g. "data/vectorstore".
+    column : str, optional
+        The name of the embeddings column. Default is "ada_v2".
+    """
+    embeddings_path, metadata_path = get_mmap_store_paths(path)
+    matrix = EmbeddingIndex(df, column=column).matrix
+    np.save(embeddings_path, matrix)
+    df.drop(columns=[column]).to_parquet(metadata_path, index=False)
+    logging.info(f"Memory-mapped vectorstore saved in {embeddings_path}")
+
+
+def load_mmap_store(path: str) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Load the metadata of a memory-mapped vector store and map its embeddings.
+
+    The embeddings are not read in memory, the operating system pages them in when
+    they are scanned.
+
+    Parameters
+    ----------
+    path : str
+        The path of the store without extension, e.g. "data/vectorstore".
+
+    Returns
+    -------
+    tuple[pd.DataFrame, np.ndarray]
+        The metadata and the read-only memory-mapped matrix of normalized embeddings.
+    """
+    embeddings_path, metadata_path = get_mmap_store_paths(path)
+    matrix = np.load(embeddings_path, mmap_mode="r")
+    df = pd.read_parquet(metadata_path)
+
+    if matrix.shape[0] != df.shape[0]:
+        raise ValueError(
+            f"The store {path} is inconsistent: {matrix.shape[0]} embeddings "
+            f"and {df.shape[0]} rows of metadata"
+        )
+
+    return df, matrix
+
+
+def load_mmap_index(path: str) -> EmbeddingIndex:
+    """
+    Load a memory-mapped vector store as an EmbeddingIndex, without copying it.
+
+    Parameters
+    ----------
+    path : str
+        The path of the store without extension, e.g. "data/vectorstore".
+
+    Returns
+    -------
+    EmbeddingIndex
+        The index searching directly over the mapped matrix.
+    """
+    df, matrix = load_mmap_store(path)
+    return EmbeddingIndex(df, matrix=matrix)
+
+
+def convert_parquet_to_mmap_store(
+    parquet_path: str, path: str = None, column: str = "ada_v2", batch_size: int = 4096
+) -> str:
+    """
+    Convert a vector store saved as a single parquet file to the memory-mapped format.
+
+    The parquet file is read in batches of `batch_size` rows, the embeddings are
+    normalized into a preallocated memory-mapped `.npy` matrix and the other columns
+    are appended to the metadata file, so the whole store is never in memory.
+
+    Parameters
+    ----------
+    parquet_path : str
+        The parquet file with the embeddings in the 'ada_v2' column.
+    path : str, optional
+        The path of the new store without extension. Default is the parquet path
+        without its extension.
+    column : str, optional
+        The name of the embeddings column. Default is "ada_v2".
+    batch_size : int, optional
+        The rows converted at a time. Default is 4096.
+
+    Returns
+    -------
+    str
+        The path of the new store without extension.
+    """
+    if path is None:
+        path = os.path.splitext(parquet_path)[0]
+
+    parquet = pq.ParquetFile(parquet_path)
+    n_rows = parquet.metadata.num_rows
+
+    if n_rows == 0:
+        save_mmap_store(pd.read_parquet(parquet_path), path, column=column)
+        return path
+
+    embeddings_path, metadata_path = get_mmap_store_paths(path)
+    first = next(parquet.iter_batches(batch_size=1, columns=[column]))
+    dimension = len(first.column(column)[0])
+    matrix = np.lib.format.open_memmap(
+        embeddings_path, mode="w+", dtype=np.float32, shape=(n_rows, dimension)
+    )
+    columns = [name for name in parquet.schema_arrow.names if name != column]
+    writer = None
+    start = 0
+
+    try:
+        for batch in parquet.iter_batches(batch_size=batch_size):
+            embeddings = batch.column(column).flatten().to_numpy(zero_copy_only=False)
+            embeddings = embeddings.reshape(batch.num_rows, dimension)
+            matrix[start : start + batch.num_rows] = EmbeddingIndex.normalize(
+                embeddings
+            )
+            start += batch.num_rows
+            metadata = batch.select(columns)
+
+            if writer is None:
+                writer = pq.ParquetWriter(metadata_path, metadata.schema)
+
+            writer.write_batch(metadata)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    matrix.flush()
+    del matrix
+    logging.info(f"Memory-mapped vectorstore saved in {embeddings_path}")
+    return path
+
+
+def is_mmap_store_outdated(parquet_path: str, path: str) -> bool:
+    """
+    Check if the memory-mapped store is missing or older than the parquet file.
+    """
+    embeddings_path, metadata_path = get_mmap_store_paths(path)
+
+    if not (os.path.exists(embeddings_path) and os.path.exists(metadata_path)):
+        return True
+
+    if not os.path.exists(parquet_path):
+        return False
+
+    parquet_time = os.path.getmtime(parquet_path)
+    return min(os.path.getmtime(embeddings_path), os.path.getmtime(metadata_path)) < (
+        parquet_time
+    )
+
+
+if __name__ == "__main__":
+    # python -m load_transform_data.mmap_store data/vectorstore.parquet
+    logging.basicConfig(level=logging.INFO)
+    convert_parquet_to_mmap_store(*sys.argv[1:3])
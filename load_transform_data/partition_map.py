@@ -0,0 +1,149 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from load_transform_data.utils import get_store_fingerprint
+
+
+class SearchFilter:
+    """
+    The rows a search is restricted to, by document and page range.
+
+    Args:
+        name_paths (list, optional): The paths of the PDFs. Default is None, any.
+        index_documents (list, optional): The numbers of the PDFs. Default is None,
+            any.
+        pages (tuple[int, int], optional): The first and last page, both included.
+            Default is None, any.
+    """
+
+    def __init__(
+        self,
+        name_paths: list = None,
+        index_documents: list = None,
+        pages: tuple[int, int] = None,
+    ):
+        self.name_paths = name_paths
+        self.index_documents = index_documents
+        self.pages = pages
+
+
+class PartitionMap:
+    """
+    The row ranges of every document of a vectorstore, to search only some of them.
+
+    The rows of a document are contiguous in the vectorstore, so every `name_path`
+    and `index_document` is mapped to the ranges of rows where it is stored (a
+    single range, unless the store was assembled in pieces). A filter is resolved to
+    the rows of its documents, narrowed to the page range with a binary search when
+    the pages of a range are sorted, so its cost is proportional to the partition
+    and not to the corpus.
+    Usage:
+    partition_map = PartitionMap(df)
+    rows = partition_map.rows(SearchFilter(name_paths=[path], pages=(2, 5)))
+
+    Args:
+        df (pd.DataFrame): The vectorstore, with 'name_path', 'index_document' and
+            'page' columns.
+        fingerprint (str, optional): The get_store_fingerprint of `df`, to detect a
+            stale map. Default is None, it is computed.
+    """
+
+    KEYS = ("name_path", "index_document")
+
+    def __init__(self, df: pd.DataFrame, fingerprint: str = None):
+        self.n_rows = len(df)
+        self.fingerprint = fingerprint or get_store_fingerprint(df)
+        self.ranges = {
+            key: self.__build_ranges(df[key]) for key in self.KEYS if key in df
+        }
+        self.pages = df.page.to_numpy() if "page" in df else None
+        n_documents = len(self.ranges.get("name_path", {}))
+        logging.info(f"Partition map built with {n_documents} documents")
+
+    @staticmethod
+    def __build_ranges(values: pd.Series) -> dict:
+        """
+        Get the (start, end) row ranges of every value of a column, end excluded.
+        """
+        values = values.to_numpy()
+
+        if values.size == 0:
+            return {}
+
+        starts = np.concatenate([[0], np.flatnonzero(values[1:] != values[:-1]) + 1])
+        ends = np.append(starts[1:], values.size)
+        ranges = {}
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            ranges.setdefault(values[start], []).append((start, end))
+
+        return ranges
+
+    def __key_ranges(self, key: str, values: list) -> set:
+        """
+        Get the row ranges of some values of a column.
+        """
+        if key not in self.ranges:
+            raise ValueError(f"The vectorstore has no '{key}' column to filter by")
+
+        return {
+            row_range
+            for value in values
+            for row_range in self.ranges[key].get(value, [])
+        }
+
+    def __narrow_pages(self, start: int, end: int, first: int, last: int) -> np.ndarray:
+        """
+        Get the rows of a range whose page is between `first` and `last`.
+        """
+        pages = self.pages[start:end]
+
+        if pages.size and np.all(pages[:-1] <= pages[1:]):
+            low = np.searchsorted(pages, first, side="left")
+            high = np.searchsorted(pages, last, side="right")
+            return np.arange(start + low, start + high)
+
+        return start + np.flatnonzero((pages >= first) & (pages <= last))
+
+    def rows(self, search_filter: SearchFilter) -> np.ndarray:
+        """
+        Get the sorted row positions that match a filter.
+
+        Args:
+            search_filter (SearchFilter): The documents and pages to keep.
+
+        Returns:
+            np.ndarray: The positions of the matching rows.
+        """
+        selected = None
+
+        for key, values in (
+            ("name_path", search_filter.name_paths),
+            ("index_document", search_filter.index_documents),
+        ):
+            if values is not None:
+                key_ranges = self.__key_ranges(key, values)
+                selected = key_ranges if selected is None else selected & key_ranges
+
+        if selected is None:
+            selected = {(0, self.n_rows)}
+
+        selected = sorted(selected)
+
+        if search_filter.pages is not None:
+            if self.pages is None:
+                raise ValueError("The vectorstore has no 'page' column to filter by")
+
+            first, last = search_filter.pages
+            pieces = [
+                self.__narrow_pages(start, end, first, last) for start, end in selected
+            ]
+        else:
+            pieces = [np.arange(start, end) for start, end in selected]
+
+        if not pieces:
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate(pieces).astype(np.int64)
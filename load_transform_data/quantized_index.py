@@ -0,0 +1,181 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from load_transform_data.embedding_index import EmbeddingIndex
+
+
+class QuantizedIndex(EmbeddingIndex):
+    """
+    An index that keeps the embeddings quantized in memory and rescores exactly.
+
+    The normalized embeddings are stored as float16, or as int8 with one scale per
+    vector, and both are scored block by block through the float32 BLAS product. A
+    shortlist of the best approximate scores is then rescored at full precision, so
+    the returned scores are exact and the similarity threshold behaves as with the
+    full-precision index.
+
+    The full-precision rows come from `matrix` when it is given (ideally a
+    memory-mapped store, only the shortlist rows are read), otherwise from the
+    embeddings column of `df` in float64. Only the first case saves memory: without
+    `matrix` the float64 column stays in memory next to the codes.
+    Usage:
+    index = QuantizedIndex(df, dtype="int8")
+    positions, scores = index.search(embedding, top_n=5)
+
+    Args:
+        df (pd.DataFrame): The vectorstore containing the embeddings.
+        column (str, optional): The name of the embeddings column. Default is "ada_v2".
+        matrix (np.ndarray, optional): The embeddings of `df` already normalized.
+            Default is None.
+        dtype (str, optional): "int8" or "float16". Default is "int8".
+        shortlist (int, optional): The minimum rows rescored at full precision.
+            Default is 64.
+        block_size (int, optional): The rows scored at a time, it bounds the temporary
+            float32 copy of the codes of a search to block_size x dimension.
+            Default is 2048.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        column: str = "ada_v2",
+        matrix: np.ndarray = None,
+        dtype: str = "int8",
+        shortlist: int = 64,
+        block_size: int = 2048,
+    ):
+        if dtype not in ("int8", "float16"):
+            raise ValueError("dtype has to be 'int8' or 'float16'")
+
+        super().__init__(df, column=column, matrix=matrix)
+        self.dtype = dtype
+        self.shortlist = shortlist
+        self.block_size = block_size
+        self.codes, self.scales = self.quantize(self.matrix, dtype)
+
+        if matrix is None:
+            # the float32 copy is not needed, df keeps the full precision
+            self.matrix = None
+
+        logging.info(f"Quantized index built with {self.codes.nbytes} bytes")
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @staticmethod
+    def quantize(matrix: np.ndarray, dtype: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Quantize the rows of a normalized matrix.
+
+        Args:
+            matrix (np.ndarray): 2-d matrix of normalized rows, or a single vector.
+            dtype (str): "int8" or "float16".
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The codes and the scale of every row (ones
+                for float16).
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+
+        if matrix.size == 0:
+            code_dtype = np.float16 if dtype == "float16" else np.int8
+            codes = np.empty(matrix.shape, dtype=code_dtype)
+            return codes, np.ones(matrix.shape[:-1], np.float32)
+
+        if dtype == "float16":
+            return matrix.astype(np.float16), np.ones(matrix.shape[:-1], np.float32)
+
+        scales = np.abs(matrix).max(axis=-1) / 127
+        scales = np.where(scales == 0, 1, scales).astype(np.float32)
+        codes = np.rint(matrix / scales[..., None]).astype(np.int8)
+        return codes, scales
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        """
+        Score every row against a normalized query with the quantized embeddings.
+
+        Args:
+            query (np.ndarray): The normalized query.
+
+        Returns:
+            np.ndarray: The approximate cosine similarity of every row.
+        """
+        query_codes, query_scale = self.quantize(query, self.dtype)
+        query_codes = query_codes.astype(np.float32)
+        scores = np.empty(len(self), dtype=np.float32)
+
+        # both dtypes are scored through the float32 BLAS path, one small block at
+        # a time, the int8 dot products only lose precision in the shortlist order
+        for start in range(0, len(self), self.block_size):
+            block = self.codes[start : start + self.block_size]
+            scores[start : start + self.block_size] = (
+                block.astype(np.float32) @ query_codes
+            )
+
+        return scores * self.scales * query_scale
+
+    def exact_scores(self, positions: np.ndarray, embedding: list) -> np.ndarray:
+        """
+        Score some rows against the query at full precision.
+
+        Args:
+            positions (np.ndarray): The rows to score.
+            embedding (list): The query embedding.
+
+        Returns:
+            np.ndarray: The float64 cosine similarity of each row.
+        """
+        query = np.asarray(embedding, dtype=np.float64)
+        query = query / (np.linalg.norm(query) or 1)
+
+        if self.matrix is not None:
+            rows = np.asarray(self.matrix[positions], dtype=np.float64)
+        else:
+            rows = np.vstack(self.df[self.column].values[positions]).astype(np.float64)
+
+        norms = np.linalg.norm(rows, axis=1)
+        norms[norms == 0] = 1
+        return rows @ query / norms
+
+    def score(self, embedding: list, positions: np.ndarray) -> np.ndarray:
+        """
+        Get the exact cosine similarity of some rows to a query embedding.
+        """
+        return self.exact_scores(positions, embedding)
+
+    def search_batch(
+        self, embeddings: np.ndarray, top_n: int = 3, block_size: int = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search every query, the rescoring of the shortlists is done one at a time.
+        """
+        results = [self.search(embedding, top_n) for embedding in embeddings]
+        shape = (len(results), max(0, min(top_n, len(self))))
+        positions = np.array([result[0] for result in results], dtype=np.int64)
+        scores = np.array([result[1] for result in results], dtype=np.float64)
+        return positions.reshape(shape), scores.reshape(shape)
+
+    def search(self, embedding: list, top_n: int = 3) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows with the highest cosine similarity to a query embedding.
+
+        Args:
+            embedding (list): The query embedding.
+            top_n (int, optional): The number of rows to retrieve. Default is 3.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions in the vectorstore and
+                their exact cosine similarities, highest first.
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        scores = self.approximate_scores(self.normalize(embedding))
+        candidates = self.top_k(scores, max(self.shortlist, 4 * top_n))
+        # scan the candidates in storage order, it is faster on a mapped matrix
+        candidates.sort()
+        exact = self.exact_scores(candidates, embedding)
+        best = self.top_k(exact, top_n)
+        return candidates[best], exact[best]
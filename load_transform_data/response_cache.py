@@ -0,0 +1,347 @@
+import hashlib
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+
+from load_transform_data.embedding_cache import EmbeddingCache
+from openai_api_connection.api_conection import get_completion_from_messages
+
+
+class ResponseCache:
+    """
+    A semantic cache of the chat answers to first-turn questions.
+
+    A stored answer is reused when the embedding of the new question is within
+    `max_distance` cosine distance of a cached question and the hash of the retrieved
+    context is the same, so the answer was generated from the same documentation.
+    The entries expire after `ttl` seconds and the least recently used ones are
+    evicted above `max_items`. All the entries are kept in memory, in the rows of a
+    growable normalized matrix with a validity mask, and mirrored in a SQLite file to
+    survive restarts. A lookup only compares the valid rows that are not expired, the
+    expired rows are removed by a sweep every `sweep_interval` seconds.
+    Usage:
+    cache = ResponseCache(get_file_full_path("response_cache.sqlite"))
+    context_hash = ResponseCache.hash_context(context)
+    response = cache.lookup(embedding, context_hash)
+
+    Args:
+        path (str, optional): The SQLite file. If None, the cache is only in memory.
+            Default is None.
+        max_distance (float, optional): The maximum cosine distance between the
+            questions. Default is 0.05.
+        ttl (float, optional): The seconds an answer is valid. Default is 86400.
+        max_items (int, optional): Maximum number of answers. Default is 5000.
+        sweep_interval (float, optional): The seconds between two removals of the
+            expired answers. Default is 600.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        max_distance: float = 0.05,
+        ttl: float = 86400,
+        max_items: int = 5000,
+        sweep_interval: float = 600,
+    ):
+        self.path = path
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_items = max_items
+        self.sweep_interval = sweep_interval
+        # key -> entry, in least recently used order
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.__lock = threading.Lock()
+        self.__connection = None
+        self.__next_sweep = time.time() + sweep_interval
+        # the rows of the matrix, a row is reused after its entry is deleted
+        self.__matrix = np.empty((0, 0), dtype=np.float32)
+        self.__valid = np.zeros(0, dtype=bool)
+        self.__created = np.zeros(0, dtype=np.float64)
+        self.__context_hashes = np.empty(0, dtype=object)
+        self.__row_keys = []
+        self.__free_rows = []
+
+        if path is not None:
+            self.__connection = self.__connect_sqlite(path)
+            self.__load()
+
+    @staticmethod
+    def __connect_sqlite(path: str) -> sqlite3.Connection:
+        """
+        Open the SQLite file and create the responses table if it does not exist.
+        """
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, context_hash TEXT, embedding BLOB, "
+            "response TEXT, created REAL, last_access REAL)"
+        )
+        connection.commit()
+        logging.info(f"Response cache opened in {path}")
+        return connection
+
+    def __load(self):
+        """
+        Load the persisted answers that are still valid.
+        """
+        self.__connection.execute(
+            "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+        )
+        self.__connection.commit()
+        rows = self.__connection.execute(
+            "SELECT key, context_hash, embedding, response, created, last_access "
+            "FROM responses ORDER BY last_access"
+        )
+
+        for key, context_hash, blob, response, created, last_access in rows:
+            self.__add(
+                key,
+                context_hash,
+                np.frombuffer(blob, dtype=np.float32),
+                response,
+                created,
+                last_access,
+            )
+
+        logging.info(f"{len(self.entries)} cached responses loaded")
+
+    @staticmethod
+    def hash_context(context: str) -> str:
+        """
+        Hash the context retrieved for a question.
+        """
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(question: str, context_hash: str) -> str:
+        """
+        Build the key of an answer from its question and context.
+        """
+        normalized = EmbeddingCache.normalize_text(question).lower()
+        return hashlib.sha256(
+            f"{context_hash}\x00{normalized}".encode("utf-8")
+        ).hexdigest()
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters of the cache.
+
+        Returns:
+            dict: The hits, misses, hit rate, expired and evicted answers and size.
+        """
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "items": len(self.entries),
+            }
+
+    def __add(
+        self,
+        key: str,
+        context_hash: str,
+        vector: np.ndarray,
+        response: str,
+        created: float,
+        last_access: float,
+    ):
+        """
+        Put an entry in a free row of the matrix, doubling the matrix when it is full.
+        """
+        if not self.__free_rows:
+            size = len(self.__valid)
+            capacity = max(2 * size, 64)
+            dimension = self.__matrix.shape[1] if size else vector.shape[0]
+            matrix = np.zeros((capacity, dimension), dtype=np.float32)
+
+            if size:
+                matrix[:size] = self.__matrix
+            self.__matrix = matrix
+            self.__valid = np.concatenate(
+                [self.__valid, np.zeros(capacity - size, bool)]
+            )
+            self.__created = np.concatenate([self.__created, np.zeros(capacity - size)])
+            self.__context_hashes = np.concatenate(
+                [self.__context_hashes, np.empty(capacity - size, dtype=object)]
+            )
+            self.__row_keys.extend([None] * (capacity - size))
+            self.__free_rows = list(range(capacity - 1, size - 1, -1))
+
+        row = self.__free_rows.pop()
+        self.__matrix[row] = vector
+        self.__valid[row] = True
+        self.__created[row] = created
+        self.__context_hashes[row] = context_hash
+        self.__row_keys[row] = key
+        self.entries[key] = {
+            "context_hash": context_hash,
+            "row": row,
+            "response": response,
+            "created": created,
+            "last_access": last_access,
+        }
+
+    def __delete(self, keys: list):
+        for key in keys:
+            row = self.entries.pop(key)["row"]
+            self.__valid[row] = False
+            self.__context_hashes[row] = None
+            self.__row_keys[row] = None
+            self.__free_rows.append(row)
+
+        if self.__connection is not None and keys:
+            self.__connection.executemany(
+                "DELETE FROM responses WHERE key = ?", [(key,) for key in keys]
+            )
+            self.__connection.commit()
+
+    def __remove_expired(self, now: float):
+        """
+        Delete the expired answers, at most once every `sweep_interval` seconds.
+        """
+        if now < self.__next_sweep:
+            return
+
+        self.__next_sweep = now + self.sweep_interval
+        expired = np.flatnonzero(self.__valid & (self.__created < now - self.ttl))
+        keys = [self.__row_keys[row] for row in expired.tolist()]
+        self.expired += len(keys)
+        self.__delete(keys)
+
+    @staticmethod
+    def __normalize(embedding: list) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def lookup(self, embedding: list, context_hash: str):
+        """
+        Find the answer of a similar question with the same context.
+
+        Args:
+            embedding (list): The embedding of the question.
+            context_hash (str): The hash of the retrieved context.
+
+        Returns:
+            str | None: The cached answer, or None on a miss.
+        """
+        query = self.__normalize(embedding)
+        now = time.time()
+
+        with self.__lock:
+            self.__remove_expired(now)
+            # the expired rows not swept yet are skipped
+            candidates = np.flatnonzero(
+                self.__valid
+                & (self.__created >= now - self.ttl)
+                & (self.__context_hashes == context_hash)
+            )
+
+            if candidates.size:
+                similarities = self.__matrix[candidates] @ query
+                best = int(np.argmax(similarities))
+
+                if 1 - similarities[best] <= self.max_distance:
+                    key = self.__row_keys[candidates[best]]
+                    entry = self.entries.pop(key)
+                    entry["last_access"] = now
+                    self.entries[key] = entry
+
+                    if self.__connection is not None:
+                        self.__connection.execute(
+                            "UPDATE responses SET last_access = ? WHERE key = ?",
+                            (entry["last_access"], key),
+                        )
+                        self.__connection.commit()
+
+                    self.hits += 1
+                    logging.info(
+                        f"Response cache hit, distance {1 - similarities[best]}"
+                    )
+                    return entry["response"]
+
+            self.misses += 1
+            return None
+
+    def store(self, question: str, embedding: list, context_hash: str, response: str):
+        """
+        Store the answer of a question.
+
+        Args:
+            question (str): The question of the user.
+            embedding (list): The embedding of the question.
+            context_hash (str): The hash of the retrieved context.
+            response (str): The generated answer, without the references.
+        """
+        key = self.make_key(question, context_hash)
+        vector = self.__normalize(embedding)
+        now = time.time()
+
+        with self.__lock:
+            if key in self.entries:
+                self.__delete([key])
+
+            self.__add(key, context_hash, vector, response, now, now)
+
+            if self.__connection is not None:
+                self.__connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, context_hash, vector.tobytes(), response, now, now),
+                )
+                self.__connection.commit()
+
+            excess = len(self.entries) - self.max_items
+
+            if excess > 0:
+                self.evicted += excess
+                self.__delete(list(itertools.islice(self.entries, excess)))
+
+    def get_completion(
+        self,
+        messages: list,
+        embedding: list,
+        context: str,
+        completion_function: Callable = get_completion_from_messages,
+    ) -> str:
+        """
+        Get the answer of a first-turn question from the cache, generating it on a miss.
+
+        Args:
+            messages (list): The system message and the question of the user.
+            embedding (list): The embedding of the question.
+            context (str): The context retrieved for the question.
+            completion_function (Callable, optional): Called on a miss as
+                completion_function(messages). Default is get_completion_from_messages.
+
+        Returns:
+            str: The answer.
+        """
+        context_hash = self.hash_context(context)
+        response = self.lookup(embedding, context_hash)
+
+        if response is None:
+            response = completion_function(messages)
+            self.store(messages[-1]["content"], embedding, context_hash, response)
+
+        return response
+
+    def close(self):
+        """
+        Close the SQLite file.
+        """
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
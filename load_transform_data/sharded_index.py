@@ -0,0 +1,126 @@
+import logging
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from load_transform_data.embedding_index import EmbeddingIndex
+
+
+class ShardedIndex(EmbeddingIndex):
+    """
+    An exact index that scans the embeddings matrix in shards on several cores.
+
+    The rows are split in `n_shards` contiguous shards. Every shard is scored and
+    reduced to its local top-k in a thread pool, the matrix-vector product and the
+    partition release the GIL, and the local results are merged in a global top-k.
+    The shards are views of the matrix, so a memory-mapped store is not copied.
+    The results are the same as the ones of EmbeddingIndex.search.
+
+    NumPy's BLAS may already use several threads for a single product, set
+    OPENBLAS_NUM_THREADS=1 (or the variable of your BLAS) so the shards do not
+    compete with it.
+    Usage:
+    index = ShardedIndex(df, n_shards=8)
+    positions, scores = index.search(embedding, top_n=5)
+
+    Args:
+        df (pd.DataFrame): The vectorstore containing the embeddings.
+        column (str, optional): The name of the embeddings column. Default is "ada_v2".
+        matrix (np.ndarray, optional): The embeddings of `df` already normalized.
+            Default is None.
+        n_shards (int, optional): The number of shards. Default is the number of CPUs.
+        min_shard_rows (int, optional): Smaller shards are not worth a thread, the
+            number of shards is reduced so each one has at least these rows.
+            Default is 16384.
+        executor (Executor, optional): The pool that scores the shards. Default is a
+            thread pool with one worker per shard.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        column: str = "ada_v2",
+        matrix: np.ndarray = None,
+        n_shards: int = None,
+        min_shard_rows: int = 16384,
+        executor: Executor = None,
+    ):
+        super().__init__(df, column=column, matrix=matrix)
+
+        if n_shards is None:
+            n_shards = os.cpu_count() or 1
+
+        if n_shards < 1:
+            raise ValueError("n_shards has to be at least 1")
+
+        n_shards = max(1, min(n_shards, len(self) // max(min_shard_rows, 1)))
+        self.n_shards = n_shards
+        self.bounds = np.linspace(0, len(self), n_shards + 1).astype(np.int64)
+        self.__owns_executor = executor is None and n_shards > 1
+
+        if self.__owns_executor:
+            executor = ThreadPoolExecutor(
+                max_workers=n_shards, thread_name_prefix="shard"
+            )
+
+        self.executor = executor
+        logging.info(f"Sharded index built with {n_shards} shards")
+
+    def __search_shard(
+        self, start: int, end: int, query: np.ndarray, top_n: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the local top-k of the rows between `start` and `end`.
+        """
+        scores = self.matrix[start:end] @ query
+        positions = self.top_k(scores, top_n)
+        return positions + start, scores[positions]
+
+    @staticmethod
+    def merge(results: list, top_n: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Merge the local top-k of the shards in the global top-k.
+
+        Args:
+            results (list): The (positions, scores) of every shard.
+            top_n (int): The number of rows to keep.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions and their scores,
+                highest first, ties broken by position as in EmbeddingIndex.top_k.
+        """
+        positions = np.concatenate([result[0] for result in results])
+        scores = np.concatenate([result[1] for result in results])
+        order = np.lexsort((positions, -scores))[:top_n]
+        return positions[order], scores[order]
+
+    def search(self, embedding: list, top_n: int = 3) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the rows with the highest cosine similarity to a query embedding.
+
+        Args:
+            embedding (list): The query embedding.
+            top_n (int, optional): The number of rows to retrieve. Default is 3.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions in the vectorstore and
+                their cosine similarities, highest first.
+        """
+        if self.n_shards == 1 or len(self) == 0:
+            return super().search(embedding, top_n)
+
+        query = self.normalize(embedding)
+        futures = [
+            self.executor.submit(self.__search_shard, start, end, query, top_n)
+            for start, end in zip(self.bounds[:-1].tolist(), self.bounds[1:].tolist())
+        ]
+        return self.merge([future.result() for future in futures], top_n)
+
+    def close(self):
+        """
+        Stop the threads of the pool, if the index created it.
+        """
+        if self.__owns_executor:
+            self.executor.shutdown(wait=False)
@@ -1,25 +1,302 @@
 # search through the reviews for a specific product
+import asyncio
+from concurrent.futures import Executor
+import numpy as np
 import pandas as pd
-from openai.embeddings_utils import get_embedding, cosine_similarity
+from openai_api_connection.api_conection import get_embedding
+from openai_api_connection.batch_embeddings import BatchEmbedder
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.bm25_index import BM25Index
+from load_transform_data.embedding_cache import EmbeddingCache
+from load_transform_data.context_builder import ContextBuilder
+from load_transform_data.partition_map import PartitionMap, SearchFilter
+from load_transform_data.metrics import metrics
+from load_transform_data.utils import get_store_fingerprint
 import logging
 
 
+class SearchResult:
+    """
+    The top rows retrieved from the vectorstore for a single query.
+
+    Only the retrieved rows are kept, without the embeddings, so a result is small
+    and independent of the shared vectorstore.
+
+    Args:
+        row_ids (np.ndarray): The positions of the retrieved rows in the vectorstore.
+        scores (np.ndarray): The cosine similarity of each retrieved row.
+        metadata (pd.DataFrame): The retrieved rows without the embeddings column,
+            with an added 'similarities' column.
+        query_embedding (list, optional): The embedding of the query. Default is None.
+    """
+
+    def __init__(
+        self,
+        row_ids: np.ndarray,
+        scores: np.ndarray,
+        metadata: pd.DataFrame,
+        query_embedding: list = None,
+    ):
+        self.row_ids = row_ids
+        self.scores = scores
+        self.metadata = metadata
+        self.query_embedding = query_embedding
+
+    def __len__(self) -> int:
+        return len(self.row_ids)
+
+    @property
+    def empty(self) -> bool:
+        return len(self) == 0
+
+
 class SimilaritiesContextSearcher:
     """
     A class for searching similar contexts and references within a DataFrame.
+
+    The searcher keeps no per-query state, one instance can be shared between
+    concurrent requests and the searched DataFrame is never modified.
     Usage:
     searcher = SimilaritiesContextSearcher()
-    top_similarities = searcher.get_dataframe_top_similarities(df, user_query)
-    context, references = searcher.get_context_and_references(threshold)
+    result = searcher.get_dataframe_top_similarities(df, user_query)
+    context, references = searcher.get_context_and_references(result, threshold)
+
+    A search can be restricted to some PDFs or pages with a SearchFilter, only the
+    rows of the partition map that match it are scored.
+
+    Args:
+        index (EmbeddingIndex, optional): A prebuilt index over the vectorstore. If
+            not given, it is built on the first search and reused while the same
+            DataFrame is searched.
+        embedding_cache (EmbeddingCache, optional): A cache for the query embeddings.
+            If not given, every query is embedded through the API.
+        context_builder (ContextBuilder, optional): Builds the context from the
+            retrieved chunks. Default is a ContextBuilder with its default budget.
+        mode (str, optional): "dense" ranks by cosine similarity only. "hybrid" also
+            gets the `hybrid_candidates` best BM25 chunks and fuses both rankings with
+            reciprocal rank fusion, the cosine similarity is still the returned score.
+            Up to `max_dense_rows` chunks, the hybrid mode still scans all the
+            embeddings for the dense candidates, above it only the lexical candidates
+            are scored with the embeddings. Default is "dense".
+        bm25_index (BM25Index, optional): A prebuilt BM25 index over the vectorstore,
+            for the hybrid mode. If not given, it is built on the first search.
+        hybrid_candidates (int, optional): The candidates of each ranking.
+            Default is 100.
+        max_dense_rows (int, optional): Default is 200000.
+        rrf_k (int, optional): The constant of reciprocal rank fusion. Default is 60.
+        min_similarity (float, optional): In the hybrid mode, the candidates below
+            this cosine similarity are left out of the fusion, so the lexical hits
+            that get_context_and_references would drop do not take the place of the
+            dense ones. Pass its threshold. Default is None, all are fused.
+        partition_map (PartitionMap, optional): A prebuilt partition map of the
+            vectorstore, for the filtered searches. If not given, it is built on the
+            first filtered search.
     """
 
-    def __init__(self):
-        self.df = pd.DataFrame({})
-        self.pages = {}
+    def __init__(
+        self,
+        index: EmbeddingIndex = None,
+        embedding_cache: EmbeddingCache = None,
+        context_builder: ContextBuilder = None,
+        mode: str = "dense",
+        bm25_index: BM25Index = None,
+        hybrid_candidates: int = 100,
+        max_dense_rows: int = 200_000,
+        rrf_k: int = 60,
+        partition_map: PartitionMap = None,
+        min_similarity: float = None,
+    ):
+        if mode not in ("dense", "hybrid"):
+            raise ValueError("mode has to be 'dense' or 'hybrid'")
+
+        self.index = index
+        self.embedding_cache = embedding_cache
+        self.mode = mode
+        self.bm25_index = bm25_index
+        self.hybrid_candidates = hybrid_candidates
+        self.max_dense_rows = max_dense_rows
+        self.rrf_k = rrf_k
+        self.partition_map = partition_map
+        self.min_similarity = min_similarity
+        self.__fingerprint = (None, None)
+
+        if context_builder is None:
+            context_builder = ContextBuilder()
+
+        self.context_builder = context_builder
+
+    def __get_index(self, df: pd.DataFrame) -> EmbeddingIndex:
+        """
+        Get the index for the DataFrame, building it if it is not the indexed one.
+        """
+        index = self.index
+
+        if index is None or index.df is not df:
+            index = EmbeddingIndex(df)
+            self.index = index
+            self.bm25_index = None
+            self.partition_map = None
+
+        return index
+
+    def __get_fingerprint(self, df: pd.DataFrame) -> str:
+        """
+        Get the fingerprint of the DataFrame, computed once per searched DataFrame.
+        """
+        fingerprint_df, fingerprint = self.__fingerprint
+
+        if fingerprint_df is not df:
+            fingerprint = get_store_fingerprint(df)
+            self.__fingerprint = (df, fingerprint)
+
+        return fingerprint
+
+    def __get_bm25_index(self, df: pd.DataFrame) -> BM25Index:
+        """
+        Get the BM25 index for the DataFrame, building it if it does not match.
+        """
+        bm25_index = self.bm25_index
+        fingerprint = self.__get_fingerprint(df)
+
+        if bm25_index is None or bm25_index.fingerprint != fingerprint:
+            bm25_index = BM25Index(df.content, fingerprint=fingerprint)
+            self.bm25_index = bm25_index
+
+        return bm25_index
+
+    def __get_partition_map(self, df: pd.DataFrame) -> PartitionMap:
+        """
+        Get the partition map for the DataFrame, building it if it does not match.
+        """
+        partition_map = self.partition_map
+        fingerprint = self.__get_fingerprint(df)
+
+        # rows moved between documents keep the number of rows
+        if partition_map is None or partition_map.fingerprint != fingerprint:
+            partition_map = PartitionMap(df, fingerprint=fingerprint)
+            self.partition_map = partition_map
+
+        return partition_map
+
+    @staticmethod
+    def __dense_search(
+        index: EmbeddingIndex, embedding: list, top_n: int, rows: np.ndarray = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the best rows by cosine similarity, among `rows` when they are given.
+        """
+        if rows is None:
+            return index.search(embedding, top_n)
+
+        if rows.size == 0:
+            return rows, np.empty(0, dtype=np.float32)
+
+        scores = np.asarray(index.score(embedding, rows))
+        best = EmbeddingIndex.top_k(scores, top_n)
+        return rows[best], scores[best]
+
+    def __hybrid_search(
+        self,
+        index: EmbeddingIndex,
+        df: pd.DataFrame,
+        user_query: str,
+        embedding: list,
+        top_n: int,
+        rows: np.ndarray = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rank the union of the lexical and dense candidates by reciprocal rank fusion.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The row positions, best fused rank first,
+                and their cosine similarities.
+        """
+        lexical, _ = self.__get_bm25_index(df).search(
+            user_query, self.hybrid_candidates, rows
+        )
+        n_rows = len(index) if rows is None else rows.size
+
+        if n_rows > self.max_dense_rows:
+            if lexical.size == 0:
+                return self.__dense_search(index, embedding, top_n, rows)
+
+            candidates = np.sort(lexical)
+        else:
+            dense, _ = self.__dense_search(
+                index, embedding, self.hybrid_candidates, rows
+            )
+            candidates = np.union1d(lexical, dense)
+
+        dense_scores = np.asarray(index.score(embedding, candidates), dtype=np.float64)
+
+        if self.min_similarity is not None:
+            passing = dense_scores >= self.min_similarity
+
+            # if none passes the context is empty anyway, all of them are fused
+            if passing.any():
+                candidates, dense_scores = candidates[passing], dense_scores[passing]
+                lexical = lexical[np.isin(lexical, candidates)]
+
+        dense_rank = np.empty(candidates.size, dtype=np.int64)
+        dense_rank[np.lexsort((candidates, -dense_scores))] = np.arange(candidates.size)
+        # the chunks without query terms get no lexical contribution
+        lexical_rank = pd.Series(np.arange(lexical.size), index=lexical)
+        lexical_rank = lexical_rank.reindex(candidates).to_numpy(dtype=np.float64)
+        fused = 1 / (self.rrf_k + dense_rank + 1) + np.nan_to_num(
+            1 / (self.rrf_k + lexical_rank + 1)
+        )
+        best = EmbeddingIndex.top_k(fused, top_n)
+        return candidates[best], dense_scores[best]
+
+    def __get_query_embedding(self, user_query: str) -> list:
+        """
+        Get the embedding of the query, through the cache when there is one.
+        """
+        with metrics.span("query_embedding"):
+            if self.embedding_cache is None:
+                return get_embedding(user_query, engine="testCX_2")
+
+            return self.embedding_cache.get_embedding(user_query, engine="testCX_2")
+
+    def __search(
+        self,
+        index: EmbeddingIndex,
+        df: pd.DataFrame,
+        user_query: str,
+        embedding: list,
+        top_n: int,
+        search_filter: SearchFilter = None,
+    ) -> SearchResult:
+        """
+        Score the vectorstore against a query embedding and collect the top rows.
+        """
+        with metrics.span("vector_search"):
+            rows = None
+
+            if search_filter is not None:
+                rows = self.__get_partition_map(df).rows(search_filter)
+                logging.info(f"filtered search over {rows.size} rows")
+
+            if self.mode == "hybrid":
+                positions, scores = self.__hybrid_search(
+                    index, df, user_query, embedding, top_n, rows
+                )
+            else:
+                positions, scores = self.__dense_search(index, embedding, top_n, rows)
+
+        logging.info("cosine similarity applied")
+        columns = [col for col in df.columns if col != index.column]
+        metadata = df.iloc[positions][columns].assign(similarities=scores)
+        logging.info(metadata.shape)
+        return SearchResult(positions, scores, metadata, embedding)
 
     def get_dataframe_top_similarities(
-        self, df: pd.DataFrame, user_query: str, top_n: int = 3
-    ) -> None:
+        self,
+        df: pd.DataFrame,
+        user_query: str,
+        top_n: int = 3,
+        search_filter: SearchFilter = None,
+    ) -> SearchResult:
         """
         Get the top similar rows from the DataFrame based on a user query.
 
@@ -27,94 +304,174 @@ class SimilaritiesContextSearcher:
             df (pd.DataFrame): The DataFrame containing data to search.
             user_query (str): The user's query for similarity comparison.
             top_n (int, optional): The number of top similar rows to retrieve. Default is 3.
+            search_filter (SearchFilter, optional): The PDFs and pages to search.
+                Default is None, the whole vectorstore.
+
+        Returns:
+            SearchResult: The retrieved rows, their scores and metadata.
+        """
+        index = self.__get_index(df)
+        embedding = self.__get_query_embedding(user_query)
+        logging.info("message embedding created")
+        return self.__search(index, df, user_query, embedding, top_n, search_filter)
+
+    async def aget_dataframe_top_similarities(
+        self,
+        df: pd.DataFrame,
+        user_query: str,
+        client,
+        top_n: int = 3,
+        executor: Executor = None,
+        search_filter: SearchFilter = None,
+    ) -> SearchResult:
+        """
+        Get the top similar rows without blocking the event loop.
+
+        The query is embedded with the async client, and the scoring, which is
+        CPU-bound, runs in `executor` so the loop keeps serving other sessions.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing data to search.
+            user_query (str): The user's query for similarity comparison.
+            client (AsyncAzureOpenAIClient): The async client of the embeddings API.
+            top_n (int, optional): The number of top similar rows to retrieve. Default is 3.
+            executor (Executor, optional): Where the scoring runs. Default is the
+                default executor of the loop.
+            search_filter (SearchFilter, optional): The PDFs and pages to search.
+                Default is None, the whole vectorstore.
 
         Returns:
-            None
+            SearchResult: The retrieved rows, their scores and metadata.
         """
-        self.df = df.copy()
-        self.pages = {}
-        embedding = get_embedding(user_query, engine="testCX_2")
+        loop = asyncio.get_running_loop()
+        index = self.__get_index(df)
+        embedding = None
+
+        with metrics.span("query_embedding"):
+            # the SQLite level of the cache blocks, it runs out of the event loop
+            if self.embedding_cache is not None:
+                embedding = await loop.run_in_executor(
+                    executor, self.embedding_cache.get, user_query, "testCX_2"
+                )
+
+            if embedding is None:
+                embedding = await client.get_embedding(user_query, engine="testCX_2")
+
+                if self.embedding_cache is not None:
+                    await loop.run_in_executor(
+                        executor,
+                        self.embedding_cache.put,
+                        user_query,
+                        "testCX_2",
+                        embedding,
+                    )
+
         logging.info("message embedding created")
-        self.df["similarities"] = self.df.ada_v2.apply(
-            lambda x: cosine_similarity(x, embedding)
+        return await loop.run_in_executor(
+            executor,
+            self.__search,
+            index,
+            df,
+            user_query,
+            embedding,
+            top_n,
+            search_filter,
         )
-        logging.info("cosine similarity applied")
-        self.df = self.df.sort_values("similarities", ascending=False).head(top_n)
-        logging.info(self.df.shape)
 
-    def get_context_and_references(self, threshold: float = 0.8) -> tuple[str, str]:
+    def get_dataframe_top_similarities_batch(
+        self,
+        df: pd.DataFrame,
+        user_queries: list,
+        top_n: int = 3,
+        embeddings: np.ndarray = None,
+        embedder: BatchEmbedder = None,
+    ) -> list:
+        """
+        Get the top similar rows for many queries at once.
+
+        The queries are embedded in batches, and in the dense mode they are scored
+        together by EmbeddingIndex.search_batch. The hybrid mode fuses the rankings
+        of every query as get_dataframe_top_similarities does.
+
+        Args:
+            df (pd.DataFrame): The DataFrame containing data to search.
+            user_queries (list): The queries.
+            top_n (int, optional): The number of top similar rows to retrieve per
+                query. Default is 3.
+            embeddings (np.ndarray, optional): The embeddings of the queries, to skip
+                the embedding requests. Default is None.
+            embedder (BatchEmbedder, optional): Embeds the queries. Default is a
+                BatchEmbedder using the embedding cache of the searcher.
+
+        Returns:
+            list: One SearchResult per query, in the same order.
+        """
+        if len(user_queries) == 0:
+            return []
+
+        index = self.__get_index(df)
+
+        if embeddings is None:
+            if embedder is None:
+                embedder = BatchEmbedder(embedding_cache=self.embedding_cache)
+
+            with metrics.span("query_embedding"):
+                embeddings = embedder.embed(list(user_queries))
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        logging.info(f"{len(embeddings)} message embeddings created")
+
+        if self.mode == "hybrid":
+            return [
+                self.__search(index, df, user_query, embedding, top_n)
+                for user_query, embedding in zip(user_queries, embeddings)
+            ]
+
+        with metrics.span("vector_search"):
+            positions, scores = index.search_batch(embeddings, top_n)
+
+        columns = [col for col in df.columns if col != index.column]
+        results = []
+
+        for row_ids, row_scores, embedding in zip(positions, scores, embeddings):
+            metadata = df.iloc[row_ids][columns].assign(similarities=row_scores)
+            results.append(SearchResult(row_ids, row_scores, metadata, embedding))
+
+        return results
+
+    def get_context_and_references(
+        self, result: SearchResult, threshold: float = 0.8
+    ) -> tuple[str, str]:
         """
         Get context and references for rows with similarities above the threshold.
 
+        The overlapping chunks of the same page are merged and the context is packed
+        in score order within the token budget of the context builder.
+
         Args:
+            result (SearchResult): The result of get_dataframe_top_similarities.
             threshold (float, optional): The similarity threshold. Default is 0.8.
 
         Returns:
             tuple[str, str]: A tuple containing context and references information.
         """
-        if self.df.empty:
-            raise NameError(
-                "First use get_dataframe_top_similarities and use a DataFrame"
-            )
+        if result.empty:
+            logging.info("there are no information in the vectorstore")
+            return "null", "null"
 
         logging.info("maximum")
-        logging.info(self.df.similarities.max())
-        df_similarities = self.df[self.df.similarities >= threshold]
+        logging.info(result.metadata.similarities.max())
+        df_similarities = result.metadata[result.metadata.similarities >= threshold]
 
         if df_similarities.empty:
             logging.info("there are no information in the vectorstore")
             return "null", "null"
 
-        file_name = []
-        indexes = []
         logging.info(df_similarities.shape)
-        for i, row in df_similarities.iterrows():
-            file_name.append(row.name_path)
-            self.pages[row.name_path] = []
-            self.pages[row.name_path].append(row.page)
-            indexes.append(i)
-        logging.info("pages len")
-        logging.info(len(self.pages))
-        context = ""
-        for key in self.pages.keys():
-
-            for val in self.pages[key]:
-                df_path = df_similarities.query("name_path == @key")
-                content_values = df_path.content[df_path.page == val].values
-                content_values = " ".join(list(content_values))
-                context += content_values
-
-        pages = self.__transform_dict_to_str_references()
-        logging.info("documentation and references created")
-        logging.info(pages)
-
-        return context, pages
+        with metrics.span("context_build"):
+            context, references = self.context_builder.build(df_similarities)
 
-    def __transform_dict_to_str_references(self) -> str:
-        """
-        Transform the pages dictionary into formatted string references.
-        """
-        references = ""
-        ref = []
-
-        # concat the path and the page
-        for key, value in self.pages.items():
-            for val in value:
-                ref.append(key + "§" + str(value))
-
-        # get the unique values
-        ref = set(ref)
-        logging.info(len(ref))
-        dict_references = {}
-
-        # again transform in dictionary
-        for item in ref:
-            # use the symbol § because is rarely used in texts
-            item_list = item.split("§")
-            dict_references[item_list[0]] = item_list[1]
-
-        # transform in str
-        for key in dict_references:
-            references += f"`File name: {key} | Pages: {str(dict_references[key])}`\n"
+        logging.info("documentation and references created")
+        logging.info(references)
 
-        return references
+        return context, references
@@ -1,79 +1,118 @@
 import pandas as pd
 import logging
+import tiktoken
+from load_transform_data.metrics import metrics
+from typing import Iterable, Iterator
 
 
 class TextSplitter:
     """
-    A class for splitting text content into smaller documents.
+    A class for splitting text content into smaller documents measured in tokens.
+
+    The texts are encoded with `tiktoken`, so the sizes are the real token counts of
+    the embedding and chat models, and there is no limit in the length of a text.
+    Every document records the character offsets where it starts and ends in the
+    original text and its number of tokens.
 
     Args:
-        max_tokens (int, optional): The maximum number of tokens in the entire text.
-            Defaults to 2048.
         tokens_per_document (int, optional): The desired number of tokens per document.
-            Defaults to 500.
+            Defaults to 600.
         overlap (int, optional): The number of tokens overlapping between consecutive documents.
-            Defaults to 50.
+            Defaults to 150.
+        encoding_name (str, optional): The tiktoken encoding of the models.
+            Defaults to "cl100k_base".
     """
 
     def __init__(
-        self, max_tokens: int = 4096, tokens_per_document: int = 600, overlap: int = 150
+        self,
+        tokens_per_document: int = 600,
+        overlap: int = 150,
+        encoding_name: str = "cl100k_base",
     ):
-        self.max_tokens = max_tokens
         self.tokens_per_document = tokens_per_document
         self.overlap = overlap
-        self.list_indexes = []
 
         if self.overlap >= self.tokens_per_document:
             raise ValueError("The tokens_per_document has to be > overlap")
 
-        self.__generate_indexes()
+        self.encoding = tiktoken.get_encoding(encoding_name)
 
-    def __generate_indexes(self):
-        """
-        Generates the list of start and end indexes for each document based on
-        `tokens_per_document` and `overlap` parameters.
+    def __get_windows(self, n_tokens: int) -> list:
         """
+        Get the start and end token of each document of a text with `n_tokens` tokens.
 
-        list_indexes = []
-        i = 0
+        Args:
+            n_tokens (int): The number of tokens of the text.
 
-        while i < self.max_tokens:
-            next_i = i + self.tokens_per_document - 1
+        Returns:
+            list: List of (start, end) tuples, the end is exclusive.
+        """
+        windows = []
+        step = self.tokens_per_document - self.overlap
 
-            if i == 0:
-                list_indexes.append((0, self.tokens_per_document - 1))
-            else:
-                list_indexes.append((i, next_i))
+        for start in range(0, n_tokens, step):
+            end = min(start + self.tokens_per_document, n_tokens)
+            windows.append((start, end))
 
-            i = next_i - self.overlap + 1
+            if end == n_tokens:
+                break
 
-        self.list_indexes = list_indexes[:]
-        logging.info("General structure for indexes split generated")
+        return windows
 
-    def __split_text(self, text: str) -> list:
+    def __split_text(self, text: str, tokens: list) -> tuple[list, list, list, list]:
         """
-        Splits the given text into a list of smaller documents based on the
-        pre-generated list of indexes.
+        Splits the given text into a list of smaller documents following its tokens.
 
         Args:
             text (str): The input text to be split.
+            tokens (list): The tokens of the text.
 
         Returns:
-            list: List of split documents.
+            tuple[list, list, list, list]: The documents, the character offsets where
+                each one starts and ends in the text, and their number of tokens.
         """
-        list_text = text.split(" ")
+        _, token_offsets = self.encoding.decode_with_offsets(tokens)
+        token_offsets.append(len(text))
         list_documents = []
+        list_start = []
+        list_end = []
+        list_tokens = []
 
-        for i, j in self.list_indexes:
-            new_item = " ".join(list_text[i : j + 1])
+        for i, j in self.__get_windows(len(tokens)):
+            raw = text[token_offsets[i] : token_offsets[j]]
+            new_item = raw.strip()
 
             if new_item != "":
+                start = token_offsets[i] + len(raw) - len(raw.lstrip())
                 list_documents.append(new_item)
+                list_start.append(start)
+                list_end.append(start + len(new_item))
+                list_tokens.append(j - i)
 
-            if j > len(list_text):
-                break
+        return list_documents, list_start, list_end, list_tokens
+
+    def split_texts(self, texts: list) -> tuple[list, list, list, list]:
+        """
+        Splits a batch of texts, encoding all of them at once.
+
+        Args:
+            texts (list): The input texts.
 
-        return list_documents
+        Returns:
+            tuple[list, list, list, list]: For each text, the list of its documents,
+                the lists of their start and end character offsets and the list of
+                their number of tokens.
+        """
+        list_tokens = self.encoding.encode_batch(texts, disallowed_special=())
+        splits = [
+            self.__split_text(text, tokens) for text, tokens in zip(texts, list_tokens)
+        ]
+
+        if not splits:
+            return [], [], [], []
+
+        documents, starts, ends, n_tokens = zip(*splits)
+        return list(documents), list(starts), list(ends), list(n_tokens)
 
     def generate_documents(self, df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -83,9 +122,31 @@ class TextSplitter:
             df (pd.DataFrame): Input DataFrame with a 'content' column containing text.
 
         Returns:
-            pd.DataFrame: DataFrame with added 'content' column containing split documents.
+            pd.DataFrame: DataFrame with the 'content' column containing the list of
+                split documents of each row, the 'char_start' and 'char_end' columns
+                with the lists of their character offsets, and the 'n_tokens' column
+                with the lists of their number of tokens.
         """
-        print(self.list_indexes)
-        df["content"] = df["content"].apply(lambda x: self.__split_text(x))
+        with metrics.span("splitting"):
+            documents, starts, ends, n_tokens = self.split_texts(df["content"].tolist())
+
+        df["content"] = pd.Series(documents, index=df.index, dtype=object)
+        df["char_start"] = pd.Series(starts, index=df.index, dtype=object)
+        df["char_end"] = pd.Series(ends, index=df.index, dtype=object)
+        df["n_tokens"] = pd.Series(n_tokens, index=df.index, dtype=object)
         logging.info("Documents split generated")
         return df
+
+    def iter_documents(self, dfs: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """
+        Generates smaller documents from a stream of DataFrames, one input at a time.
+
+        Args:
+            dfs (Iterable[pd.DataFrame]): DataFrames with a 'content' column, for
+                example the output of AzureBlobStorageDocumentLoader.iter_documents.
+
+        Yields:
+            pd.DataFrame: Each input DataFrame with the 'content' column split.
+        """
+        for df in dfs:
+            yield self.generate_documents(df)
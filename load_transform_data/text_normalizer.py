@@ -0,0 +1,94 @@
+import codecs
+import re
+from typing import Iterable
+
+# runs of two or more spaces are deleted, as in the original clean_content
+MULTIPLE_SPACES = re.compile(r" {2,}")
+ALLOWED_CHARACTER = re.compile(r"[a-zA-Z0-9\s.,!?_(){}\[\]+=\-/*]")
+
+
+def _drop_non_ascii(error: UnicodeEncodeError) -> tuple[str, int]:
+    """
+    Encoding error handler that deletes the non-ASCII characters, except the
+    whitespace that becomes a space, because it is collapsed later anyway.
+    """
+    run = error.object[error.start : error.end]
+    return "".join(" " for character in run if character.isspace()), error.end
+
+
+codecs.register_error("text_normalizer_drop", _drop_non_ascii)
+
+
+class _DeletionTable(dict):
+    """
+    A str.translate table that deletes line breaks, tabs and the characters that are
+    not allowed. The decision for every code point is computed once and cached.
+    """
+
+    def __missing__(self, code: int):
+        character = chr(code)
+
+        if character in "\r\n\t" or not ALLOWED_CHARACTER.match(character):
+            self[code] = None
+        else:
+            self[code] = code
+
+        return self[code]
+
+
+class TextNormalizer:
+    """
+    Clean the text extracted from the PDFs with precompiled patterns.
+
+    The cleaning removes line breaks, strange symbols and runs of spaces, collapses
+    the remaining whitespace and fixes repeated dots. The non-ASCII characters are
+    dropped while encoding, and the other deletions are done with a cached translate
+    table, which runs in the ASCII fast path of str.translate. The instance has no
+    state besides its caches and can be used in the extraction worker processes.
+    Usage:
+    normalizer = TextNormalizer()
+    cleaned = normalizer.clean_many(pages)
+    """
+
+    def __init__(self):
+        self.__table = _DeletionTable()
+
+    def clean(self, x: str) -> str:
+        """
+        Clean the input text, removing line breaks, strange symbols and double spaces.
+
+        Args:
+            x (str): The input text to be cleaned.
+
+        Returns:
+            str: The cleaned text.
+        """
+        # the runs of spaces are found before deleting the characters around them
+        x = MULTIPLE_SPACES.sub("", x)
+
+        if not x.isascii():
+            x = x.encode("ascii", "text_normalizer_drop").decode("ascii")
+
+        x = " ".join(x.translate(self.__table).split())
+
+        # a literal ". ," only, the original pattern had an unescaped dot
+        x = x.replace(". ,", "")
+        x = x.replace("..", ".")
+        x = x.replace(". .", ".")
+        return x.strip()
+
+    def clean_many(self, texts: Iterable[str]) -> list:
+        """
+        Clean a whole column of texts.
+
+        Args:
+            texts (Iterable[str]): The input texts, for example a pandas Series.
+
+        Returns:
+            list: The cleaned texts, in the same order.
+        """
+        clean = self.clean
+        return [clean(x) for x in texts]
+
+
+default_normalizer = TextNormalizer()
@@ -1,5 +1,11 @@
+import hashlib
 import os
 
+import pandas as pd
+
+# the columns that the lexical index and the partition map depend on
+FINGERPRINT_COLUMNS = ["name_path", "index_document", "page", "content"]
+
 
 def get_azure_primary_key(name_env_variable: str = "AZURE_KEY") -> str:
     """
@@ -73,6 +79,37 @@ def get_azure_base(name_env_variable: str = "AZURE_BASE") -> str:
     return azure_base
 
 
+def get_store_fingerprint(dfs) -> str:
+    """
+    Get a digest of the rows of a vectorstore, without the embeddings.
+
+    It changes when a chunk is replaced or moved to another document or page, even
+    if the number of rows does not change, so the indexes saved with it can be
+    checked against the current store.
+
+    Parameters
+    ----------
+    dfs : pd.DataFrame or Iterable[pd.DataFrame]
+        The vectorstore, or its consecutive rows in batches.
+
+    Returns
+    -------
+    str
+        The SHA-256 hex digest of the FINGERPRINT_COLUMNS of every row.
+    """
+    if isinstance(dfs, pd.DataFrame):
+        dfs = [dfs]
+
+    digest = hashlib.sha256()
+
+    for df in dfs:
+        columns = [col for col in FINGERPRINT_COLUMNS if col in df.columns]
+        hashes = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+        digest.update(hashes.to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+
 def get_file_full_path(filename: str) -> str:
     root_path = os.path.abspath(os.path.join(os.getcwd(), "."))
     # Path to the "data" folder in the root path
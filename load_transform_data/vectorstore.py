@@ -1,11 +1,26 @@
+import hashlib
+import numpy as np
 import pandas as pd
-from openai.embeddings_utils import get_embedding
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterable
 from openai_api_connection.api_conection import embedding_connection
+from openai_api_connection.batch_embeddings import BatchEmbedder
+from load_transform_data.embedding_cache import EmbeddingCache
+from load_transform_data.metrics import metrics
+from load_transform_data.bm25_index import BM25Index
+from load_transform_data.utils import (
+    FINGERPRINT_COLUMNS,
+    get_file_full_path,
+    get_store_fingerprint,
+)
 import os
 import logging
 import sys
 
 debug_mode = False
+# the columns of the previous store kept in memory in an incremental build
+PREVIOUS_COLUMNS = ["name_path", "blob_version", "content_hash"]
 
 if "--debug" in sys.argv:
     debug_mode = True
@@ -20,60 +35,292 @@ class VectorStore:
 
     This class is designed to create a vector store from a given pandas DataFrame.
     It provides methods to restructure and split the DataFrame, generate embeddings
-    for the contents, and save the resulting vector store as a parquet file.
+    for the contents, and save the resulting vector store as a parquet file. The
+    vector store can also be streamed to the parquet file in batches with
+    `stream_vector_store`, without holding the whole corpus in memory.
 
     Args:
-        df (pd.DataFrame): The input DataFrame containing data to create the vector store.
+        df (pd.DataFrame, optional): The input DataFrame containing data to create the
+            vector store. Not needed for `stream_vector_store`. Default is None.
+        embedding_cache (EmbeddingCache, optional): A cache for the embeddings, the
+            texts already embedded are not requested again. Default is None.
+        embedder (BatchEmbedder, optional): The engine that generates the embeddings.
+            Default is a BatchEmbedder with the default budgets using embedding_cache.
+        previous (pd.DataFrame, optional): The previously saved vector store, for an
+            incremental build. Its rows of the blobs that are not loaded again are kept,
+            and its embeddings are reused for the chunks with the same content hash.
+            With `previous_path`, only its metadata columns from `read_previous`.
+            Default is None.
+        previous_path (str, optional): The parquet file of the previous store. The
+            kept rows and the reused embeddings are read from it by row groups, so the
+            old embeddings are never all in memory. Default is None.
     """
 
-    def __init__(self, df: pd.DataFrame):
+    def __init__(
+        self,
+        df: pd.DataFrame = None,
+        embedding_cache: EmbeddingCache = None,
+        embedder: BatchEmbedder = None,
+        previous: pd.DataFrame = None,
+        previous_path: str = None,
+    ):
         self.df = df
-        self.count = 0
+        self.embedding_cache = embedding_cache
+        self.report = {"added": 0, "reused": 0, "removed": 0}
+        self.bm25_index = None
+        self.previous_path = previous_path
+        self.__previous_file = None
+        self.__known_rows = pd.Series(dtype=np.int64)
 
-    def __restruct_split(self):
+        if previous_path is not None:
+            self.__previous_file = pq.ParquetFile(previous_path)
+
+            if previous is None:
+                previous = self.read_previous(previous_path)
+
+        self.previous = previous
+
+        if previous is not None and "content_hash" in previous.columns:
+            # the first row of every content hash of the previous store
+            known_rows = pd.Series(
+                np.arange(len(previous)), index=previous.content_hash
+            )
+            self.__known_rows = known_rows[~known_rows.index.duplicated()]
+
+        if embedder is None:
+            embedder = BatchEmbedder(embedding_cache=embedding_cache)
+
+        self.embedder = embedder
+
+    @staticmethod
+    def __restruct_split(df: pd.DataFrame) -> pd.DataFrame:
         """
         Restructure and split the DataFrame for embedding generation.
+
+        The list columns of the splitter ('content', the offsets and the number of
+        tokens) are exploded together, every chunk becomes a row inheriting the other
+        columns.
+        """
+        list_columns = [
+            col
+            for col in ["content", "char_start", "char_end", "n_tokens"]
+            if col in df.columns
+        ]
+        df = df.explode(list_columns, ignore_index=True)
+        df = df.dropna(subset=["content"]).reset_index(drop=True)
+
+        for col in list_columns[1:]:
+            df[col] = df[col].astype("int64")
+
+        return df
+
+    @staticmethod
+    def read_previous(path: str) -> pd.DataFrame:
+        """
+        Read the metadata columns of a saved store needed by an incremental build.
+
+        Args:
+            path (str): The parquet file of the store.
+
+        Returns:
+            pd.DataFrame: The columns of PREVIOUS_COLUMNS that are in the file.
+        """
+        names = pq.read_schema(path).names
+        columns = [col for col in PREVIOUS_COLUMNS if col in names]
+        return pd.read_parquet(path, columns=columns)
+
+    @property
+    def __previous_columns(self) -> set:
+        if self.__previous_file is not None:
+            return set(self.__previous_file.schema_arrow.names)
+
+        return set(self.previous.columns)
+
+    def __iter_previous(self, batch_size: int = 4096):
+        """
+        Iterate over the previous store in DataFrames of consecutive rows.
+
+        Yields:
+            tuple[int, pd.DataFrame]: The position of the first row and the rows.
+        """
+        if self.__previous_file is None:
+            yield 0, self.previous
+            return
+
+        start = 0
+
+        for batch in self.__previous_file.iter_batches(batch_size=batch_size):
+            yield start, batch.to_pandas()
+            start += batch.num_rows
+
+    def __get_known_embeddings(self, hashes: pd.Series) -> pd.Series:
+        """
+        Get the embeddings of the previous store for the known content hashes.
+
+        From the previous file, only the embeddings of the row groups holding the
+        known hashes are read.
         """
-        columns = {col: [] for col in self.df.columns}
+        embeddings = pd.Series(None, index=hashes.index, dtype=object)
+        rows = hashes.map(self.__known_rows).dropna().astype(np.int64)
+
+        if rows.empty:
+            return embeddings
+
+        if self.__previous_file is None:
+            embeddings[rows.index] = self.previous.ada_v2.to_numpy()[rows.to_numpy()]
+            return embeddings
+
+        metadata = self.__previous_file.metadata
+        group_rows = [
+            metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+        ]
+        group_starts = np.concatenate([[0], np.cumsum(group_rows)])
+        groups = np.searchsorted(group_starts, rows.to_numpy(), side="right") - 1
+
+        for group in np.unique(groups):
+            selected = rows[groups == group]
+            column = self.__previous_file.read_row_group(int(group), columns=["ada_v2"])
+            offsets = selected.to_numpy() - group_starts[group]
+            values = column.column("ada_v2").take(offsets).to_pylist()
+            embeddings[selected.index] = pd.Series(
+                values, index=selected.index, dtype=object
+            )
 
-        # The column 'content' in the df is a list object, the items in this list
-        # will be transformed in new rows inheriting the other elements in the adjacent columns
-        for i, content in self.df.iterrows():
-            for text in content.content:
-                # save the info in dictionaries for create a new expanded data frame
-                columns["content"].append(text)
-                columns["name_path"].append(content.name_path)
-                columns["index_document"].append(content.index_document)
-                columns["page"].append(content.page)
+        return embeddings
 
-        self.df = pd.DataFrame(columns)
+    @staticmethod
+    def hash_content(text: str) -> str:
+        """
+        Get the hash that identifies the content of a chunk.
+
+        Args:
+            text (str): The content of the chunk.
+
+        Returns:
+            str: The SHA-256 hex digest of the content.
+        """
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-    def __get_embedding_(self, x: str):
+    @staticmethod
+    def get_changed_blobs(previous: pd.DataFrame, blobs: pd.DataFrame) -> pd.DataFrame:
         """
-        Generate embedding for a given input text.
+        Get the blobs that are new or whose version changed since the previous build.
 
         Args:
-            x (str): Input text for embedding generation.
+            previous (pd.DataFrame): The previously saved vector store, can be None.
+            blobs (pd.DataFrame): The current blobs with 'name_path' and 'blob_version'.
 
         Returns:
-            str: The generated embedding.
+            pd.DataFrame: The rows of `blobs` that have to be loaded again.
+        """
+        if previous is None or "blob_version" not in previous.columns:
+            return blobs
+
+        previous_versions = previous.groupby("name_path").blob_version.first()
+        known = blobs.name_path.map(previous_versions)
+        return blobs[known != blobs.blob_version]
+
+    def __embed_chunks(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Split the documents of a DataFrame in rows and generate their embeddings.
+
+        The embeddings of the previous store are reused for the known content hashes.
+
+        Args:
+            df (pd.DataFrame): Documents with a 'content' column of split texts.
+
+        Returns:
+            pd.DataFrame: One row per chunk, with 'content_hash' and 'ada_v2' columns.
+        """
+        df = self.__restruct_split(df)
+        df["content_hash"] = df["content"].apply(self.hash_content)
+        df["ada_v2"] = self.__get_known_embeddings(df.content_hash)
+        missing = df.ada_v2.isna()
+
+        with metrics.span("embedding"):
+            embeddings = self.embedder.embed(df.content[missing].tolist())
+
+        df.loc[missing, "ada_v2"] = pd.Series(
+            embeddings, index=df.index[missing], dtype=object
+        )
+        self.report["added"] += len(embeddings)
+        self.report["reused"] += int((~missing).sum())
+        return df
+
+    def __iter_kept_rows(self, blobs: pd.DataFrame, loaded_names: set, new_hashes: set):
         """
-        self.count += 1
-        logging.info(f"{self.count}/{self.df.shape[0]}") if self.count % 50 == 0 else 0
-        x = get_embedding(x, engine="testCX_2")
-        return x
+        Iterate over the rows of the previous store that are kept as they are.
+
+        The rows of the loaded blobs are replaced by the new ones, and when `blobs` is
+        given the rows of the blobs that are no longer in it are dropped. The dropped
+        rows whose content is not in the new chunks are counted as removed. The
+        previous file is read in batches, so the kept rows are never all in memory.
+
+        Args:
+            blobs (pd.DataFrame): The current blobs, can be None.
+            loaded_names (set): The paths of the blobs loaded again.
+            new_hashes (set): The content hashes of the new chunks.
 
-    def create_vector_store(self):
+        Yields:
+            pd.DataFrame: The kept rows, nothing if there is no previous store.
+        """
+        previous = self.previous
+
+        if previous is None:
+            return
+
+        required = {"content_hash", "char_start", "char_end", "n_tokens"}
+
+        if not required <= self.__previous_columns:
+            # stores from before the incremental builds or token splitter are rebuilt
+            self.report["removed"] += len(previous)
+            return
+
+        # the kept rows are decided on the metadata, only they are read in full
+        is_kept = ~previous.name_path.isin(loaded_names)
+
+        if blobs is not None:
+            is_kept &= previous.name_path.isin(blobs.name_path)
+            index_document = blobs.set_index("name_path").index_document
+
+        replaced = previous.content_hash[~is_kept]
+        self.report["reused"] += int(is_kept.sum())
+        self.report["removed"] += int((~replaced.isin(new_hashes)).sum())
+        is_kept = is_kept.to_numpy()
+
+        for start, rows in self.__iter_previous():
+            kept = rows[is_kept[start : start + len(rows)]]
+
+            if blobs is not None:
+                kept = kept.assign(index_document=kept.name_path.map(index_document))
+
+            if not kept.empty:
+                yield kept
+
+    def create_vector_store(self, blobs: pd.DataFrame = None):
         """
         Create the vector store by generating embeddings.
 
+        In an incremental build, only the chunks whose content hash is not in the
+        previous store are embedded, and the number of chunks added, reused and
+        removed is left in `report`.
+
+        Args:
+            blobs (pd.DataFrame, optional): The current blobs as returned by
+                `AzureBlobStorageDocumentLoader.list_blobs`, used to drop the rows of
+                deleted blobs from the previous store. Default is None.
+
         Returns:
             pd.DataFrame: The DataFrame containing generated embeddings.
         """
         embedding_connection()
-        self.__restruct_split()
         logging.info("Generating embeddings...")
-        self.df["ada_v2"] = self.df["content"].apply(lambda x: self.__get_embedding_(x))
+        chunks = self.__embed_chunks(self.df)
+        kept = self.__iter_kept_rows(
+            blobs, set(chunks.name_path), set(chunks.content_hash)
+        )
+        self.df = pd.concat([*kept, chunks], ignore_index=True)
+        logging.info(f"Chunks added, reused and removed: {self.report}")
 
         if debug_mode:
             for i, content in self.df.iterrows():
@@ -81,9 +328,146 @@ class VectorStore:
                 logging.debug(content.content)
 
         logging.info("Embeddings Generated!!!")
+
+        if self.embedding_cache is not None:
+            logging.info(f"Embedding cache: {self.embedding_cache.stats()}")
+
+        # the lexical index of the hybrid search, saved next to the parquet file
+        self.bm25_index = BM25Index(
+            self.df.content, fingerprint=get_store_fingerprint(self.df)
+        )
         logging.info("Vectorstore generated in memory!")
         return self.df
 
+    def __write_empty(self, path: str, tmp_path: str) -> bool:
+        """
+        Write an empty store in `tmp_path` with the schema of the previous store.
+
+        Returns:
+            bool: False if there is no previous store to replace.
+        """
+        if self.__previous_file is not None:
+            table = self.__previous_file.schema_arrow.empty_table()
+        elif self.previous is not None:
+            table = pa.Table.from_pandas(self.previous.iloc[:0], preserve_index=False)
+        elif os.path.exists(path):
+            table = pq.read_schema(path).empty_table()
+        else:
+            return False
+
+        pq.write_table(table, tmp_path)
+        return True
+
+    def stream_vector_store(
+        self,
+        dfs: Iterable[pd.DataFrame],
+        file_name: str,
+        blobs: pd.DataFrame = None,
+        batch_size: int = 512,
+    ) -> str:
+        """
+        Create the vector store from a stream of documents, appended to a parquet file.
+
+        The chunks are embedded in batches of about `batch_size` rows, and every batch
+        is written to the file before the next documents are requested, so the memory
+        used is bounded by the batch size instead of the corpus size. The file is
+        written under a temporary name and replaces `file_name` when it is complete.
+
+        Args:
+            dfs (Iterable[pd.DataFrame]): Documents with a 'content' column of split
+                texts, for example the output of TextSplitter.iter_documents.
+            file_name (str): The name of the output file in the data folder.
+            blobs (pd.DataFrame, optional): The current blobs, used to drop the rows of
+                deleted blobs from the previous store. Default is None.
+            batch_size (int, optional): The chunks embedded and written at a time.
+                Default is 512.
+
+        Returns:
+            str: The path of the saved vector store.
+        """
+        embedding_connection()
+        path = get_file_full_path(file_name)
+        tmp_path = path + ".tmp"
+        writer = None
+        buffer = []
+        buffered = 0
+        loaded_names = set()
+        new_hashes = set()
+        written_empty = False
+
+        def write(df: pd.DataFrame):
+            nonlocal writer
+
+            if writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            else:
+                table = pa.Table.from_pandas(
+                    df[writer.schema.names], schema=writer.schema, preserve_index=False
+                )
+
+            writer.write_table(table)
+
+        def flush():
+            nonlocal buffer, buffered
+            chunks = self.__embed_chunks(pd.concat(buffer, ignore_index=True))
+            new_hashes.update(chunks.content_hash)
+            write(chunks)
+            logging.info(
+                f"{self.report['added'] + self.report['reused']} chunks written"
+            )
+            buffer, buffered = [], 0
+
+        logging.info("Generating embeddings...")
+
+        try:
+            for df in dfs:
+                loaded_names.update(df.name_path)
+                buffer.append(df)
+                buffered += int(df.content.str.len().sum())
+
+                if buffered >= batch_size:
+                    flush()
+
+            if buffer:
+                flush()
+
+            for kept in self.__iter_kept_rows(blobs, loaded_names, new_hashes):
+                write(kept)
+
+            if writer is None:
+                # an empty store replaces the old one, its documents were deleted
+                logging.info("There are no documents, the vectorstore is empty")
+                written_empty = self.__write_empty(path, tmp_path)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is None and not written_empty:
+            return path
+
+        if self.__previous_file is not None:
+            self.__previous_file.close()
+
+        os.replace(tmp_path, path)
+        logging.info(f"Chunks added, reused and removed: {self.report}")
+        logging.info(f"Vectorstore saved in {path}")
+        # the store is read by batches, only the postings are kept in memory
+        parquet = pq.ParquetFile(path)
+        columns = [
+            col for col in FINGERPRINT_COLUMNS if col in parquet.schema_arrow.names
+        ]
+        fingerprint = get_store_fingerprint(
+            batch.to_pandas() for batch in parquet.iter_batches(columns=columns)
+        )
+        batches = parquet.iter_batches(columns=["content"])
+        self.bm25_index = BM25Index(
+            (text for batch in batches for text in batch.column("content").to_pylist()),
+            fingerprint=fingerprint,
+        )
+        self.bm25_index.save(os.path.splitext(path)[0])
+        return path
+
     def save_vector_store(self, file_name):
         """
         Save the vector store to a parquet file.
@@ -100,3 +484,6 @@ class VectorStore:
         csv_path = os.path.join(data_folder_path, csv_filename)
         self.df.to_parquet(csv_path)
         logging.info(f"Vectorstore saved in {csv_path}")
+
+        if self.bm25_index is not None:
+            self.bm25_index.save(os.path.splitext(csv_path)[0])
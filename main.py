@@ -1,5 +1,8 @@
+import asyncio
 import logging
+import os
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 from load_transform_data.loader_blob_storage import (
     AzureBlobStorageDocumentLoader,
@@ -7,92 +10,200 @@ from load_transform_data.loader_blob_storage import (
 from load_transform_data.splitters import TextSplitter
 from load_transform_data.vectorstore import VectorStore
 from load_transform_data.similarities_searcher import SimilaritiesContextSearcher
-from openai_api_connection.api_conection import (
-    connect_api,
-    get_completion_from_messages,
+from load_transform_data.embedding_cache import EmbeddingCache
+from load_transform_data.response_cache import ResponseCache
+from load_transform_data.metrics import metrics
+from load_transform_data.mmap_store import (
+    convert_parquet_to_mmap_store,
+    is_mmap_store_outdated,
+    load_mmap_index,
+    load_mmap_store,
 )
+from load_transform_data.ivf_index import IVFIndex
+from load_transform_data.bm25_index import BM25Index
+from load_transform_data.partition_map import PartitionMap
+from load_transform_data.quantized_index import QuantizedIndex
+from load_transform_data.sharded_index import ShardedIndex
+from openai_api_connection.api_conection import connect_api
+from openai_api_connection.async_client import AsyncAzureOpenAIClient
+from openai_api_connection.history_manager import HistoryManager
 from prompts.paper_assistent import CONTEXT, CHECK_IF_ONLY_HELLO
 import gradio as gr
 import time
-import signal
-from openai_api_connection.api_conection import get_completion_from_messages
-from load_transform_data.utils import get_azure_primary_key, get_file_full_path
+from load_transform_data.utils import (
+    get_azure_primary_key,
+    get_file_full_path,
+    get_store_fingerprint,
+)
 import sys
 
 # Set the logging configuration
 logging.basicConfig(level=logging.INFO)
+# "int8" or "float16" to keep the embeddings quantized in memory, None for float32
+QUANTIZATION = None
+# simultaneous conversations served by the event loop
+CHAT_CONCURRENCY = 64
+# reuse the answers of near-identical first questions with the same context
+RESPONSE_CACHE = False
+# port of the Prometheus text of the stage histograms, None to disable it
+METRICS_PORT = None
+# interface of the metrics endpoint, "0.0.0.0" exposes it outside this machine
+METRICS_HOST = "127.0.0.1"
+# seconds a conversation can last, and can wait between two questions
+SESSION_TOTAL_TIME = 3600
+USER_DELAY_TIME = 600
+# minimum cosine similarity of the chunks used as context
+CONTEXT_THRESHOLD = 0.8
+# "hybrid" fuses the BM25 and the embeddings rankings, "dense" only the embeddings
+SEARCH_MODE = "dense"
+# shards of the exact search scanned in parallel, None for one per CPU, 1 to disable.
+# It pays off above a few hundred thousand chunks, with OPENBLAS_NUM_THREADS=1
+SEARCH_SHARDS = 1
 
 
-def create_and_save_vectorstore():
+def create_and_save_vectorstore(incremental: bool = True, streaming: bool = True):
     splitter = TextSplitter(tokens_per_document=600, overlap=40)
     azure_key = get_azure_primary_key()
     loader = AzureBlobStorageDocumentLoader(azure_key)
-    df = loader.load_document()
-    df = splitter.generate_documents(df)
-    logging.debug(df.head())
-    vectorstore = VectorStore(df)
-    df = vectorstore.create_vector_store()
-    logging.debug(df.head())
-    vectorstore.save_vector_store("vectorstore.parquet")
+    filepath = get_file_full_path("vectorstore.parquet")
+    previous = None
+    previous_path = None
+
+    if incremental and os.path.exists(filepath):
+        # only the metadata, the old embeddings are read from the file when needed
+        previous = VectorStore.read_previous(filepath)
+        previous_path = filepath
+
+    blobs = loader.list_blobs()
+    changed_blobs = VectorStore.get_changed_blobs(previous, blobs)
+    logging.info(f"{len(changed_blobs)}/{len(blobs)} blobs changed")
+    embedding_cache = EmbeddingCache(get_file_full_path("embedding_cache.sqlite"))
+
+    if streaming:
+        # pages, chunks and embeddings flow in batches, bounded memory
+        documents = splitter.iter_documents(loader.iter_documents(changed_blobs))
+        vectorstore = VectorStore(
+            embedding_cache=embedding_cache,
+            previous=previous,
+            previous_path=previous_path,
+        )
+        vectorstore.stream_vector_store(documents, "vectorstore.parquet", blobs)
+    else:
+        df = loader.load_document(changed_blobs)
+        df = splitter.generate_documents(df)
+        logging.debug(df.head())
+        vectorstore = VectorStore(
+            df,
+            embedding_cache=embedding_cache,
+            previous=previous,
+            previous_path=previous_path,
+        )
+        df = vectorstore.create_vector_store(blobs)
+        logging.debug(df.head())
+        vectorstore.save_vector_store("vectorstore.parquet")
+
+    store_path = convert_parquet_to_mmap_store(filepath)
+
+    if IVFIndex.exists(store_path):
+        # the lists of the old rows do not match the new store
+        IVFIndex.rebuild(store_path)
+
+    metrics.dump_json(get_file_full_path("build_metrics.json"))
     loaded_df = pd.read_parquet("./data/vectorstore.parquet")
     print(loaded_df)
 
 
-def check_user_time_between_questions(delay_time: float):
+def check_user_time_between_questions(session: dict, delay_time: float):
+    # the limits apply to this conversation only, the others keep running
+    session_time = time.time() - session.setdefault("time_start", time.time())
+
     if delay_time > USER_DELAY_TIME:
         logging.info("User has abandoned the chat")
-        chat.close()
-        exit()
+        session["expired"] = True
+    elif session_time > SESSION_TOTAL_TIME:
+        logging.info("Time's up! Finishing the session.")
+        session["expired"] = True
 
+    if session.get("expired"):
+        raise gr.Error("Session finished, reload the page to start again")
 
-def chatbot(message, history):
-    global time_response
-    time_request = time.time()
-    delay_user = time_request - time_response
 
-    # this is for avoid hallucination in references
-    if history:
-        split_last_assistant_message = history[-1][1].split("\n\n`References:`")
-        # there exist references
-        new_join = "".join(split_last_assistant_message[:-1])
-
-        # there not exist references
-        if not new_join:
-            new_join = "".join(split_last_assistant_message)
-
-        history[-1][1] = new_join
+async def chatbot(message, history, session):
+    loop = asyncio.get_running_loop()
+    time_request = time.time()
+    delay_user = time_request - session.get("time_response", time_request)
 
     if len(history) < 1:
         delay_user = 0
 
-    check_user_time_between_questions(delay_user)
+    check_user_time_between_questions(session, delay_user)
     logging.info(delay_user)
-    similarity_searcher.get_dataframe_top_similarities(
-        df, message, top_n=5
+    result = await similarity_searcher.aget_dataframe_top_similarities(
+        df, message, openai_client, top_n=5, executor=search_executor
+    )
+    text, pages = await loop.run_in_executor(
+        search_executor,
+        similarity_searcher.get_context_and_references,
+        result,
+        CONTEXT_THRESHOLD,
+    )
+    # the recent turns within the budget, the older ones are in the summary
+    history_openai = history_manager.build_messages(
+        CONTEXT.format(information=text), history, message, session
     )
-    text, pages = similarity_searcher.get_context_and_references()
-    # delete the previous request
-    history_openai = [{"role": "system", "content": CONTEXT.format(information=text)}]
-    logging.info("system context created correctly")
+    logging.info("History loaded")
+    # only the first question, the next ones depend on the conversation
+    use_cache = response_cache is not None and not history
+    response = None
 
-    for user, assistant in history:
-        history_openai.append({"role": "user", "content": user})
-        history_openai.append({"role": "assistant", "content": assistant})
+    if use_cache:
+        context_hash = ResponseCache.hash_context(text)
+        response = await loop.run_in_executor(
+            search_executor, response_cache.lookup, result.query_embedding, context_hash
+        )
+        logging.info(f"Response cache {response_cache.stats()}")
+
+    if response is not None:
+        session["time_response"] = time.time()
+        yield response
+    else:
+        logging.info("writing in the chat...")
+        response = ""
+        start = time.perf_counter()
+        first_token = None
+
+        async for delta in openai_client.stream_completion(history_openai):
+            if first_token is None:
+                first_token = time.perf_counter()
+                metrics.observe("completion_first_token", first_token - start)
+
+            response += delta
+            session["time_response"] = time.time()
+            yield response
+
+        end = time.perf_counter()
+        metrics.observe("completion_total", end - start)
+
+        if first_token is not None:
+            metrics.observe("streaming", end - first_token)
+
+        if use_cache:
+            await loop.run_in_executor(
+                search_executor,
+                response_cache.store,
+                message,
+                result.query_embedding,
+                context_hash,
+                response,
+            )
 
-    history_openai.append({"role": "user", "content": message})
-    logging.info("History loaded")
-    response = get_completion_from_messages(history_openai)
     logging.info("response generated")
+    history_manager.schedule_summary(history + [[message, response]], session)
 
     if pages != "null":
         response += f"\n\n`References:`\n{pages}"
-
-    logging.info("writing in the chat...")
-
-    for i in range(len(response)):
-        time.sleep(0.005)
-        time_response = time.time()
-        yield response[: i + 1]
+        session["time_response"] = time.time()
+        yield response
 
 
 def run_chatbot():
@@ -100,13 +211,14 @@ def run_chatbot():
     chat_interface = gr.ChatInterface(
         chatbot,
         chatbot=gr.Chatbot(height=500),
+        # per-conversation state, every browser session gets its own copy
+        additional_inputs=[gr.State({})],
         textbox=gr.Textbox(
             placeholder="Ask me about Lang Chain", container=False, scale=9
         ),
         title="Lang Chain Professor",
         description="AI",
         theme=my_theme,
-        examples=[""],
         submit_btn="Submit",
         stop_btn="Stop",
         retry_btn=None,
@@ -116,23 +228,92 @@ def run_chatbot():
     return chat_interface
 
 
-def handler(signum, frame):
-    logging.info("Time's up! Terminating the process.")
-    gr.Info("Session finished")
-    exit()
+def init_chatbot(
+    openai_client_: AsyncAzureOpenAIClient = None,
+    embedding_cache_path: str = get_file_full_path("embedding_cache.sqlite"),
+    use_response_cache: bool = RESPONSE_CACHE,
+):
+    """
+    Load the vectorstore and create the resources shared by all the conversations.
 
+    Parameters
+    ----------
+    openai_client_ : AsyncAzureOpenAIClient, optional
+        The client of the chat requests. Default is a client of the environment
+        endpoint.
+    embedding_cache_path : str, optional
+        The SQLite file of the query embeddings, None to keep them only in memory.
+    use_response_cache : bool, optional
+        Whether to reuse the answers of similar first questions.
+        Default is RESPONSE_CACHE.
+    """
+    global df, similarity_searcher, response_cache, openai_client
+    global search_executor, history_manager
+    filepath = get_file_full_path("vectorstore.parquet")
+    store_path = get_file_full_path("vectorstore")
 
-# create_and_save_vectorstore()
-# Set the alarm to 1 minute (60 seconds)
-signal.signal(signal.SIGALRM, handler)
-filename = "vectorstore.parquet"
-filepath = get_file_full_path(filename)
-df = pd.read_parquet(filepath)
-SESSION_TOTAL_TIME = 3600
-USER_DELAY_TIME = 600
-signal.alarm(SESSION_TOTAL_TIME)
-connect_api()
-similarity_searcher = SimilaritiesContextSearcher()
-time_response = time.time()
-chat = run_chatbot()
-chat.queue().launch(share=True)
+    if is_mmap_store_outdated(filepath, store_path):
+        convert_parquet_to_mmap_store(filepath, store_path)
+
+    if IVFIndex.exists(store_path) and IVFIndex.is_outdated(store_path):
+        IVFIndex.rebuild(store_path)
+
+    # the embeddings stay in the mapped file, df only has the text and metadata
+    if IVFIndex.exists(store_path):
+        df, matrix = load_mmap_store(store_path)
+        index = IVFIndex.load(store_path, df, matrix=matrix)
+    elif QUANTIZATION is not None:
+        # quantized codes in memory, the mapped matrix is only read to rescore
+        df, matrix = load_mmap_store(store_path)
+        index = QuantizedIndex(df, matrix=matrix, dtype=QUANTIZATION)
+    elif SEARCH_SHARDS != 1:
+        # the exact scan split across the cores, it only pays off on big stores
+        df, matrix = load_mmap_store(store_path)
+        index = ShardedIndex(df, matrix=matrix, n_shards=SEARCH_SHARDS)
+    else:
+        index = load_mmap_index(store_path)
+        df = index.df
+
+    bm25_index = None
+    # the same number of rows is not enough, the chunks may have been replaced
+    fingerprint = get_store_fingerprint(df)
+
+    if SEARCH_MODE == "hybrid":
+        if BM25Index.exists(store_path):
+            bm25_index = BM25Index.load(store_path)
+
+        if bm25_index is None or bm25_index.fingerprint != fingerprint:
+            bm25_index = BM25Index(df.content, fingerprint=fingerprint)
+            bm25_index.save(store_path)
+
+    embedding_cache = EmbeddingCache(embedding_cache_path)
+    similarity_searcher = SimilaritiesContextSearcher(
+        index,
+        embedding_cache=embedding_cache,
+        mode=SEARCH_MODE,
+        bm25_index=bm25_index,
+        min_similarity=CONTEXT_THRESHOLD,
+        # row ranges of every PDF, for the searches filtered by document or page
+        partition_map=PartitionMap(df, fingerprint=fingerprint),
+    )
+    response_cache = None
+
+    if use_response_cache:
+        response_cache = ResponseCache(get_file_full_path("response_cache.sqlite"))
+
+    # one pooled client and one scoring pool shared by all the conversations
+    openai_client = openai_client_ or AsyncAzureOpenAIClient()
+    search_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    history_manager = HistoryManager(openai_client.get_completion)
+
+
+if __name__ == "__main__":
+    # create_and_save_vectorstore()
+    connect_api()
+    init_chatbot()
+
+    if METRICS_PORT is not None:
+        metrics.start_http_server(METRICS_PORT, host=METRICS_HOST)
+
+    chat = run_chatbot()
+    chat.queue(default_concurrency_limit=CHAT_CONCURRENCY).launch(share=True)
@@ -1,7 +1,8 @@
 import os
 import openai
-import requests
 import logging
+from typing import Iterator
+from openai_api_connection.http_client import get_default_client
 
 
 def embedding_connection():
@@ -9,10 +10,11 @@ def embedding_connection():
     openai.api_type = "azure"
     openai.api_base = os.getenv("OPENAI_API_BASE")
     openai.api_key = api_key
-    openai.api_version = "2022-12-01"
-    url = openai.api_base + "/openai/deployments?api-version=2022-12-01"
-
-    r = requests.get(url, headers={"api-key": api_key})
+    # batched inputs in the embeddings endpoint need at least this version
+    openai.api_version = "2023-05-15"
+    # the first request opens the pooled connection that the embeddings reuse
+    deployments = get_default_client().get_deployments()
+    logging.info(f"Deployments available: {deployments}")
 
 
 def connect_api(
@@ -35,6 +37,7 @@ def connect_api(
     logging.info("Set credentials correctly")
     openai.api_type = api_type
     openai.api_version = api_version
+    get_default_client().chat_api_version = api_version
 
 
 def get_completion_from_messages(
@@ -70,8 +73,66 @@ def get_completion_from_messages(
     str
         The model-generated message in response to the user prompt.
     """
-    response = openai.ChatCompletion.create(
-        engine=engine, model=model, messages=messages, temperature=temperature
+    return get_default_client().create_chat_completion(
+        messages, engine=engine, temperature=temperature
+    )
+
+
+def stream_completion_from_messages(
+    messages: list,
+    model: str = "gpt-3.5-turbo",
+    engine: str = "cx_gpt4",
+    temperature: float = 0,
+) -> Iterator[str]:
+    """
+    Stream the model-generated message as the tokens arrive.
+
+    Same as get_completion_from_messages, but the request is made with
+    `stream=True` and the text is yielded in pieces, so the first words can be
+    shown while the rest of the answer is generated.
+
+    Parameters
+    ----------
+    messages : list
+        messages for which the model will generate a response.
+    model : str, optional
+        The name of the chat model to use for generating the response.
+        Default is "gpt-3.5-turbo".
+    engine: str, optional
+        The name of the deployment model in azure
+        Default is "cx_gpt4"
+    temperature: float, optional
+        The randomness of the output response, the value is between 0 and 1
+        Default is 0, for more predictable response
+
+    Yields
+    ------
+    str
+        The next piece (delta) of the model-generated message.
+    """
+    yield from get_default_client().stream_chat_completion(
+        messages, engine=engine, temperature=temperature
     )
 
-    return response.choices[0].message.get("content")
+
+def get_embedding(text: str, engine: str = "testCX_2") -> list:
+    """
+    Get the embedding of a text.
+
+    Same signature as openai.embeddings_utils.get_embedding, but the request goes
+    through the pooled client, with its timeouts and retries.
+
+    Parameters
+    ----------
+    text : str
+        The text to embed.
+    engine: str, optional
+        The name of the embedding deployment in azure
+        Default is "testCX_2"
+
+    Returns
+    -------
+    list
+        The embedding of the text.
+    """
+    return get_default_client().create_embeddings([text.replace("\n", " ")], engine)[0]
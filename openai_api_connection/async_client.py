@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+
+from openai_api_connection.http_client import (
+    AzureOpenAIError,
+    RetryPolicy,
+    parse_stream_line,
+)
+
+
+class AsyncAzureOpenAIClient:
+    """
+    An asyncio client for the Azure OpenAI embeddings and chat completions endpoints.
+
+    All the requests share one aiohttp session, so the connections are pooled and
+    kept alive between the chat sessions. The session is created on the first
+    request, in the event loop that serves the chat. As in AzureOpenAIHttpClient,
+    the requests have connect and read timeouts, are retried with RetryPolicy and
+    at most `max_in_flight` run at the same time.
+    Usage:
+    client = AsyncAzureOpenAIClient()
+    embedding = await client.get_embedding("What is a chain?")
+    async for delta in client.stream_completion(messages):
+        ...
+    await client.close()
+
+    Args:
+        api_base (str, optional): The Azure endpoint. Defaults to the environment
+            variable OPENAI_API_BASE.
+        api_key (str, optional): The key of the endpoint. Defaults to the environment
+            variable OPENAI_API_KEY.
+        embeddings_api_version (str, optional): Defaults to "2023-05-15".
+        chat_api_version (str, optional): Defaults to "2023-03-15-preview".
+        max_connections (int, optional): The size of the connection pool.
+            Defaults to 100.
+        max_in_flight (int, optional): The requests at the same time. Defaults to 100.
+        connect_timeout (float, optional): Seconds to connect. Defaults to 5.
+        read_timeout (float, optional): Seconds without receiving data, it is also the
+            limit between the chunks of a streamed completion. Defaults to 60.
+        retry_policy (RetryPolicy, optional): Defaults to RetryPolicy().
+    """
+
+    def __init__(
+        self,
+        api_base: str = None,
+        api_key: str = None,
+        embeddings_api_version: str = "2023-05-15",
+        chat_api_version: str = "2023-03-15-preview",
+        max_connections: int = 100,
+        max_in_flight: int = 100,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        retry_policy: RetryPolicy = None,
+    ):
+        self.api_base = (api_base or os.getenv("OPENAI_API_BASE", "")).rstrip("/")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.embeddings_api_version = embeddings_api_version
+        self.chat_api_version = chat_api_version
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.__session = None
+        self.__lock = asyncio.Lock()
+        self.__slots = asyncio.Semaphore(max_in_flight)
+
+    async def __get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared session, creating it in the running loop the first time.
+        """
+        if self.__session is None or self.__session.closed:
+            async with self.__lock:
+                if self.__session is None or self.__session.closed:
+                    connector = aiohttp.TCPConnector(limit=self.max_connections)
+                    self.__session = aiohttp.ClientSession(
+                        connector=connector, headers={"api-key": self.api_key}
+                    )
+                    logging.info("Async OpenAI session created")
+
+        return self.__session
+
+    def __url(self, engine: str, operation: str, api_version: str) -> str:
+        return (
+            f"{self.api_base}/openai/deployments/{engine}/{operation}"
+            f"?api-version={api_version}"
+        )
+
+    def stats(self) -> dict:
+        """
+        Get the request counters and the in-flight requests.
+        """
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "max_in_flight": self.max_in_flight,
+        }
+
+    @asynccontextmanager
+    async def __post(
+        self, url: str, payload: dict
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Send a request with retries and hold its in-flight place until the block ends.
+
+        A streamed body is read inside the block, a failure in the middle of it is
+        not retried.
+        """
+        session = await self.__get_session()
+        max_retries = self.retry_policy.max_retries
+
+        for attempt in range(max_retries + 1):
+            async with self.__slots:
+                self.in_flight += 1
+                self.requests += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+                try:
+                    response = await session.post(
+                        url, json=payload, timeout=self.timeout
+                    )
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                    if attempt == max_retries:
+                        raise
+
+                    reason = type(error).__name__
+                    retry_after = None
+                else:
+                    if response.status < 400:
+                        try:
+                            yield response
+                        finally:
+                            response.release()
+                        return
+
+                    retry_after = RetryPolicy.parse_retry_after(
+                        response.headers.get("Retry-After")
+                    )
+                    error = AzureOpenAIError(
+                        response.status, await response.text(), retry_after
+                    )
+                    response.release()
+
+                    if not error.retryable or attempt == max_retries:
+                        raise error
+
+                    reason = error.status
+                finally:
+                    self.in_flight -= 1
+
+            delay = self.retry_policy.get_delay(attempt, retry_after)
+            logging.warning(
+                f"Azure OpenAI request failed ({reason}), retry in {delay:.1f}s"
+            )
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def get_embedding(self, text: str, engine: str = "testCX_2") -> list:
+        """
+        Get the embedding of a text.
+
+        Args:
+            text (str): The text to embed.
+            engine (str, optional): The embedding deployment. Defaults to "testCX_2".
+
+        Returns:
+            list: The embedding.
+        """
+        url = self.__url(engine, "embeddings", self.embeddings_api_version)
+        payload = {"input": [text.replace("\n", " ")]}
+
+        async with self.__post(url, payload) as response:
+            data = await response.json()
+
+        return data["data"][0]["embedding"]
+
+    async def get_completion(
+        self,
+        messages: list,
+        engine: str = "cx_gpt4",
+        temperature: float = 0,
+    ) -> str:
+        """
+        Get the model-generated message of a chat in a single response.
+
+        Args:
+            messages (list): The messages for which the model generates a response.
+            engine (str, optional): The chat deployment. Defaults to "cx_gpt4".
+            temperature (float, optional): The randomness of the response.
+                Defaults to 0.
+
+        Returns:
+            str: The model-generated message.
+        """
+        url = self.__url(engine, "chat/completions", self.chat_api_version)
+        payload = {"messages": messages, "temperature": temperature}
+
+        async with self.__post(url, payload) as response:
+            data = await response.json()
+
+        return data["choices"][0]["message"].get("content")
+
+    async def stream_completion(
+        self,
+        messages: list,
+        engine: str = "cx_gpt4",
+        temperature: float = 0,
+    ) -> AsyncIterator[str]:
+        """
+        Stream the model-generated message as the tokens arrive.
+
+        Args:
+            messages (list): The messages for which the model generates a response.
+            engine (str, optional): The chat deployment. Defaults to "cx_gpt4".
+            temperature (float, optional): The randomness of the response.
+                Defaults to 0.
+
+        Yields:
+            str: The next piece (delta) of the model-generated message.
+        """
+        url = self.__url(engine, "chat/completions", self.chat_api_version)
+        payload = {"messages": messages, "temperature": temperature, "stream": True}
+
+        async with self.__post(url, payload) as response:
+            # server-sent events, one "data: {...}" line per chunk
+            async for line in response.content:
+                delta = parse_stream_line(line.decode("utf-8"))
+
+                if delta is StopIteration:
+                    break
+
+                if delta:
+                    yield delta
+
+    async def close(self):
+        """
+        Close the shared session and its connections.
+        """
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
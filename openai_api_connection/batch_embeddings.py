@@ -0,0 +1,249 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import requests
+import tiktoken
+
+from openai_api_connection.http_client import AzureOpenAIError, get_default_client
+
+
+class RateLimiter:
+    """
+    A thread safe limiter for the tokens per minute and requests per minute budgets.
+
+    Both budgets are token buckets refilled continuously. When the API answers with
+    a 429 every caller is paused with `penalize`, so the workers back off together.
+
+    Args:
+        tokens_per_minute (int): The token budget per minute.
+        requests_per_minute (int): The request budget per minute.
+    """
+
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.__tokens = float(tokens_per_minute)
+        self.__requests = float(requests_per_minute)
+        self.__last_refill = time.monotonic()
+        self.__blocked_until = 0.0
+        self.__lock = threading.Lock()
+
+    def __refill(self, now: float):
+        elapsed = now - self.__last_refill
+        self.__last_refill = now
+        self.__tokens = min(
+            self.tokens_per_minute,
+            self.__tokens + elapsed * self.tokens_per_minute / 60,
+        )
+        self.__requests = min(
+            self.requests_per_minute,
+            self.__requests + elapsed * self.requests_per_minute / 60,
+        )
+
+    def acquire(self, tokens: int):
+        """
+        Block until one request of `tokens` tokens fits in both budgets.
+
+        A request bigger than the whole token budget is let through when the bucket
+        is full, otherwise it would wait forever.
+
+        Args:
+            tokens (int): The tokens of the request.
+        """
+        tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__refill(now)
+                wait = self.__blocked_until - now
+
+                if wait <= 0:
+                    if self.__tokens >= tokens and self.__requests >= 1:
+                        self.__tokens -= tokens
+                        self.__requests -= 1
+                        return
+
+                    missing_tokens = max(0.0, tokens - self.__tokens)
+                    missing_requests = max(0.0, 1 - self.__requests)
+                    wait = max(
+                        missing_tokens * 60 / self.tokens_per_minute,
+                        missing_requests * 60 / self.requests_per_minute,
+                    )
+
+            time.sleep(min(max(wait, 0.01), 5.0))
+
+    def penalize(self, delay: float):
+        """
+        Pause every caller for `delay` seconds.
+
+        Args:
+            delay (float): The seconds to wait before the next request.
+        """
+        with self.__lock:
+            self.__blocked_until = max(self.__blocked_until, time.monotonic() + delay)
+
+
+def request_embeddings(texts: list, engine: str) -> list:
+    """
+    Request the embeddings of several texts in a single call to the API.
+
+    The request is not retried by the client, BatchEmbedder retries it after
+    pausing all its workers.
+
+    Parameters
+    ----------
+    texts : list
+        The texts to embed.
+    engine : str
+        The name of the embedding deployment in azure.
+
+    Returns
+    -------
+    list
+        The embeddings, in the same order as the texts.
+    """
+    return get_default_client().create_embeddings(texts, engine, max_retries=0)
+
+
+class BatchEmbedder:
+    """
+    Generate embeddings for many texts with batched and concurrent requests.
+
+    The texts are grouped in batches of `batch_size` inputs, and up to `max_workers`
+    batches are in flight at the same time. Every request waits for the tokens per
+    minute and requests per minute budgets, and a 429 answer pauses all the workers
+    with an exponential backoff before the batch is retried. The embeddings are
+    returned in the order of the input texts.
+    Usage:
+    embedder = BatchEmbedder(batch_size=16, max_workers=4)
+    embeddings = embedder.embed(df["content"].tolist())
+
+    Args:
+        engine (str, optional): The name of the embedding deployment.
+            Default is "testCX_2".
+        batch_size (int, optional): Maximum inputs per request. Default is 16.
+        max_workers (int, optional): Maximum requests in flight. Default is 4.
+        tokens_per_minute (int, optional): Token budget per minute. Default is 240000.
+        requests_per_minute (int, optional): Request budget per minute. Default is 720.
+        max_retries (int, optional): Retries of a batch on 429 or server errors.
+            Default is 8.
+        embedding_cache (EmbeddingCache, optional): A cache checked before requesting
+            and filled with the new embeddings. Default is None.
+        request_function (Callable, optional): Called as request_function(texts, engine)
+            to embed a batch, it allows using a stub server or a fake. Default is
+            request_embeddings.
+    """
+
+    def __init__(
+        self,
+        engine: str = "testCX_2",
+        batch_size: int = 16,
+        max_workers: int = 4,
+        tokens_per_minute: int = 240_000,
+        requests_per_minute: int = 720,
+        max_retries: int = 8,
+        embedding_cache=None,
+        request_function: Callable = request_embeddings,
+    ):
+        if batch_size < 1 or max_workers < 1:
+            raise ValueError("batch_size and max_workers have to be >= 1")
+
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.embedding_cache = embedding_cache
+        self.request_function = request_function
+        self.rate_limiter = RateLimiter(tokens_per_minute, requests_per_minute)
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.__done = 0
+        self.__total = 0
+        self.__lock = threading.Lock()
+
+    def __request_batch(self, texts: list) -> list:
+        """
+        Embed one batch, waiting for the budgets and retrying on 429 and 5xx.
+        """
+        tokens = sum(len(tokens) for tokens in self.encoding.encode_batch(texts))
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+
+            try:
+                embeddings = self.request_function(texts, engine=self.engine)
+                break
+            except (
+                AzureOpenAIError,
+                requests.ConnectionError,
+                requests.Timeout,
+            ) as error:
+                retryable = getattr(error, "retryable", True)
+
+                if not retryable or attempt == self.max_retries:
+                    raise
+
+                delay = getattr(error, "retry_after", None)
+
+                if delay is None:
+                    delay = min(60.0, 2**attempt) * (0.5 + random.random() / 2)
+
+                logging.warning(
+                    f"Embedding request failed ({error}), retry in {delay:.1f}s"
+                )
+                self.rate_limiter.penalize(delay)
+
+        with self.__lock:
+            self.__done += len(texts)
+            logging.info(f"{self.__done}/{self.__total}")
+
+        return embeddings
+
+    def embed(self, texts: list) -> list:
+        """
+        Get the embeddings of the texts, keeping their order.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: One embedding per text, in the same order.
+        """
+        embeddings = [None] * len(texts)
+        pending = []
+
+        for i, text in enumerate(texts):
+            if self.embedding_cache is not None:
+                embeddings[i] = self.embedding_cache.get(text, self.engine)
+
+            if embeddings[i] is None:
+                pending.append(i)
+
+        logging.info(f"{len(texts) - len(pending)} embeddings reused from the cache")
+        batches = [
+            pending[i : i + self.batch_size]
+            for i in range(0, len(pending), self.batch_size)
+        ]
+        self.__done = 0
+        self.__total = len(pending)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(
+                lambda batch: self.__request_batch(
+                    [texts[i].replace("\n", " ") for i in batch]
+                ),
+                batches,
+            )
+
+            for batch, batch_embeddings in zip(batches, results):
+                for i, embedding in zip(batch, batch_embeddings):
+                    embeddings[i] = embedding
+
+                    if self.embedding_cache is not None:
+                        self.embedding_cache.put(texts[i], self.engine, embedding)
+
+        return embeddings
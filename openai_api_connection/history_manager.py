@@ -0,0 +1,183 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+import tiktoken
+
+from prompts.paper_assistent import SUMMARIZE_HISTORY
+
+REFERENCES_SEPARATOR = "\n\n`References:`"
+
+
+class HistoryManager:
+    """
+    Keep the conversation sent to the model within a token budget.
+
+    The most recent turns are kept while their tokens, counted with `tiktoken`, fit
+    in `max_history_tokens`. The older turns are folded into a rolling summary that
+    is sent as a system message. The summary is updated in a background task after
+    a response, so a question never waits for it, it uses the summary available.
+    The state of a conversation (the summary, the turns it covers and the running
+    task) is kept in the `session` dict of the chat.
+    Usage:
+    history_manager = HistoryManager(client.get_completion)
+    messages = history_manager.build_messages(system, history, message, session)
+    history_manager.schedule_summary(history + [[message, response]], session)
+
+    Args:
+        summarize_function (Callable): An async function called with the messages of
+            the summary request that returns the summary.
+        max_history_tokens (int, optional): The token budget of the recent turns.
+            Default is 2000.
+        summary_max_words (int, optional): The length asked for the summary.
+            Default is 200.
+        encoding_name (str, optional): The tiktoken encoding of the chat model.
+            Default is "cl100k_base".
+    """
+
+    # tokens added by the chat format to every message
+    TOKENS_PER_MESSAGE = 4
+
+    def __init__(
+        self,
+        summarize_function: Callable[[list], Awaitable[str]],
+        max_history_tokens: int = 2000,
+        summary_max_words: int = 200,
+        encoding_name: str = "cl100k_base",
+    ):
+        self.summarize_function = summarize_function
+        self.max_history_tokens = max_history_tokens
+        self.summary_max_words = summary_max_words
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    @staticmethod
+    def strip_references(answer: str) -> str:
+        """
+        Remove the references added to an answer for the user, the model should not
+        repeat them from the history.
+        """
+        return answer.split(REFERENCES_SEPARATOR)[0]
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a message with the given content.
+        """
+        return (
+            len(self.encoding.encode(text, disallowed_special=()))
+            + self.TOKENS_PER_MESSAGE
+        )
+
+    def split_history(self, history: list) -> tuple[list, list]:
+        """
+        Split the turns in the older ones and the recent ones that fit in the budget.
+
+        Args:
+            history (list): The [user, assistant] turns of the conversation.
+
+        Returns:
+            tuple[list, list]: The older turns and the recent turns, the answers
+                without references.
+        """
+        turns = [
+            [user, self.strip_references(assistant)] for user, assistant in history
+        ]
+        used = 0
+        first_recent = len(turns)
+
+        for i in range(len(turns) - 1, -1, -1):
+            user, assistant = turns[i]
+            used += self.count_tokens(user) + self.count_tokens(assistant)
+
+            if used > self.max_history_tokens:
+                break
+
+            first_recent = i
+
+        return turns[:first_recent], turns[first_recent:]
+
+    def build_messages(
+        self, system_content: str, history: list, message: str, session: dict
+    ) -> list:
+        """
+        Build the messages of a request with the summary and the recent turns.
+
+        Args:
+            system_content (str): The system message with the retrieved context.
+            history (list): The [user, assistant] turns of the conversation.
+            message (str): The new question of the user.
+            session (dict): The state of the conversation.
+
+        Returns:
+            list: The messages for the chat model.
+        """
+        older, recent = self.split_history(history)
+        messages = [{"role": "system", "content": system_content}]
+        summary = session.get("summary")
+
+        if older and summary:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation: {summary}",
+                }
+            )
+
+        for user, assistant in recent:
+            messages.append({"role": "user", "content": user})
+            messages.append({"role": "assistant", "content": assistant})
+
+        messages.append({"role": "user", "content": message})
+        logging.info(f"{len(recent)}/{len(history)} turns in the history")
+        return messages
+
+    def schedule_summary(self, history: list, session: dict):
+        """
+        Start updating the summary in the background if there are new older turns.
+
+        Only one update runs at a time per conversation, the turns that are left
+        are summarized after the next response.
+
+        Args:
+            history (list): The [user, assistant] turns including the last response.
+            session (dict): The state of the conversation.
+        """
+        task = session.get("summary_task")
+
+        if task is not None and not task.done():
+            return
+
+        older, _ = self.split_history(history)
+        summarized_turns = session.get("summarized_turns", 0)
+
+        if len(older) <= summarized_turns:
+            return
+
+        session["summary_task"] = asyncio.create_task(
+            self.__update_summary(older[summarized_turns:], len(older), session)
+        )
+
+    async def __update_summary(self, turns: list, summarized_turns: int, session: dict):
+        """
+        Fold some turns into the summary of the conversation.
+        """
+        conversation = "\n".join(
+            f"User: {user}\nAssistant: {assistant}" for user, assistant in turns
+        )
+        prompt = SUMMARIZE_HISTORY.format(
+            summary=session.get("summary", ""),
+            conversation=conversation,
+            max_words=self.summary_max_words,
+        )
+
+        try:
+            summary = await self.summarize_function(
+                [{"role": "user", "content": prompt}]
+            )
+        except Exception:
+            # the turns are summarized again after the next response
+            logging.exception("The summary of the history could not be updated")
+            return
+
+        session["summary"] = summary
+        session["summarized_turns"] = summarized_turns
+        logging.info(f"{summarized_turns} turns summarized")
@@ -0,0 +1,393 @@
+import email.utils
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class AzureOpenAIError(Exception):
+    """
+    An error answer of the Azure OpenAI API.
+
+    Args:
+        status (int): The HTTP status.
+        message (str): The body of the answer.
+        retry_after (float, optional): The seconds of the Retry-After header.
+    """
+
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RetryPolicy.RETRY_STATUSES
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter that honors the Retry-After of the server.
+
+    Args:
+        max_retries (int, optional): Retries after the first attempt. Default is 6.
+        base_delay (float, optional): The maximum delay of the first retry, doubled
+            on every retry. Default is 0.5.
+        max_delay (float, optional): The maximum delay of a retry. Default is 30.
+    """
+
+    RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+    def __init__(
+        self, max_retries: int = 6, base_delay: float = 0.5, max_delay: float = 30
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def parse_retry_after(value: str):
+        """
+        Get the seconds of a Retry-After header, given in seconds or as an HTTP date.
+        """
+        if not value:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        return max(0.0, date.timestamp() - time.time())
+
+    def get_delay(self, attempt: int, retry_after: float = None) -> float:
+        """
+        Get the seconds to wait before the retry number `attempt` (starting at 0).
+
+        The Retry-After of the server is respected, with a small jitter so the
+        clients that were rejected together do not retry together.
+        """
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class AzureOpenAIHttpClient:
+    """
+    A thread safe client of the Azure OpenAI REST API over a pooled keep-alive session.
+
+    All the requests share one requests.Session, so the TCP and TLS connections
+    are reused. Every request has a connect and a read timeout, the connection
+    errors and the 408, 429 and 5xx answers are retried with RetryPolicy, and at
+    most `max_in_flight` requests run at the same time, the next ones wait.
+    Usage:
+    client = get_default_client()
+    embeddings = client.create_embeddings(texts, engine="testCX_2")
+    answer = client.create_chat_completion(messages, engine="cx_gpt4")
+
+    Args:
+        api_base (str, optional): The Azure endpoint. Defaults to the environment
+            variable OPENAI_API_BASE.
+        api_key (str, optional): The key of the endpoint. Defaults to the environment
+            variable OPENAI_API_KEY.
+        embeddings_api_version (str, optional): Defaults to "2023-05-15".
+        chat_api_version (str, optional): Defaults to "2023-03-15-preview".
+        pool_size (int, optional): The connections kept alive. Defaults to 32.
+        max_in_flight (int, optional): The requests at the same time. Defaults to 32.
+        connect_timeout (float, optional): Seconds to connect. Defaults to 5.
+        read_timeout (float, optional): Seconds without receiving data, it is also the
+            limit between the chunks of a streamed completion. Defaults to 60.
+        retry_policy (RetryPolicy, optional): Defaults to RetryPolicy().
+    """
+
+    def __init__(
+        self,
+        api_base: str = None,
+        api_key: str = None,
+        embeddings_api_version: str = "2023-05-15",
+        chat_api_version: str = "2023-03-15-preview",
+        pool_size: int = 32,
+        max_in_flight: int = 32,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        retry_policy: RetryPolicy = None,
+    ):
+        api_base = api_base or os.getenv("OPENAI_API_BASE") or openai.api_base
+        self.api_base = (api_base or "").rstrip("/")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY") or openai.api_key
+        self.embeddings_api_version = embeddings_api_version
+        self.chat_api_version = chat_api_version
+        self.max_in_flight = max_in_flight
+        self.timeout = (connect_timeout, read_timeout)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"api-key": self.api_key})
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        self.__lock = threading.Lock()
+
+    def stats(self) -> dict:
+        """
+        Get the request counters and the in-flight requests.
+        """
+        with self.__lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "max_in_flight": self.max_in_flight,
+            }
+
+    @contextmanager
+    def __slot(self):
+        """
+        Hold one of the `max_in_flight` places while a request runs.
+        """
+        with self.__slots:
+            with self.__lock:
+                self.in_flight += 1
+                self.requests += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+            try:
+                yield
+            finally:
+                with self.__lock:
+                    self.in_flight -= 1
+
+    def __url(self, path: str) -> str:
+        return f"{self.api_base}/openai/{path}"
+
+    def __wait_retry(self, attempt: int, reason: str, retry_after: float = None):
+        delay = self.retry_policy.get_delay(attempt, retry_after)
+        logging.warning(
+            f"Azure OpenAI request failed ({reason}), retry in {delay:.1f}s"
+        )
+
+        with self.__lock:
+            self.retries += 1
+
+        time.sleep(delay)
+
+    @contextmanager
+    def request(
+        self,
+        method: str,
+        path: str,
+        api_version: str,
+        json_body: dict = None,
+        stream: bool = False,
+        max_retries: int = None,
+    ) -> Iterator[requests.Response]:
+        """
+        Send a request with retries and hold its in-flight place until the block ends.
+
+        A streamed body is read inside the block, a failure in the middle of it is
+        not retried.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path after "/openai/", e.g. "deployments".
+            api_version (str): The api-version parameter.
+            json_body (dict, optional): The JSON body. Default is None.
+            stream (bool, optional): Whether the body is read in the block.
+                Default is False.
+            max_retries (int, optional): Overrides the retries of the policy.
+
+        Yields:
+            requests.Response: The successful answer.
+
+        Raises:
+            AzureOpenAIError: For an error answer, after the retries.
+            requests.RequestException: For a connection error, after the retries.
+        """
+        if max_retries is None:
+            max_retries = self.retry_policy.max_retries
+
+        url = self.__url(path)
+
+        for attempt in range(max_retries + 1):
+            with self.__slot():
+                try:
+                    response = self.session.request(
+                        method,
+                        url,
+                        params={"api-version": api_version},
+                        json=json_body,
+                        stream=stream,
+                        timeout=self.timeout,
+                    )
+                except (requests.ConnectionError, requests.Timeout) as error:
+                    if attempt == max_retries:
+                        raise
+
+                    reason = type(error).__name__
+                    retry_after = None
+                else:
+                    if response.status_code < 400:
+                        try:
+                            yield response
+                        finally:
+                            response.close()
+                        return
+
+                    retry_after = RetryPolicy.parse_retry_after(
+                        response.headers.get("Retry-After")
+                    )
+                    error = AzureOpenAIError(
+                        response.status_code, response.text, retry_after
+                    )
+                    response.close()
+
+                    if not error.retryable or attempt == max_retries:
+                        raise error
+
+                    reason = error.status
+
+            self.__wait_retry(attempt, reason, retry_after)
+
+    def get_deployments(self) -> list:
+        """
+        Get the names of the deployments of the endpoint.
+        """
+        with self.request("GET", "deployments", "2022-12-01") as response:
+            return [deployment["id"] for deployment in response.json()["data"]]
+
+    def create_embeddings(
+        self, texts: list, engine: str, max_retries: int = None
+    ) -> list:
+        """
+        Get the embeddings of several texts in a single request.
+
+        Args:
+            texts (list): The texts to embed.
+            engine (str): The embedding deployment.
+            max_retries (int, optional): Overrides the retries of the policy.
+
+        Returns:
+            list: The embeddings, in the same order as the texts.
+        """
+        with self.request(
+            "POST",
+            f"deployments/{engine}/embeddings",
+            self.embeddings_api_version,
+            {"input": texts},
+            max_retries=max_retries,
+        ) as response:
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+
+        return [item["embedding"] for item in data]
+
+    def create_chat_completion(
+        self, messages: list, engine: str, temperature: float = 0
+    ) -> str:
+        """
+        Get the model-generated message of a chat in a single response.
+        """
+        with self.request(
+            "POST",
+            f"deployments/{engine}/chat/completions",
+            self.chat_api_version,
+            {"messages": messages, "temperature": temperature},
+        ) as response:
+            return response.json()["choices"][0]["message"].get("content")
+
+    def stream_chat_completion(
+        self, messages: list, engine: str, temperature: float = 0
+    ) -> Iterator[str]:
+        """
+        Stream the model-generated message of a chat as the tokens arrive.
+        """
+        with self.request(
+            "POST",
+            f"deployments/{engine}/chat/completions",
+            self.chat_api_version,
+            {"messages": messages, "temperature": temperature, "stream": True},
+            stream=True,
+        ) as response:
+            for line in response.iter_lines():
+                delta = parse_stream_line(line.decode("utf-8"))
+
+                if delta is StopIteration:
+                    break
+
+                if delta:
+                    yield delta
+
+    def close(self):
+        self.session.close()
+
+
+def parse_stream_line(line: str):
+    """
+    Get the content of a server-sent event line of a streamed completion.
+
+    Returns:
+        str | None | StopIteration: The delta, None for the lines without content
+            (e.g. the content filter results of azure), StopIteration at the end.
+    """
+    line = line.strip()
+
+    if not line.startswith("data:"):
+        return None
+
+    data = line[len("data:") :].strip()
+
+    if data == "[DONE]":
+        return StopIteration
+
+    choices = json.loads(data).get("choices")
+
+    if not choices:
+        return None
+
+    return choices[0].get("delta", {}).get("content")
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client() -> AzureOpenAIHttpClient:
+    """
+    Get the client shared by the process, created with the environment the first time.
+    """
+    global _default_client
+
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = AzureOpenAIHttpClient()
+
+        return _default_client
+
+
+def set_default_client(client: AzureOpenAIHttpClient):
+    """
+    Replace the client shared by the process, e.g. to point it to a test server.
+    """
+    global _default_client
+
+    with _default_client_lock:
+        _default_client = client
@@ -40,3 +40,14 @@ CHECK_IF_ONLY_HELLO = """
     
     ####output
     """
+
+SUMMARIZE_HISTORY = """
+    You have to summarize a conversation between a user and an assistant about the software Lang Chain.\
+    The summary of the conversation until now is between double backticks, it can be empty.\
+    ``{summary}``
+    The new part of the conversation is between triple backticks.\
+    ```{conversation}```
+    Write a new summary that joins both, with the questions of the user, the answers and the names of classes,\
+    functions and code that were mentioned. Use less than {max_words} words.\
+    Only write the summary.
+    """
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from load_transform_data.embedding_index import EmbeddingIndex
+from load_transform_data.quantized_index import QuantizedIndex
+
+
+@pytest.fixture
+def store():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(500, 64))
+    queries = rng.normal(size=(20, 64))
+    return pd.DataFrame({"ada_v2": list(embeddings)}), queries
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+@pytest.mark.parametrize("with_matrix", [True, False])
+def test_top_k_matches_embedding_index(store, dtype, with_matrix):
+    df, queries = store
+    exact = EmbeddingIndex(df)
+    matrix = exact.matrix if with_matrix else None
+    index = QuantizedIndex(df, matrix=matrix, dtype=dtype)
+
+    for query in queries:
+        expected_positions, expected_scores = exact.search(query, top_n=5)
+        positions, scores = index.search(query, top_n=5)
+        np.testing.assert_array_equal(positions, expected_positions)
+        np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+    positions, scores = index.search_batch(queries, top_n=5)
+    expected_positions, expected_scores = exact.search_batch(queries, top_n=5)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_empty_store(dtype):
+    index = QuantizedIndex(pd.DataFrame({"ada_v2": []}), dtype=dtype)
+    positions, scores = index.search(np.ones(8), top_n=3)
+    assert len(index) == 0
+    assert positions.size == 0 and scores.size == 0
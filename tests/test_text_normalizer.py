@@ -0,0 +1,21 @@
+import pytest
+
+from benchmarks.clean_content import CASES, legacy_clean_content_fixed, make_pages
+from load_transform_data.text_normalizer import TextNormalizer
+
+TEXTS = [
+    "The loader reads every PDF page. , Then the splitter cuts it in chunks.",
+    "Accents é, symbols € and emoji 😀 are removed.. from the text",
+    "values 1 , 2 , 3 and   wide\tgaps\r\nbetween lines",
+]
+
+
+@pytest.mark.parametrize("text, expected", CASES)
+def test_cases(text, expected):
+    assert TextNormalizer().clean(text) == expected
+
+
+def test_matches_fixed_legacy():
+    pages = make_pages(TEXTS, 300)
+    expected = [legacy_clean_content_fixed(page) for page in pages]
+    assert TextNormalizer().clean_many(pages) == expected